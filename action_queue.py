@@ -0,0 +1,70 @@
+import asyncio
+from collections import deque
+
+from metrics import ACTION_BATCH_SIZE, ACTION_QUEUE_REJECTED
+
+
+class ActionQueueFull(Exception):
+    pass
+
+
+# Serializes the actions of each player inside this process. A request that
+# arrives while the player's previous actions are in the database waits in the
+# player's queue; everything queued by then is applied in one transaction, in
+# arrival order, and every waiter gets the result of its own action. A burst
+# for one player therefore holds one connection instead of one per request.
+# More than max_depth waiting actions are refused with ActionQueueFull.
+class ActionQueue:
+    def __init__(self, run_batch, max_depth: int = 16, max_batch: int = 32):
+        # run_batch(user_id, [(action, payload), ...], username, first_name)
+        # returns one result per action.
+        self._run_batch = run_batch
+        self.max_depth = max(1, max_depth)
+        self.max_batch = max(1, max_batch)
+        self._queues: dict[str, deque] = {}
+        # Running drains; the loop only keeps weak references to tasks.
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._queues)
+
+    def depth(self, user_id: str) -> int:
+        queue = self._queues.get(user_id)
+        return len(queue) if queue is not None else 0
+
+    async def submit(self, user_id: str, action: str, payload: dict | None, username: str | None, first_name: str | None):
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = self._queues[user_id] = deque()
+            # A task, so a client that disconnects does not stall the others.
+            task = asyncio.create_task(self._drain(user_id, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif len(queue) >= self.max_depth:
+            ACTION_QUEUE_REJECTED.inc()
+            raise ActionQueueFull(user_id)
+
+        future = asyncio.get_running_loop().create_future()
+        queue.append((action, payload, username, first_name, future))
+        return await future
+
+    async def _drain(self, user_id: str, queue: deque):
+        try:
+            while queue:
+                batch = [queue.popleft() for _ in range(min(len(queue), self.max_batch))]
+                _, _, username, first_name, _ = batch[-1]
+                ACTION_BATCH_SIZE.observe(len(batch))
+                try:
+                    results = await self._run_batch(
+                        user_id, [(action, payload) for action, payload, _, _, _ in batch], username, first_name
+                    )
+                except Exception as e:
+                    for *_, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                for (*_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            del self._queues[user_id]
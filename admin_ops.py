@@ -0,0 +1,167 @@
+import csv
+import gzip
+import io
+import json
+import re
+
+from aggregates import CORRECT as CORRECT_AGGREGATE
+from aggregates import UPSERT as AGGREGATE_UPSERT
+from user_record import FIELDS
+
+_NUMERIC_PLACEHOLDER = re.compile(r"\$\d+")
+_USER_ID_SEPARATORS = re.compile(r"[\s,;]+")
+
+GIVE_COINS = """
+    UPDATE users SET coins = coins + $1, version = version + 1
+    WHERE {user_ids}
+    RETURNING user_id, first_name, coins
+"""
+RESET_USERS = """
+    UPDATE users SET
+        coins = 0,
+        energy = 1000,
+        max_energy = 1000,
+        multi_tap_level = 1,
+        energy_level = 1,
+        auto_tap_level = 0,
+        skin_bought = $1,
+        ban_end_time = 0,
+        tap_window_start = 0,
+        tap_count = 0,
+        last_update = $2,
+        version = version + 1
+    WHERE {user_ids}
+    RETURNING user_id, first_name
+"""
+# The user_aggregates triggers do not watch coins on UPDATE, so the coins
+# RESET_USERS zeroes come off the total first, in the same transaction. On
+# PostgreSQL the rows are locked here so that no tap lands in between.
+# (WHERE true keeps SQLite from reading ON CONFLICT as a join constraint.)
+RESET_COINS_TOTAL = f"""
+    INSERT INTO user_aggregates (slot, metric, value)
+    SELECT 0, 'coins', -COALESCE(SUM(CAST(coins AS DOUBLE PRECISION)), 0)
+    FROM (SELECT coins FROM users WHERE {{user_ids}}{{lock}}) AS reset
+    WHERE true
+    {AGGREGATE_UPSERT}
+"""
+
+# What RESET_USERS writes (last_update is the reset time), for the journal.
+RESET_VALUES = {
+    "coins": 0.0,
+    "energy": 1000.0,
+    "max_energy": 1000,
+    "multi_tap_level": 1,
+    "energy_level": 1,
+    "auto_tap_level": 0,
+    "skin_bought": False,
+    "ban_end_time": 0,
+    "tap_window_start": 0,
+    "tap_count": 0,
+}
+
+BAN_USERS = """
+    UPDATE users SET ban_end_time = $1, version = version + 1
+    WHERE {user_ids}
+    RETURNING user_id, first_name
+"""
+
+# /users pages in leaderboard order; (coins, user_id) of the first or last row
+# shown is the cursor, so every page is an index range scan on
+# idx_users_coins_user however deep it is. coins is REAL (float4) on
+# PostgreSQL, so the cursor value is cast back to it to compare equal.
+USERS_PAGE_FIRST = """
+    SELECT user_id, first_name, coins, multi_tap_level FROM users
+    ORDER BY coins DESC, user_id DESC
+    LIMIT $1
+"""
+USERS_PAGE_AFTER = """
+    SELECT user_id, first_name, coins, multi_tap_level FROM users
+    WHERE (coins, user_id) < ($1{real}, $2)
+    ORDER BY coins DESC, user_id DESC
+    LIMIT $3
+"""
+USERS_PAGE_BEFORE = """
+    SELECT user_id, first_name, coins, multi_tap_level FROM users
+    WHERE (coins, user_id) > ($1{real}, $2)
+    ORDER BY coins ASC, user_id ASC
+    LIMIT $3
+"""
+EXPORT_COLUMNS = ("user_id",) + FIELDS + ("blocked_bot",)
+EXPORT_USERS = f"SELECT {', '.join(EXPORT_COLUMNS)} FROM users ORDER BY user_id"
+
+
+# Each admin mutation is one UPDATE ... RETURNING over a list of user ids bound
+# as a single parameter: a text[] on PostgreSQL, a JSON array expanded with
+# json_each() on SQLite. Queries are written with $n placeholders and
+# rewritten for the driver's paramstyle ("numeric", "format" or "qmark").
+class AdminQueries:
+    def __init__(self, postgres: bool, paramstyle: str = "numeric"):
+        self.postgres = postgres
+        self.paramstyle = paramstyle
+        self.give_coins = self._query(GIVE_COINS, "$2")
+        self.reset_users = self._query(RESET_USERS, "$3")
+        self.reset_coins_total = self._query(RESET_COINS_TOTAL, "$1", lock=" FOR UPDATE" if postgres else "")
+        self.ban_users = self._query(BAN_USERS, "$2")
+        real = "::real" if postgres else ""
+        self.users_page_first = self._rewrite(USERS_PAGE_FIRST)
+        self.users_page_after = self._rewrite(USERS_PAGE_AFTER.format(real=real))
+        self.users_page_before = self._rewrite(USERS_PAGE_BEFORE.format(real=real))
+        self.export_users = EXPORT_USERS
+        self.correct_aggregate = self._rewrite(CORRECT_AGGREGATE)
+
+    def _query(self, template: str, placeholder: str, **fields) -> str:
+        if self.postgres:
+            user_ids = f"user_id = ANY({placeholder}::text[])"
+        else:
+            user_ids = f"user_id IN (SELECT value FROM json_each({placeholder}))"
+        return self._rewrite(template.format(user_ids=user_ids, **fields))
+
+    def _rewrite(self, query: str) -> str:
+        if self.paramstyle == "format":
+            return _NUMERIC_PLACEHOLDER.sub("%s", query)
+        if self.paramstyle == "qmark":
+            return _NUMERIC_PLACEHOLDER.sub("?", query)
+        return query
+
+    def user_ids(self, user_ids):
+        return list(user_ids) if self.postgres else json.dumps(list(user_ids))
+
+    def users_page(self, cursor, direction: str, limit: int):
+        # (query, params) for the page after or before cursor, or the first.
+        if cursor is None:
+            return self.users_page_first, (limit,)
+        query = self.users_page_before if direction == "prev" else self.users_page_after
+        return query, (cursor[0], cursor[1], limit)
+
+
+# /export output: rows are appended chunk by chunk to a gzip-compressed CSV,
+# so memory stays bounded by one chunk whatever the table size.
+class CsvGzipWriter:
+    def __init__(self, path: str, header, compresslevel: int = 6):
+        self.path = path
+        self.rows = 0
+        self._file = gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=compresslevel)
+        self._csv = csv.writer(self._file)
+        self._csv.writerow(header)
+
+    def write_rows(self, rows):
+        self._csv.writerows(rows)
+        self.rows += len(rows)
+
+    def close(self):
+        self._file.close()
+
+
+def parse_user_ids(text: str) -> list[str]:
+    # "1,2,3", "1 2 3" or one id; duplicates are dropped, order is kept.
+    return list(dict.fromkeys(part for part in _USER_ID_SEPARATORS.split(text) if part))
+
+
+def read_user_ids_csv(data: bytes) -> list[str]:
+    # User ids are taken from the first column; a header row is skipped.
+    text = data.decode("utf-8-sig", errors="replace")
+    user_ids = []
+    for row in csv.reader(io.StringIO(text)):
+        if row and row[0].strip().isdigit():
+            user_ids.append(row[0].strip())
+    return list(dict.fromkeys(user_ids))
@@ -0,0 +1,161 @@
+import math
+
+# dialect is "postgresql" or "sqlite", as in migrations.py.
+
+LEVEL_COLUMNS = ("multi_tap_level", "energy_level", "auto_tap_level")
+# PostgreSQL triggers spread increments over this many rows per metric, by
+# hash of user_id, so concurrent transactions do not queue on one row lock.
+# SQLite has a single writer and keeps everything in slot 0.
+PG_SLOTS = 16
+
+TABLE = """
+    CREATE TABLE IF NOT EXISTS user_aggregates (
+        slot INTEGER NOT NULL,
+        metric TEXT NOT NULL,
+        value DOUBLE PRECISION NOT NULL DEFAULT 0,
+        PRIMARY KEY (slot, metric)
+    )
+"""
+UPSERT = "ON CONFLICT (slot, metric) DO UPDATE SET value = user_aggregates.value + excluded.value"
+
+# The triggers count coins only when a player is created or deleted: coins
+# change on every tap, and an UPDATE trigger on them would write to
+# user_aggregates on the tap path. Each process adds up the coin changes of
+# the actions it runs and flushes them with CORRECT every
+# AGGREGATES_COINS_FLUSH_S instead (bot.py); an admin reset takes the coins it
+# zeroes off itself (admin_ops.RESET_COINS_TOTAL).
+# metric -> value computed from users itself: the full scans /admin used to run.
+TRUE_VALUES = " UNION ALL ".join(
+    [
+        "SELECT 'users' AS metric, CAST(COUNT(*) AS DOUBLE PRECISION) AS value FROM users",
+        "SELECT 'coins', CAST(COALESCE(SUM(coins), 0) AS DOUBLE PRECISION) FROM users",
+    ]
+    + [
+        f"SELECT '{column}=' || {column}, CAST(COUNT(*) AS DOUBLE PRECISION) FROM users GROUP BY {column}"
+        for column in LEVEL_COLUMNS
+    ]
+)
+READ = "SELECT metric, SUM(value) FROM user_aggregates GROUP BY metric"
+# Drift is fixed by adding the difference rather than overwriting, so
+# increments committed after the DRIFT snapshot are kept.
+CORRECT = f"INSERT INTO user_aggregates (slot, metric, value) VALUES (0, $1, $2) {UPSERT}"
+# Both sides in one statement, so they are read from the same snapshot and
+# writes committed meanwhile cannot show up as drift.
+DRIFT = f"""
+    SELECT metric, SUM(actual), SUM(stored)
+    FROM (
+        SELECT metric, value AS actual, 0 AS stored FROM ({TRUE_VALUES}) AS counted
+        UNION ALL
+        SELECT metric, 0, value FROM user_aggregates
+    ) AS sides
+    GROUP BY metric
+"""
+
+
+def _changes(sides, guard: bool, coins: bool = True) -> str:
+    # Per-metric increments of one row change; sides is (record, sign) for
+    # OLD (-1) and/or NEW (+1). An UPDATE that leaves a level alone adds -1
+    # and +1 to the same metric, which the caller's GROUP BY cancels out.
+    parts = []
+    for record, sign in sides:
+        where = f" WHERE {record}.user_id IS NOT NULL" if guard else ""
+        parts.append(f"SELECT 'users' AS metric, {sign} AS value{where}")
+        if coins:
+            parts.append(f"SELECT 'coins', {sign} * CAST({record}.coins AS DOUBLE PRECISION){where}")
+        parts.extend(f"SELECT '{column}=' || {record}.{column}, {sign}{where}" for column in LEVEL_COLUMNS)
+    return " UNION ALL ".join(parts)
+
+
+def _increment(slot: str, changes: str) -> str:
+    return f"""
+        INSERT INTO user_aggregates (slot, metric, value)
+        SELECT {slot}, metric, SUM(value)
+        FROM ({changes}) AS changes
+        GROUP BY metric
+        HAVING SUM(value) <> 0
+        {UPSERT};
+    """
+
+
+def install(cursor, dialect: str):
+    # Table, triggers and the initial values from a full scan. Used by schema
+    # migration 3, and by 6, which took coins out of the UPDATE triggers.
+    cursor.execute(TABLE)
+    watched = ", ".join(LEVEL_COLUMNS)
+    if dialect == "postgresql":
+        slot = f"hashtext(COALESCE(NEW.user_id, OLD.user_id)) & {PG_SLOTS - 1}"
+        both = (("OLD", -1), ("NEW", 1))
+        cursor.execute(
+            f"""
+            CREATE OR REPLACE FUNCTION users_aggregates_trigger() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP = 'UPDATE' THEN
+                    {_increment(slot, _changes(both, guard=True, coins=False))}
+                ELSE
+                    {_increment(slot, _changes(both, guard=True))}
+                END IF;
+                RETURN NULL;
+            END
+            $$
+            """
+        )
+        cursor.execute("DROP TRIGGER IF EXISTS users_aggregates ON users")
+        cursor.execute(
+            f"""
+            CREATE TRIGGER users_aggregates
+            AFTER INSERT OR DELETE OR UPDATE OF {watched} ON users
+            FOR EACH ROW EXECUTE PROCEDURE users_aggregates_trigger()
+            """
+        )
+    else:
+        for event, sides, coins in (
+            ("INSERT", (("NEW", 1),), True),
+            (f"UPDATE OF {watched}", (("OLD", -1), ("NEW", 1)), False),
+            ("DELETE", (("OLD", -1),), True),
+        ):
+            name = f"users_aggregates_{event.split()[0].lower()}"
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+            cursor.execute(
+                f"""
+                CREATE TRIGGER {name} AFTER {event} ON users
+                BEGIN
+                    {_increment("0", _changes(sides, guard=False, coins=coins))}
+                END
+                """
+            )
+    cursor.execute("DELETE FROM user_aggregates")
+    cursor.execute(
+        f"INSERT INTO user_aggregates (slot, metric, value) SELECT 0, metric, value FROM ({TRUE_VALUES}) AS counted"
+    )
+
+
+def summary(rows) -> dict:
+    # READ rows as {"users": n, "coins": x, "multi_tap_level": {level: n}, ...}.
+    result = {"users": 0, "coins": 0.0}
+    result.update({column: {} for column in LEVEL_COLUMNS})
+    for metric, value in rows:
+        column, _, level = metric.partition("=")
+        if column in LEVEL_COLUMNS:
+            if round(value):
+                result[column][int(level)] = int(round(value))
+        elif column == "users":
+            result["users"] = int(round(value))
+        elif column == "coins":
+            result["coins"] = float(value)
+    for column in LEVEL_COLUMNS:
+        result[column] = dict(sorted(result[column].items()))
+    return result
+
+
+def drift(rows, coins_tolerance: float = 1e-6) -> list[tuple[str, float, float]]:
+    # DRIFT rows that disagree, as (metric, actual, stored). coins is a sum of
+    # floats and may differ in the last bits, hence the relative tolerance.
+    mismatched = []
+    for metric, actual, stored in rows:
+        actual, stored = float(actual or 0), float(stored or 0)
+        if metric == "coins":
+            if not math.isclose(actual, stored, rel_tol=coins_tolerance, abs_tol=coins_tolerance):
+                mismatched.append((metric, actual, stored))
+        elif round(actual) != round(stored):
+            mismatched.append((metric, actual, stored))
+    return sorted(mismatched)
@@ -0,0 +1,497 @@
+import asyncio
+import math
+import time
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+
+import aggregates
+from admin_ops import EXPORT_COLUMNS, AdminQueries, CsvGzipWriter
+from game import DEFAULT_FIRST_NAME, DEFAULT_USERNAME, apply_identity, apply_passive_progress, now_ms, resolve_actions, row_to_data
+from metrics import (
+    DB_OPTIMISTIC_CONFLICTS,
+    DB_OPTIMISTIC_FALLBACKS,
+    DB_POOL_IN_USE,
+    DB_POOL_WAIT_SECONDS,
+    DB_TRANSACTION_SECONDS,
+)
+from storage import (
+    BROADCAST_RECIPIENTS,
+    CREATE_BROADCAST_JOB,
+    FETCH_USER,
+    FETCH_USER_FOR_UPDATE,
+    FETCH_USER_VERSIONED,
+    INSERT_USER,
+    LEADERBOARD,
+    PG_PLACEHOLDER,
+    RANKING_ROWS,
+    SAVE_BROADCAST_PROGRESS,
+    SET_USER_BLOCKED,
+    TOP_USERS,
+    UNFINISHED_BROADCAST_JOBS,
+    leaderboard_entry,
+)
+from tap_sql import PG_TAP_BATCH, SQLITE_TAP_BATCH, TapBatch, is_tap_batch
+from user_record import group_updates, update_params, update_query
+
+
+# storage.Storage like the threaded psycopg2/sqlite3 functions in bot.py, but
+# every call stays on the event loop. Subclasses provide a pooled connection with
+# fetchrow/fetch/fetchval/execute/executemany and a write transaction.
+class AsyncDatabase(ABC):
+    lock_rows = False
+    driver = ""
+    admin: AdminQueries
+    # > 0: player actions are optimistic with this many attempts (bot.py's
+    # DB_CONCURRENCY) before falling back to the locked transaction.
+    optimistic_retries = 0
+    # Batches of taps go through tap_batch, one statement each (DB_TAP_SQL).
+    tap_sql = False
+    tap_batch = ""
+
+    @abstractmethod
+    async def connect(self): ...
+
+    @abstractmethod
+    async def close(self): ...
+
+    @abstractmethod
+    def connection(self): ...
+
+    @abstractmethod
+    def transaction(self, conn): ...
+
+    @abstractmethod
+    async def _update_count(self, conn, query: str, *args) -> int:
+        # Runs an UPDATE outside any transaction and returns the rows changed.
+        ...
+
+    async def _fetch_or_create(self, conn, user_id: str, username: str | None, first_name: str | None, query: str):
+        row = await conn.fetchrow(query, user_id)
+        if row is None:
+            await conn.execute(
+                INSERT_USER,
+                user_id,
+                username or DEFAULT_USERNAME,
+                first_name or DEFAULT_FIRST_NAME,
+                now_ms(),
+            )
+            row = await conn.fetchrow(query, user_id)
+            if row is None:
+                raise RuntimeError("User creation failed")
+        return row
+
+    async def load_user(self, user_id: str, username: str | None = None, first_name: str | None = None):
+        async with self.connection() as conn:
+            row = await self._fetch_or_create(conn, user_id, username, first_name, FETCH_USER)
+        return row_to_data(row)
+
+    async def save_users(self, rows):
+        if not rows:
+            return
+        async with self.connection() as conn:
+            async with self.transaction(conn):
+                for columns, params in group_updates(rows).items():
+                    await conn.executemany(update_query(columns), params)
+
+    async def get_user_data(self, user_id: str, username: str | None = None, first_name: str | None = None):
+        data = await self.load_user(user_id, username, first_name)
+        apply_identity(data, username, first_name)
+        apply_passive_progress(data, now_ms())
+        return dict(data)
+
+    async def process_user_action(
+        self,
+        user_id: str,
+        action: str,
+        username: str | None = None,
+        first_name: str | None = None,
+        action_payload: dict | None = None,
+    ):
+        results = await self.process_user_actions(user_id, [(action, action_payload)], username, first_name)
+        return results[0]
+
+    async def process_user_actions(
+        self, user_id: str, actions, username: str | None = None, first_name: str | None = None
+    ):
+        if self.tap_sql and is_tap_batch(actions):
+            return await self._process_tap_batches(user_id, actions, username, first_name)
+        if self.optimistic_retries > 0:
+            results = await self._process_optimistic(user_id, actions, username, first_name)
+            if results is not None:
+                return results
+        async with self.connection() as conn:
+            started = time.perf_counter()
+            try:
+                async with self.transaction(conn):
+                    row = await self._fetch_or_create(
+                        conn,
+                        user_id,
+                        username,
+                        first_name,
+                        FETCH_USER_FOR_UPDATE if self.lock_rows else FETCH_USER,
+                    )
+                    data = row_to_data(row)
+                    apply_identity(data, username, first_name)
+                    results = resolve_actions(data, actions)
+                    changes = data.take_changes()
+                    if changes:
+                        await conn.execute(update_query(tuple(changes)), *update_params(user_id, changes))
+            finally:
+                DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, self.driver)
+        return results
+
+    async def _process_optimistic(self, user_id: str, actions, username: str | None, first_name: str | None):
+        # None once every attempt lost to a concurrent write.
+        async with self.connection() as conn:
+            started = time.perf_counter()
+            try:
+                for _ in range(self.optimistic_retries):
+                    row = await self._fetch_or_create(conn, user_id, username, first_name, FETCH_USER_VERSIONED)
+                    data = row_to_data(tuple(row)[1:])
+                    apply_identity(data, username, first_name)
+                    results = resolve_actions(data, actions)
+                    changes = data.take_changes()
+                    if not changes:
+                        return results
+                    query = update_query(tuple(changes), versioned=True)
+                    if await self._update_count(conn, query, *update_params(user_id, changes), row[0]) == 1:
+                        return results
+                    DB_OPTIMISTIC_CONFLICTS.inc(self.driver)
+            finally:
+                DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, self.driver)
+        DB_OPTIMISTIC_FALLBACKS.inc(self.driver)
+        return None
+
+    async def _process_tap_batches(self, user_id: str, actions, username: str | None, first_name: str | None):
+        # apply_tap_batch locks the row itself; SQLite needs the write lock
+        # up front, as in process_user_actions.
+        async with self.connection() as conn:
+            started = time.perf_counter()
+            try:
+                if self.lock_rows:
+                    return await self._tap_batches(conn, user_id, actions, username, first_name)
+                async with self.transaction(conn):
+                    return await self._tap_batches(conn, user_id, actions, username, first_name)
+            finally:
+                DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, self.driver)
+
+    async def _tap_batches(self, conn, user_id: str, actions, username: str | None, first_name: str | None):
+        results = []
+        for action, payload in actions:
+            batch = TapBatch(user_id, action, payload, username, first_name)
+            results.append(batch.result(await conn.fetchrow(self.tap_batch, *batch.params)))
+        return results
+
+    async def get_leaderboard(self):
+        async with self.connection() as conn:
+            rows = await conn.fetch(LEADERBOARD)
+        return [leaderboard_entry(row) for row in rows]
+
+    async def get_aggregates(self):
+        async with self.connection() as conn:
+            return aggregates.summary(await conn.fetch(aggregates.READ))
+
+    async def get_aggregate_drift(self):
+        async with self.connection() as conn:
+            return aggregates.drift(await conn.fetch(aggregates.DRIFT))
+
+    async def correct_aggregates(self, corrections):
+        async with self.connection() as conn:
+            async with self.transaction(conn):
+                await conn.executemany(self.admin.correct_aggregate, corrections)
+
+    async def add_to_coins_total(self, changes):
+        await self.correct_aggregates([("coins", math.fsum(coins for _, coins in changes))])
+
+    async def get_top_users(self, limit: int = 50):
+        async with self.connection() as conn:
+            return await conn.fetch(TOP_USERS, limit)
+
+    async def get_ranking_rows(self):
+        async with self.connection() as conn:
+            return await conn.fetch(RANKING_ROWS)
+
+    async def get_users_page(self, cursor_key, direction: str, limit: int):
+        query, params = self.admin.users_page(cursor_key, direction, limit)
+        async with self.connection() as conn:
+            return await conn.fetch(query, *params)
+
+    async def export_users(self, path: str, chunk_size: int) -> int:
+        writer = CsvGzipWriter(path, EXPORT_COLUMNS)
+        try:
+            async for rows in self.export_rows(chunk_size):
+                await asyncio.to_thread(writer.write_rows, rows)
+        finally:
+            await asyncio.to_thread(writer.close)
+        return writer.rows
+
+    async def export_rows(self, chunk_size: int):
+        # EXPORT_COLUMNS of every user in user_id order, chunk_size rows at a time.
+        async with self.connection() as conn:
+            async for rows in self._chunks(conn, self.admin.export_users, chunk_size):
+                yield [tuple(row) for row in rows]
+
+    @abstractmethod
+    def _chunks(self, conn, query: str, size: int):
+        # Async iterator over the query's rows, size rows at a time.
+        ...
+
+    async def give_coins(self, user_ids, coins: float):
+        async with self.connection() as conn:
+            return await conn.fetch(self.admin.give_coins, coins, self.admin.user_ids(user_ids))
+
+    async def reset_users(self, user_ids):
+        async with self.connection() as conn:
+            async with self.transaction(conn):
+                await conn.execute(self.admin.reset_coins_total, self.admin.user_ids(user_ids))
+                return await conn.fetch(self.admin.reset_users, False, now_ms(), self.admin.user_ids(user_ids))
+
+    async def ban_users(self, user_ids, ban_end: int):
+        async with self.connection() as conn:
+            return await conn.fetch(self.admin.ban_users, ban_end, self.admin.user_ids(user_ids))
+
+    async def get_user_row(self, user_id: str):
+        async with self.connection() as conn:
+            return await conn.fetchrow(FETCH_USER, user_id)
+
+    async def create_broadcast_job(self, text: str, chat_id: int, status_message_id: int, created_at: int):
+        async with self.connection() as conn:
+            return await conn.fetchval(CREATE_BROADCAST_JOB, text, chat_id, status_message_id, created_at, created_at)
+
+    async def get_unfinished_broadcast_jobs(self):
+        async with self.connection() as conn:
+            return await conn.fetch(UNFINISHED_BROADCAST_JOBS)
+
+    async def get_broadcast_recipients(self, after_user_id: str, limit: int):
+        async with self.connection() as conn:
+            rows = await conn.fetch(BROADCAST_RECIPIENTS, after_user_id, False, limit)
+        return [row[0] for row in rows]
+
+    async def save_broadcast_progress(
+        self, job_id: int, status: str, last_user_id: str, sent: int, failed: int, blocked: int
+    ):
+        async with self.connection() as conn:
+            await conn.execute(SAVE_BROADCAST_PROGRESS, status, last_user_id, sent, failed, blocked, now_ms(), job_id)
+
+    async def set_users_blocked(self, user_ids, blocked: bool):
+        async with self.connection() as conn:
+            await conn.executemany(SET_USER_BLOCKED, [(blocked, user_id, blocked) for user_id in user_ids])
+
+
+class AsyncPostgresDatabase(AsyncDatabase):
+    lock_rows = True
+    driver = "asyncpg"
+    admin = AdminQueries(postgres=True)
+    tap_batch = PG_TAP_BATCH
+
+    def __init__(
+        self,
+        dsn: str,
+        min_size: int,
+        max_size: int,
+        statement_cache_size: int,
+        connect_timeout: int,
+        optimistic_retries: int = 0,
+        tap_sql: bool = False,
+    ):
+        self.dsn = dsn
+        self.optimistic_retries = optimistic_retries
+        self.tap_sql = tap_sql
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self.connect_timeout = connect_timeout
+        self.pool = None
+
+    async def connect(self):
+        import asyncpg
+
+        if self.pool is None:
+            # asyncpg prepares every query on first use and keeps up to
+            # statement_cache_size prepared statements per connection; set it
+            # to 0 behind PgBouncer in transaction mode.
+            self.pool = await asyncpg.create_pool(
+                self.dsn,
+                min_size=self.min_size,
+                max_size=self.max_size,
+                statement_cache_size=self.statement_cache_size,
+                timeout=self.connect_timeout,
+                ssl="require",
+            )
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def connection(self):
+        if self.pool is None:
+            raise RuntimeError("PostgreSQL pool is not initialized")
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, self.driver)
+            DB_POOL_IN_USE.inc(self.driver)
+            try:
+                yield conn
+            finally:
+                DB_POOL_IN_USE.dec(self.driver)
+
+    def transaction(self, conn):
+        return conn.transaction()
+
+    async def _update_count(self, conn, query: str, *args) -> int:
+        status = await conn.execute(query, *args)
+        return int(status.rsplit(" ", 1)[-1])
+
+    async def _chunks(self, conn, query: str, size: int):
+        # asyncpg cursors are server-side and only live in a transaction.
+        async with conn.transaction():
+            cursor = await conn.cursor(query)
+            while True:
+                rows = await cursor.fetch(size)
+                if not rows:
+                    return
+                yield rows
+
+
+class _SqliteConnection:
+    def __init__(self, conn, statement_cache: dict):
+        self.conn = conn
+        self._statements = statement_cache
+
+    def _sql(self, query: str) -> str:
+        sql = self._statements.get(query)
+        if sql is None:
+            sql = self._statements[query] = PG_PLACEHOLDER.sub("?", query)
+        return sql
+
+    async def fetchrow(self, query: str, *args):
+        async with self.conn.execute(self._sql(query), args) as cursor:
+            return await cursor.fetchone()
+
+    async def fetch(self, query: str, *args):
+        async with self.conn.execute(self._sql(query), args) as cursor:
+            return await cursor.fetchall()
+
+    async def fetchval(self, query: str, *args):
+        row = await self.fetchrow(query, *args)
+        return row[0] if row else None
+
+    async def execute(self, query: str, *args):
+        await self.conn.execute(self._sql(query), args)
+
+    async def executemany(self, query: str, args):
+        await self.conn.executemany(self._sql(query), args)
+
+
+class AsyncSqliteDatabase(AsyncDatabase):
+    driver = "aiosqlite"
+    admin = AdminQueries(postgres=False)
+    tap_batch = SQLITE_TAP_BATCH
+
+    def __init__(
+        self,
+        path: str,
+        pool_size: int,
+        statement_cache_size: int,
+        busy_timeout: int,
+        optimistic_retries: int = 0,
+        tap_sql: bool = False,
+    ):
+        self.path = path
+        self.optimistic_retries = optimistic_retries
+        self.tap_sql = tap_sql
+        self.pool_size = max(1, pool_size)
+        self.statement_cache_size = statement_cache_size
+        self.busy_timeout = busy_timeout
+        self._idle = None
+        self._connections = []
+        self._statements = {}
+
+    async def connect(self):
+        import aiosqlite
+
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(self.pool_size):
+            # isolation_level=None leaves transaction control to BEGIN
+            # IMMEDIATE below; cached_statements is sqlite3's prepared
+            # statement cache size.
+            conn = await aiosqlite.connect(
+                self.path,
+                isolation_level=None,
+                timeout=self.busy_timeout,
+                cached_statements=self.statement_cache_size,
+            )
+            self._connections.append(conn)
+            self._idle.put_nowait(_SqliteConnection(conn, self._statements))
+
+    async def close(self):
+        for conn in self._connections:
+            await conn.close()
+        self._connections = []
+        self._idle = None
+
+    @asynccontextmanager
+    async def connection(self):
+        if self._idle is None:
+            raise RuntimeError("SQLite pool is not initialized")
+        started = time.perf_counter()
+        conn = await self._idle.get()
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, self.driver)
+        DB_POOL_IN_USE.inc(self.driver)
+        try:
+            yield conn
+        finally:
+            DB_POOL_IN_USE.dec(self.driver)
+            self._idle.put_nowait(conn)
+
+    async def _update_count(self, conn, query: str, *args) -> int:
+        async with conn.conn.execute(conn._sql(query), args) as cursor:
+            return cursor.rowcount
+
+    async def _chunks(self, conn, query: str, size: int):
+        async with conn.conn.execute(conn._sql(query)) as cursor:
+            while True:
+                rows = await cursor.fetchmany(size)
+                if not rows:
+                    return
+                yield rows
+
+    @asynccontextmanager
+    async def transaction(self, conn):
+        await conn.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            await conn.conn.execute("ROLLBACK")
+            raise
+        await conn.conn.execute("COMMIT")
+
+
+def create_async_database(
+    database_url: str,
+    sqlite_path: str,
+    pool_min: int,
+    pool_max: int,
+    statement_cache_size: int,
+    connect_timeout: int,
+    optimistic_retries: int = 0,
+    tap_sql: bool = False,
+):
+    driver = "asyncpg" if database_url else "aiosqlite"
+    try:
+        __import__(driver)
+    except ImportError:
+        print(f"{driver} не установлен, используется синхронный драйвер БД")
+        return None
+
+    if database_url:
+        return AsyncPostgresDatabase(
+            database_url, pool_min, pool_max, statement_cache_size, connect_timeout, optimistic_retries, tap_sql
+        )
+    return AsyncSqliteDatabase(
+        sqlite_path, pool_max, statement_cache_size, connect_timeout, optimistic_retries, tap_sql
+    )
@@ -0,0 +1,58 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+# Bounded LRU of already verified initData headers. Entries are keyed by a
+# digest of the raw header and expire when the signature would stop being
+# accepted (auth_date + max age), so a hit never outlives a fresh check.
+# Expired entries are dropped when a lookup finds them; a full cache drops its
+# least recently used entry, so every operation stays O(1).
+class InitDataCache:
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max(1, max_size)
+        self._entries: OrderedDict[bytes, tuple[float, dict]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(init_data_raw: str) -> bytes:
+        return hashlib.sha256(init_data_raw.encode("utf-8")).digest()
+
+    def get(self, key: bytes):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, user = entry
+        if time.time() > expires_at:
+            del self._entries[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return user
+
+    def put(self, key: bytes, user: dict, expires_at: float):
+        self._entries[key] = (expires_at, user)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
@@ -1,290 +1,392 @@
 import asyncio
+import contextlib
+import functools
 import hashlib
 import hmac
 import json
+import math
 import os
-import random
-import sqlite3
+import signal
+import sys
 import time
 from urllib.parse import parse_qsl
 
-import psycopg2
-from psycopg2 import pool as pg_pool
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
 from aiohttp import web
 
-# Security and gameplay constants
-MAX_CLICKS_PER_SECOND = 20
-AUTOCLICK_BAN_MS = 2 * 60 * 1000
+from action_queue import ActionQueue, ActionQueueFull
+import aggregates
+from admin_ops import EXPORT_COLUMNS, RESET_VALUES, CsvGzipWriter
+from async_db import create_async_database
+from auth_cache import InitDataCache
+from game import (
+    AUTOCLICK_BAN_MS,
+    apply_identity,
+    apply_passive_progress,
+    now_ms,
+    requested_taps,
+    resolve_actions,
+    row_to_data,
+)
+from journal import ActionJournal, fold, read_entries
+from leaderboard import Leaderboard
+from metrics import (
+    AGGREGATES_DRIFT,
+    AGGREGATES_RECONCILE_SECONDS,
+    BAN_EVENTS,
+    DB_OPTIMISTIC_CONFLICTS,
+    DB_OPTIMISTIC_FALLBACKS,
+    DB_POOL_IN_USE,
+    DB_TRANSACTION_SECONDS,
+    HTTP_REQUEST_SECONDS,
+    LEADERBOARD_QUERY_SECONDS,
+    REGISTRY,
+    RUN_BLOCKING_SECONDS,
+    RUN_BLOCKING_WAIT_SECONDS,
+    TAP_BATCH_SIZE,
+)
+from state_store import PlayerStateStore, StateFlushOverdue
+from static_assets import StaticAssets
+from sharding import create_sharded_storage
+from tap_sql import TapBatch, is_tap_batch
+from storage import (
+    BROADCAST_RECIPIENTS,
+    CREATE_BROADCAST_JOB,
+    FETCH_USER,
+    FETCH_USER_FOR_UPDATE,
+    FETCH_USER_VERSIONED,
+    INSERT_USER,
+    LEADERBOARD as LEADERBOARD_QUERY,
+    RANKING_ROWS,
+    SAVE_BROADCAST_PROGRESS,
+    SET_USER_BLOCKED,
+    TOP_USERS,
+    UNFINISHED_BROADCAST_JOBS,
+    MemoryStorage,
+    create_backend,
+    leaderboard_entry,
+)
+from user_record import group_updates, update_params, update_query
+from webhook import TelegramWebhook, derive_secret
+from workers import WorkerRouter, run_master
+from ws_hub import WebSocketHub
+
 AUTH_MAX_AGE_SECONDS = 24 * 60 * 60
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 WEBAPP_URL = os.getenv("WEBAPP_URL", "").strip()
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()
+# DATABASE_SHARDS (comma-separated PostgreSQL DSNs or SQLite file paths)
+# splits users over several databases by a consistent hash of user_id; it
+# replaces DATABASE_URL/SQLITE_PATH and always uses the async drivers.
+DATABASE_SHARDS = [shard.strip() for shard in os.getenv("DATABASE_SHARDS", "").split(",") if shard.strip()]
+SQLITE_PATH = os.getenv("SQLITE_PATH", "users.db")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "1254600026"))
+# /give, /ban and /reset accept a list of user ids or a CSV document.
+ADMIN_BULK_MAX_USERS = int(os.getenv("ADMIN_BULK_MAX_USERS", "50000"))
+ADMIN_CSV_MAX_BYTES = int(os.getenv("ADMIN_CSV_MAX_BYTES", str(5 * 1024 * 1024)))
+# /users shows ADMIN_USERS_PAGE_SIZE players per page; /export streams the
+# users table ADMIN_EXPORT_CHUNK_SIZE rows at a time into a .csv.gz. Bots may
+# send files up to 50 MB (more through a local Bot API server).
+ADMIN_USERS_PAGE_SIZE = int(os.getenv("ADMIN_USERS_PAGE_SIZE", "20"))
+ADMIN_EXPORT_CHUNK_SIZE = int(os.getenv("ADMIN_EXPORT_CHUNK_SIZE", "5000"))
+ADMIN_EXPORT_MAX_BYTES = int(os.getenv("ADMIN_EXPORT_MAX_BYTES", str(50 * 1024 * 1024)))
+
+# Concurrent actions of one player wait in an in-process queue and are applied
+# together in one transaction; more than ACTION_QUEUE_MAX_DEPTH waiting actions
+# get 429. ACTION_QUEUE_MAX_DEPTH=0 sends every request to the database alone.
+ACTION_QUEUE_MAX_DEPTH = int(os.getenv("ACTION_QUEUE_MAX_DEPTH", "16"))
+ACTION_QUEUE_MAX_BATCH = int(os.getenv("ACTION_QUEUE_MAX_BATCH", "32"))
+
+# JOURNAL_DIR turns on the append-only journal of accepted actions and admin
+# changes (JSON-lines segments). It is written in batches off the request
+# path; every JOURNAL_COMPACT_INTERVAL_S the users table is brought up to date
+# and older segments are dropped. A tail left by a crash is replayed at start.
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "").strip()
+JOURNAL_FLUSH_MS = int(os.getenv("JOURNAL_FLUSH_MS", "200"))
+JOURNAL_SEGMENT_MAX_BYTES = int(os.getenv("JOURNAL_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))
+JOURNAL_KEEP_SEGMENTS = int(os.getenv("JOURNAL_KEEP_SEGMENTS", "24"))
+JOURNAL_COMPACT_INTERVAL_S = float(os.getenv("JOURNAL_COMPACT_INTERVAL_S", "60"))
+JOURNAL_FSYNC = os.getenv("JOURNAL_FSYNC", "1").strip() == "1"
+
+# /admin totals come from user_aggregates, kept up to date by triggers on
+# users. Every AGGREGATES_RECONCILE_INTERVAL_S (0 = never) one process
+# recounts users, reports drift and corrects it; /reconcile does it on demand.
+# The triggers leave coins alone on taps: every process adds up the coin
+# changes of its own actions and admin gifts and writes the sum to the total
+# every AGGREGATES_COINS_FLUSH_S (0 = never; the total then only moves on a
+# reconcile).
+AGGREGATES_RECONCILE_INTERVAL_S = float(os.getenv("AGGREGATES_RECONCILE_INTERVAL_S", "21600"))
+AGGREGATES_COINS_FLUSH_S = float(os.getenv("AGGREGATES_COINS_FLUSH_S", "1"))
+
+# SQLITE_TUNED=1 (SQLite with the default sync driver): WAL, persistent read
+# connections, and a single writer thread that commits whatever writes are
+# queued in one transaction instead of a connection and commit per request.
+SQLITE_TUNED = os.getenv("SQLITE_TUNED", "0").strip() == "1" and not DATABASE_URL
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper()
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "4"))
+SQLITE_WRITE_BATCH = int(os.getenv("SQLITE_WRITE_BATCH", "256"))
+SQLITE_WRITE_DELAY_MS = float(os.getenv("SQLITE_WRITE_DELAY_MS", "0"))
+
+# Write-behind player state: hot players live in memory and dirty rows are
+# flushed in bulk. STATE_MAX_UNFLUSHED_MS bounds what a crash can lose: while
+# flushes fail, a player whose changes are older than that gets 503 until one
+# succeeds.
+STATE_STORE_ENABLED = os.getenv("STATE_STORE", "0").strip() == "1"
+STATE_FLUSH_INTERVAL_MS = int(os.getenv("STATE_FLUSH_INTERVAL_MS", "1000"))
+STATE_MAX_UNFLUSHED_MS = int(os.getenv("STATE_MAX_UNFLUSHED_MS", "5000"))
+STATE_MAX_PLAYERS = int(os.getenv("STATE_MAX_PLAYERS", "50000"))
+
+# DB_DRIVER=async keeps database calls on the event loop (asyncpg/aiosqlite)
+# instead of hopping to a thread per call; "sync" is the psycopg2/sqlite3 path.
+# "memory" keeps everything in process memory and persists nothing: for tests
+# and for benchmarks of the game itself.
+DB_DRIVER = os.getenv("DB_DRIVER", "sync").strip().lower()
+# DB_CONCURRENCY=optimistic: a player action reads the row without a lock,
+# computes, and writes with UPDATE ... WHERE version = <the one read>; losing
+# to a concurrent write starts it over, up to DB_OPTIMISTIC_RETRIES times,
+# then it takes the row lock like "pessimistic" (the default) always does.
+# The SQLITE_TUNED writer is the only writer and keeps the locked path.
+DB_CONCURRENCY = os.getenv("DB_CONCURRENCY", "pessimistic").strip().lower()
+DB_OPTIMISTIC_RETRIES = int(os.getenv("DB_OPTIMISTIC_RETRIES", "5"))
+# DB_TAP_SQL=1: actions that are all taps are applied by the database, one
+# statement per batch (tap_sql.py: a function on PostgreSQL, an UPSERT on
+# SQLite), instead of a read-modify-write transaction. Other actions are
+# unaffected; so are STATE_STORE=1 and DB_DRIVER=memory, which do not touch
+# the database per action.
+DB_TAP_SQL = os.getenv("DB_TAP_SQL", "0").strip() == "1"
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "20"))
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+
+# In-memory ranking seeded once from the users table and then kept current
+# from every coin change; readers share a snapshot rebuilt at most every
+# LEADERBOARD_SNAPSHOT_MS.
+LEADERBOARD_CACHE_ENABLED = os.getenv("LEADERBOARD_CACHE", "1").strip() == "1"
+LEADERBOARD_SNAPSHOT_MS = int(os.getenv("LEADERBOARD_SNAPSHOT_MS", "500"))
+
+# Mini app files are hashed and pre-compressed in memory; index.html links
+# them by content-hashed /assets/ URLs that can be cached forever.
+STATIC_DIR = os.getenv("STATIC_DIR", ".")
+STATIC_SENDFILE_MIN_BYTES = int(os.getenv("STATIC_SENDFILE_MIN_BYTES", str(1024 * 1024)))
+STATIC_CHECK_INTERVAL_MS = int(os.getenv("STATIC_CHECK_INTERVAL_MS", "2000"))
+
+# GET /metrics serves Prometheus text; set METRICS_TOKEN to require
+# "Authorization: Bearer <token>".
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+
+# /ws carries the mini app's actions over one authenticated WebSocket.
+# WS_MAX_QUEUE bounds the frames buffered for a client that stops reading.
+WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", "10000"))
+WS_IDLE_TIMEOUT_S = float(os.getenv("WS_IDLE_TIMEOUT_S", "60"))
+WS_MAX_QUEUE = int(os.getenv("WS_MAX_QUEUE", "64"))
+WS_RANK_PUSH_MS = int(os.getenv("WS_RANK_PUSH_MS", "2000"))
+
+# WEB_WORKERS > 1 runs a supervisor with that many web workers sharing PORT
+# through SO_REUSEPORT (Linux). Every user is owned by one worker and requests
+# landing elsewhere are forwarded to 127.0.0.1:WORKER_BASE_PORT+index, so the
+# in-memory caches stay per-user consistent. Worker 0 runs the bot.
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "1"))
+WEB_WORKER_INDEX = int(os.getenv("WEB_WORKER_INDEX", "-1"))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "9100"))
+LEADERBOARD_RESYNC_MS = int(os.getenv("LEADERBOARD_RESYNC_MS", "1000"))
+BOT_POLLING = os.getenv("BOT_POLLING", "1").strip() == "1"
+
+# With WEBHOOK_BASE_URL set, Telegram POSTs updates to WEBHOOK_PATH on the web
+# server instead of the bot long-polling; without it the bot polls as before.
+# WEBHOOK_SECRET defaults to a value derived from BOT_TOKEN.
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or (derive_secret(BOT_TOKEN) if BOT_TOKEN else "")
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# Base URL of a self-hosted Bot API server (or a fake one for tests).
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()
+
+# /broadcast runs as a resumable background job paced by a token bucket;
+# Telegram allows about 30 messages per second per bot.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+BROADCAST_CHUNK_SIZE = int(os.getenv("BROADCAST_CHUNK_SIZE", "200"))
+BROADCAST_STATUS_INTERVAL_S = float(os.getenv("BROADCAST_STATUS_INTERVAL_S", "5"))
 
 bot = None
-dp = Dispatcher()
-PG_POOL = None
+dp = None
+# The psycopg2 or sqlite3 backend of the sync driver, chosen once here.
+BACKEND = create_backend(
+    DATABASE_URL,
+    SQLITE_PATH,
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    DB_CONNECT_TIMEOUT,
+    tuned=SQLITE_TUNED,
+    read_pool_size=SQLITE_READ_POOL_SIZE,
+    write_batch=SQLITE_WRITE_BATCH,
+    write_delay_ms=SQLITE_WRITE_DELAY_MS,
+    synchronous=SQLITE_SYNCHRONOUS,
+    mmap_size=SQLITE_MMAP_SIZE,
+)
+ADMIN_QUERIES = BACKEND.admin
+STATE_STORE = None
+JOURNAL = None
+LEADERBOARD = None
+# Players this worker owns whose ranking changed since the last push to peers.
+_RANKING_CHANGES = set()
+BROADCASTS = None
+# Loops started with _start_background; shutdown() cancels them.
+_BACKGROUND_TASKS = set()
+WORKERS = (
+    WorkerRouter(WEB_WORKER_INDEX, WEB_WORKERS, WORKER_BASE_PORT, os.getenv("WORKER_SECRET", ""))
+    if WEB_WORKERS > 1 and WEB_WORKER_INDEX >= 0
+    else None
+)
+AUTH_CACHE = InitDataCache(AUTH_CACHE_SIZE) if AUTH_CACHE_SIZE > 0 else None
+STATIC_ASSETS = StaticAssets(
+    STATIC_DIR,
+    {
+        "index.html": "text/html",
+        "style.css": "text/css",
+        "script.js": "application/javascript",
+        "image.jpg": "image/jpeg",
+    },
+    sendfile_min_bytes=STATIC_SENDFILE_MIN_BYTES,
+    check_interval_ms=STATIC_CHECK_INTERVAL_MS,
+)
 
 
 def get_db_connection():
-    if DATABASE_URL:
-        if PG_POOL is None:
-            raise RuntimeError("PostgreSQL pool is not initialized")
-        conn = PG_POOL.getconn()
-        conn.autocommit = True
-        return conn
-    return sqlite3.connect("users.db")
+    return BACKEND.getconn()
 
 
 def close_db_connection(conn):
-    if DATABASE_URL:
-        if PG_POOL is not None:
-            PG_POOL.putconn(conn)
-        return
-    conn.close()
+    BACKEND.putconn(conn)
 
 
-def _sqlite_column_exists(cursor, table_name: str, column_name: str) -> bool:
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    return any(row[1] == column_name for row in cursor.fetchall())
+def close_db_pools():
+    BACKEND.close()
 
 
 def init_db():
-    global PG_POOL
-    if DATABASE_URL and PG_POOL is None:
-        PG_POOL = pg_pool.ThreadedConnectionPool(
-            minconn=1,
-            maxconn=int(os.getenv("DB_POOL_MAX", "20")),
-            dsn=DATABASE_URL,
-            sslmode="require",
-            connect_timeout=int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
-        )
-
+    if DB_DRIVER == "memory":
+        return
+    if DATABASE_SHARDS:
+        for shard in DATABASE_SHARDS:
+            backend = create_backend(shard if "://" in shard else "", shard, 1, 1, DB_CONNECT_TIMEOUT)
+            backend.open()
+            conn = backend.getconn()
+            try:
+                applied = backend.migrate(conn)
+            finally:
+                backend.putconn(conn)
+                backend.close()
+            if applied:
+                print(f"Применены миграции схемы на {shard.split('@')[-1]}: {', '.join(map(str, applied))}")
+        return
+    BACKEND.open()
     conn = get_db_connection()
-    cursor = conn.cursor()
-
-    if DATABASE_URL:
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                coins REAL DEFAULT 0,
-                energy REAL DEFAULT 1000,
-                max_energy INTEGER DEFAULT 1000,
-                multi_tap_level INTEGER DEFAULT 1,
-                energy_level INTEGER DEFAULT 1,
-                auto_tap_level INTEGER DEFAULT 0,
-                skin_bought BOOLEAN DEFAULT FALSE,
-                last_update BIGINT DEFAULT 0,
-                username TEXT DEFAULT 'Аноним',
-                first_name TEXT DEFAULT 'Игрок',
-                ban_end_time BIGINT DEFAULT 0,
-                tap_window_start BIGINT DEFAULT 0,
-                tap_count INTEGER DEFAULT 0
-            )
-            """
-        )
-        cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS ban_end_time BIGINT DEFAULT 0")
-        cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS tap_window_start BIGINT DEFAULT 0")
-        cursor.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS tap_count INTEGER DEFAULT 0")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_coins_desc ON users (coins DESC)")
-    else:
-        cursor.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                user_id TEXT PRIMARY KEY,
-                coins REAL DEFAULT 0,
-                energy REAL DEFAULT 1000,
-                max_energy INTEGER DEFAULT 1000,
-                multi_tap_level INTEGER DEFAULT 1,
-                energy_level INTEGER DEFAULT 1,
-                auto_tap_level INTEGER DEFAULT 0,
-                skin_bought INTEGER DEFAULT 0,
-                last_update INTEGER DEFAULT 0,
-                username TEXT DEFAULT 'Аноним',
-                first_name TEXT DEFAULT 'Игрок',
-                ban_end_time INTEGER DEFAULT 0,
-                tap_window_start INTEGER DEFAULT 0,
-                tap_count INTEGER DEFAULT 0
-            )
-            """
-        )
-        if not _sqlite_column_exists(cursor, "users", "ban_end_time"):
-            cursor.execute("ALTER TABLE users ADD COLUMN ban_end_time INTEGER DEFAULT 0")
-        if not _sqlite_column_exists(cursor, "users", "tap_window_start"):
-            cursor.execute("ALTER TABLE users ADD COLUMN tap_window_start INTEGER DEFAULT 0")
-        if not _sqlite_column_exists(cursor, "users", "tap_count"):
-            cursor.execute("ALTER TABLE users ADD COLUMN tap_count INTEGER DEFAULT 0")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_coins_desc ON users (coins DESC)")
-
-    conn.commit()
-    close_db_connection(conn)
+    try:
+        applied = BACKEND.migrate(conn)
+    finally:
+        close_db_connection(conn)
+    if applied:
+        print(f"Применены миграции схемы: {', '.join(map(str, applied))}")
 
 
 def _fetch_user_row(cursor, user_id: str, for_update: bool = False):
-    if DATABASE_URL:
-        query = "SELECT * FROM users WHERE user_id = %s"
-        if for_update:
-            query += " FOR UPDATE"
-    else:
-        query = "SELECT * FROM users WHERE user_id = ?"
-    cursor.execute(query, (user_id,))
+    cursor.execute(BACKEND.sql(FETCH_USER_FOR_UPDATE if for_update else FETCH_USER), (user_id,))
     return cursor.fetchone()
 
 
 def _insert_user(cursor, user_id: str, username: str, first_name: str):
-    if DATABASE_URL:
-        cursor.execute(
-            """
-            INSERT INTO users (user_id, username, first_name, last_update)
-            VALUES (%s, %s, %s, %s)
-            ON CONFLICT (user_id) DO NOTHING
-            """,
-            (user_id, username, first_name, int(time.time() * 1000)),
-        )
-    else:
-        cursor.execute(
-            """
-            INSERT OR IGNORE INTO users (user_id, username, first_name, last_update)
-            VALUES (?, ?, ?, ?)
-            """,
-            (user_id, username, first_name, int(time.time() * 1000)),
-        )
+    cursor.execute(BACKEND.sql(INSERT_USER), (user_id, username, first_name, int(time.time() * 1000)))
 
 
-def _row_to_data(row):
-    return {
-        "coins": float(row[1]),
-        "energy": float(row[2]),
-        "max_energy": int(row[3]),
-        "multi_tap_level": int(row[4]),
-        "energy_level": int(row[5]),
-        "auto_tap_level": int(row[6]),
-        "skin_bought": bool(row[7]),
-        "last_update": int(row[8]),
-        "username": row[9] or "Аноним",
-        "first_name": row[10] or "Игрок",
-        "ban_end_time": int(row[11]) if len(row) > 11 else 0,
-        "tap_window_start": int(row[12]) if len(row) > 12 else 0,
-        "tap_count": int(row[13]) if len(row) > 13 else 0,
-    }
+def _save_user(cursor, user_id: str, data):
+    # Only the columns the action changed; usually coins, energy and the tap window.
+    changes = data.take_changes()
+    if changes:
+        cursor.execute(update_query(tuple(changes), BACKEND.paramstyle), update_params(user_id, changes))
 
 
-def _save_user(cursor, user_id: str, data: dict):
-    if DATABASE_URL:
-        cursor.execute(
-            """
-            UPDATE users SET
-                coins = %s,
-                energy = %s,
-                max_energy = %s,
-                multi_tap_level = %s,
-                energy_level = %s,
-                auto_tap_level = %s,
-                skin_bought = %s,
-                last_update = %s,
-                username = %s,
-                first_name = %s,
-                ban_end_time = %s,
-                tap_window_start = %s,
-                tap_count = %s
-            WHERE user_id = %s
-            """,
-            (
-                data["coins"],
-                data["energy"],
-                data["max_energy"],
-                data["multi_tap_level"],
-                data["energy_level"],
-                data["auto_tap_level"],
-                bool(data["skin_bought"]),
-                data["last_update"],
-                data["username"],
-                data["first_name"],
-                data["ban_end_time"],
-                data["tap_window_start"],
-                data["tap_count"],
-                user_id,
-            ),
-        )
-    else:
-        cursor.execute(
-            """
-            UPDATE users SET
-                coins = ?,
-                energy = ?,
-                max_energy = ?,
-                multi_tap_level = ?,
-                energy_level = ?,
-                auto_tap_level = ?,
-                skin_bought = ?,
-                last_update = ?,
-                username = ?,
-                first_name = ?,
-                ban_end_time = ?,
-                tap_window_start = ?,
-                tap_count = ?
-            WHERE user_id = ?
-            """,
-            (
-                data["coins"],
-                data["energy"],
-                data["max_energy"],
-                data["multi_tap_level"],
-                data["energy_level"],
-                data["auto_tap_level"],
-                int(bool(data["skin_bought"])),
-                data["last_update"],
-                data["username"],
-                data["first_name"],
-                data["ban_end_time"],
-                data["tap_window_start"],
-                data["tap_count"],
-                user_id,
-            ),
-        )
+def _save_users_bulk_tx(cursor, rows):
+    for columns, params in group_updates(rows).items():
+        BACKEND.executemany(cursor, update_query(columns), params)
 
 
-def _apply_passive_progress(data: dict, now_ms: int):
-    last_update = int(data.get("last_update", 0))
-    if last_update <= 0:
-        data["last_update"] = now_ms
+def _save_users_bulk(rows):
+    if not rows:
         return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(BACKEND.begin)
+        _save_users_bulk_tx(cursor, rows)
+        BACKEND.commit(conn)
+    except Exception:
+        BACKEND.rollback(conn)
+        raise
+    finally:
+        close_db_connection(conn)
+
 
-    elapsed_seconds = max(0.0, (now_ms - last_update) / 1000)
-    if elapsed_seconds > 0:
-        data["energy"] = min(data["max_energy"], data["energy"] + elapsed_seconds)
-    data["last_update"] = now_ms
+def _load_user_tx(cursor, user_id: str, username: str | None, first_name: str | None):
+    # INSERT only when the SELECT misses; an existing user costs one read.
+    row = _fetch_user_row(cursor, user_id)
+    if row is None:
+        _insert_user(cursor, user_id, username or "Аноним", first_name or "Игрок")
+        row = _fetch_user_row(cursor, user_id)
+        if row is None:
+            raise RuntimeError("User could not be created")
+    return row_to_data(row)
 
 
-def get_user_data(user_id: str, username: str | None = None, first_name: str | None = None):
+def _read_user(user_id: str):
     conn = get_db_connection()
     cursor = conn.cursor()
+    try:
+        row = _fetch_user_row(cursor, user_id)
+    finally:
+        close_db_connection(conn)
+    return row_to_data(row) if row is not None else None
 
-    _insert_user(cursor, user_id, username or "Аноним", first_name or "Игрок")
-    row = _fetch_user_row(cursor, user_id)
-    if row is None:
+
+def _load_user(user_id: str, username: str | None = None, first_name: str | None = None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        data = _load_user_tx(cursor, user_id, username, first_name)
         conn.commit()
+    finally:
         close_db_connection(conn)
-        raise RuntimeError("User could not be created")
+    return data
 
-    data = _row_to_data(row)
-    if username:
-        data["username"] = username
-    if first_name:
-        data["first_name"] = first_name
 
-    now_ms = int(time.time() * 1000)
-    _apply_passive_progress(data, now_ms)
+def _present_user(data, username: str | None, first_name: str | None):
+    apply_identity(data, username, first_name)
+    apply_passive_progress(data, now_ms())
+    return dict(data)
 
-    conn.commit()
-    close_db_connection(conn)
-    return data
+
+def get_user_data(user_id: str, username: str | None = None, first_name: str | None = None):
+    return _present_user(_load_user(user_id, username, first_name), username, first_name)
+
+
+def _user_actions_tx(cursor, user_id: str, actions, username: str | None, first_name: str | None):
+    row = _fetch_user_row(cursor, user_id, for_update=BACKEND.lock_rows)
+    if row is None:
+        _insert_user(cursor, user_id, username or "Аноним", first_name or "Игрок")
+        row = _fetch_user_row(cursor, user_id, for_update=BACKEND.lock_rows)
+        if row is None:
+            raise RuntimeError("User creation failed")
+
+    data = row_to_data(row)
+    apply_identity(data, username, first_name)
+    results = resolve_actions(data, actions)
+    _save_user(cursor, user_id, data)
+    return results
 
 
 def process_user_action(
@@ -294,183 +396,340 @@ def process_user_action(
     first_name: str | None = None,
     action_payload: dict | None = None,
 ):
+    return process_user_actions(user_id, [(action, action_payload)], username, first_name)[0]
+
+
+def process_user_actions(user_id: str, actions, username: str | None = None, first_name: str | None = None):
     conn = get_db_connection()
     cursor = conn.cursor()
+    started = time.perf_counter()
 
     try:
-        if DATABASE_URL:
-            cursor.execute("BEGIN")
-            row = _fetch_user_row(cursor, user_id, for_update=True)
-        else:
-            cursor.execute("BEGIN IMMEDIATE")
-            row = _fetch_user_row(cursor, user_id)
-
-        if row is None:
-            _insert_user(cursor, user_id, username or "Аноним", first_name or "Игрок")
-            row = _fetch_user_row(cursor, user_id, for_update=bool(DATABASE_URL))
-            if row is None:
-                raise RuntimeError("User creation failed")
-
-        data = _row_to_data(row)
-        if username:
-            data["username"] = username
-        if first_name:
-            data["first_name"] = first_name
+        cursor.execute(BACKEND.begin)
+        results = _user_actions_tx(cursor, user_id, actions, username, first_name)
+        BACKEND.commit(conn)
+        return results
+    except Exception:
+        BACKEND.rollback(conn)
+        raise
+    finally:
+        DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, BACKEND.driver)
+        close_db_connection(conn)
 
-        now_ms = int(time.time() * 1000)
-        _apply_passive_progress(data, now_ms)
 
-        event = {"status": "ok"}
-        payload = action_payload or {}
-        taps_requested = 1
+def process_user_actions_optimistic(
+    user_id: str, actions, username: str | None = None, first_name: str | None = None
+):
+    # No transaction and no lock while the game runs: each attempt is a plain
+    # SELECT and one conditional UPDATE that commits on its own.
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    started = time.perf_counter()
+    try:
+        for _ in range(DB_OPTIMISTIC_RETRIES):
+            cursor.execute(BACKEND.sql(FETCH_USER_VERSIONED), (user_id,))
+            row = cursor.fetchone()
+            if row is None:
+                _insert_user(cursor, user_id, username or "Аноним", first_name or "Игрок")
+                conn.commit()
+                cursor.execute(BACKEND.sql(FETCH_USER_VERSIONED), (user_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    raise RuntimeError("User creation failed")
+
+            data = row_to_data(row[1:])
+            apply_identity(data, username, first_name)
+            results = resolve_actions(data, actions)
+            changes = data.take_changes()
+            if not changes:
+                return results
+            cursor.execute(
+                update_query(tuple(changes), BACKEND.paramstyle, versioned=True),
+                update_params(user_id, changes) + (row[0],),
+            )
+            conn.commit()
+            if cursor.rowcount == 1:
+                return results
+            DB_OPTIMISTIC_CONFLICTS.inc(BACKEND.driver)
+    finally:
+        DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, BACKEND.driver)
+        close_db_connection(conn)
+    DB_OPTIMISTIC_FALLBACKS.inc(BACKEND.driver)
+    return process_user_actions(user_id, actions, username, first_name)
 
-        if action == "tap_batch":
-            raw_count = payload.get("count", 1)
-            try:
-                taps_requested = int(raw_count)
-            except (TypeError, ValueError):
-                taps_requested = 1
-            taps_requested = max(1, min(taps_requested, 50))
-            action = "tap"
-
-        if action == "tap":
-            coins_earned_total = 0
-            combo_hits = 0
-            taps_processed = 0
-
-            for _ in range(taps_requested):
-                tap_now = int(time.time() * 1000)
-
-                if data["ban_end_time"] > tap_now:
-                    event = {
-                        "status": "banned",
-                        "ban_end_time": data["ban_end_time"],
-                    }
-                    break
-
-                if tap_now - data["tap_window_start"] >= 1000:
-                    data["tap_window_start"] = tap_now
-                    data["tap_count"] = 1
-                else:
-                    data["tap_count"] += 1
-
-                if data["tap_count"] > MAX_CLICKS_PER_SECOND:
-                    data["ban_end_time"] = tap_now + AUTOCLICK_BAN_MS
-                    data["tap_count"] = 0
-                    event = {
-                        "status": "banned",
-                        "ban_end_time": data["ban_end_time"],
-                    }
-                    break
-
-                if data["energy"] < 1:
-                    break
-
-                data["energy"] -= 1
-                is_combo = random.random() < 0.05
-                multiplier = 4 if is_combo else 1
-                coins_earned = data["multi_tap_level"] * multiplier
-                data["coins"] += coins_earned
-                coins_earned_total += coins_earned
-                combo_hits += int(is_combo)
-                taps_processed += 1
-
-            if event.get("status") != "banned":
-                if taps_processed == 0:
-                    event = {"status": "no_energy"}
-                else:
-                    event = {
-                        "status": "ok",
-                        "coins_earned": coins_earned_total,
-                        "combo_hits": combo_hits,
-                        "taps_processed": taps_processed,
-                        "taps_requested": taps_requested,
-                    }
-
-        elif action == "buy_multitap":
-            price = int(100 * (1.2 ** (data["multi_tap_level"] - 1)))
-            if data["coins"] < price:
-                event = {"status": "not_enough_coins", "required": price}
-            else:
-                data["coins"] -= price
-                data["multi_tap_level"] += 1
 
-        elif action == "buy_energy":
-            price = int(200 * (1.2 ** (data["energy_level"] - 1)))
-            if data["coins"] < price:
-                event = {"status": "not_enough_coins", "required": price}
-            else:
-                data["coins"] -= price
-                data["energy_level"] += 1
-                data["max_energy"] += 500
-                data["energy"] = data["max_energy"]
-
-        elif action == "buy_autotap":
-            event = {"status": "feature_disabled"}
-
-        elif action == "buy_skin":
-            if data["skin_bought"]:
-                event = {"status": "already_bought"}
-            elif data["coins"] < 1000:
-                event = {"status": "not_enough_coins", "required": 1000}
-            else:
-                data["coins"] -= 1000
-                data["skin_bought"] = True
+def _tap_batches_tx(cursor, user_id: str, actions, username: str | None, first_name: str | None):
+    results = []
+    for action, payload in actions:
+        batch = TapBatch(user_id, action, payload, username, first_name)
+        cursor.execute(BACKEND.sql(BACKEND.tap_batch), batch.params)
+        results.append(batch.result(cursor.fetchone()))
+    return results
 
-        else:
-            event = {"status": "invalid_action"}
 
-        data["last_update"] = now_ms
-        _save_user(cursor, user_id, data)
+def process_tap_batches(user_id: str, actions, username: str | None = None, first_name: str | None = None):
+    # On PostgreSQL each batch is a single autocommitted call of
+    # apply_tap_batch, which locks the row itself; SQLite takes its write
+    # lock for the transaction up front (see lock_rows).
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    started = time.perf_counter()
+    try:
+        if not BACKEND.lock_rows:
+            cursor.execute(BACKEND.begin)
+        results = _tap_batches_tx(cursor, user_id, actions, username, first_name)
         conn.commit()
-        return {"event": event, "data": data}
+        return results
     except Exception:
         conn.rollback()
         raise
     finally:
+        DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, BACKEND.driver)
         close_db_connection(conn)
 
 
 def get_leaderboard():
     conn = get_db_connection()
     cursor = conn.cursor()
+    cursor.execute(LEADERBOARD_QUERY)
+    rows = cursor.fetchall()
+    close_db_connection(conn)
+    return [leaderboard_entry(row) for row in rows]
+
+
+def get_aggregates():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(aggregates.READ)
+    rows = cursor.fetchall()
+    close_db_connection(conn)
+    return aggregates.summary(rows)
+
+
+def get_aggregate_drift():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(aggregates.DRIFT)
+    rows = cursor.fetchall()
+    close_db_connection(conn)
+    return aggregates.drift(rows)
+
+
+def _correct_aggregates_tx(cursor, corrections):
+    cursor.executemany(ADMIN_QUERIES.correct_aggregate, corrections)
+
+
+def correct_aggregates(corrections):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    _correct_aggregates_tx(cursor, corrections)
+    conn.commit()
+    close_db_connection(conn)
+
+
+def get_top_users(limit: int = 50):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(BACKEND.sql(TOP_USERS), (limit,))
+    result = cursor.fetchall()
+    close_db_connection(conn)
+    return result
+
+
+def get_users_page(cursor_key, direction: str, limit: int):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(*ADMIN_QUERIES.users_page(cursor_key, direction, limit))
+    rows = cursor.fetchall()
+    close_db_connection(conn)
+    return rows
+
+
+def export_users(path: str, chunk_size: int) -> int:
+    conn = get_db_connection()
+    writer = CsvGzipWriter(path, EXPORT_COLUMNS)
+    try:
+        cursor = BACKEND.export_cursor(conn, chunk_size)
+        cursor.execute(ADMIN_QUERIES.export_users)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            writer.write_rows(rows)
+        cursor.close()
+    finally:
+        writer.close()
+        conn.rollback()
+        close_db_connection(conn)
+    return writer.rows
+
+
+def _give_coins_tx(cursor, user_ids, coins: float):
+    cursor.execute(ADMIN_QUERIES.give_coins, (coins, ADMIN_QUERIES.user_ids(user_ids)))
+    return cursor.fetchall()
+
+
+def give_coins(user_ids, coins: float):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    rows = _give_coins_tx(cursor, user_ids, coins)
+    conn.commit()
+    close_db_connection(conn)
+    return rows
+
+
+def _reset_users_tx(cursor, user_ids):
+    cursor.execute(ADMIN_QUERIES.reset_coins_total, (ADMIN_QUERIES.user_ids(user_ids),))
+    cursor.execute(ADMIN_QUERIES.reset_users, (False, int(time.time() * 1000), ADMIN_QUERIES.user_ids(user_ids)))
+    return cursor.fetchall()
+
+
+def reset_users(user_ids):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(BACKEND.begin)
+        rows = _reset_users_tx(cursor, user_ids)
+        BACKEND.commit(conn)
+        return rows
+    except Exception:
+        BACKEND.rollback(conn)
+        raise
+    finally:
+        close_db_connection(conn)
+
+
+def _ban_users_tx(cursor, user_ids, ban_end: int):
+    cursor.execute(ADMIN_QUERIES.ban_users, (ban_end, ADMIN_QUERIES.user_ids(user_ids)))
+    return cursor.fetchall()
+
+
+def ban_users(user_ids, ban_end: int):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    rows = _ban_users_tx(cursor, user_ids, ban_end)
+    conn.commit()
+    close_db_connection(conn)
+    return rows
+
+
+def get_user_row(user_id: str):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    user = _fetch_user_row(cursor, user_id)
+    close_db_connection(conn)
+    return user
+
+
+def _create_broadcast_job_tx(cursor, text: str, chat_id: int, status_message_id: int, created_at: int) -> int:
+    cursor.execute(BACKEND.sql(CREATE_BROADCAST_JOB), (text, chat_id, status_message_id, created_at, created_at))
+    return cursor.fetchone()[0]
+
+
+def create_broadcast_job(text: str, chat_id: int, status_message_id: int, created_at: int) -> int:
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    job_id = _create_broadcast_job_tx(cursor, text, chat_id, status_message_id, created_at)
+    conn.commit()
+    close_db_connection(conn)
+    return job_id
+
+
+def get_unfinished_broadcast_jobs():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(UNFINISHED_BROADCAST_JOBS)
+    rows = cursor.fetchall()
+    close_db_connection(conn)
+    return rows
+
+
+def get_broadcast_recipients(after_user_id: str, limit: int):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(BACKEND.sql(BROADCAST_RECIPIENTS), (after_user_id, False, limit))
+    rows = cursor.fetchall()
+    close_db_connection(conn)
+    return [row[0] for row in rows]
+
+
+def _save_broadcast_progress_tx(
+    cursor, job_id: int, status: str, last_user_id: str, sent: int, failed: int, blocked: int
+):
     cursor.execute(
-        """
-        SELECT user_id, username, first_name, coins, multi_tap_level
-        FROM users
-        ORDER BY coins DESC
-        LIMIT 100
-        """
+        BACKEND.sql(SAVE_BROADCAST_PROGRESS),
+        (status, last_user_id, sent, failed, blocked, int(time.time() * 1000), job_id),
     )
+
+
+def save_broadcast_progress(job_id: int, status: str, last_user_id: str, sent: int, failed: int, blocked: int):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    _save_broadcast_progress_tx(cursor, job_id, status, last_user_id, sent, failed, blocked)
+    conn.commit()
+    close_db_connection(conn)
+
+
+def _set_users_blocked_tx(cursor, user_ids, blocked: bool):
+    cursor.executemany(BACKEND.sql(SET_USER_BLOCKED), [(blocked, user_id, blocked) for user_id in user_ids])
+
+
+def set_users_blocked(user_ids, blocked: bool):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    _set_users_blocked_tx(cursor, user_ids, blocked)
+    conn.commit()
+    close_db_connection(conn)
+
+
+def get_ranking_rows():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute(RANKING_ROWS)
     rows = cursor.fetchall()
     close_db_connection(conn)
-    return [
-        {
-            "user_id": row[0],
-            "username": row[1],
-            "first_name": row[2],
-            "coins": float(row[3]),
-            "multi_tap_level": int(row[4]),
-        }
-        for row in rows
-    ]
+    return rows
 
 
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_ID
 
 
+@functools.lru_cache(maxsize=4)
+def _webapp_secret_key(bot_token: str) -> bytes:
+    return hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
+
+
 def verify_telegram_init_data(init_data_raw: str):
     if not init_data_raw:
         return None
+    if AUTH_CACHE is None:
+        verified = _verify_init_data_signature(init_data_raw)
+        return verified[0] if verified else None
+
+    # The client resends the same header for hours, so a verified header is
+    # remembered until its auth_date ages out.
+    key = AUTH_CACHE.key(init_data_raw)
+    user = AUTH_CACHE.get(key)
+    if user is not None:
+        return user
+
+    verified = _verify_init_data_signature(init_data_raw)
+    if verified is None:
+        return None
+    user, auth_date = verified
+    AUTH_CACHE.put(key, user, auth_date + AUTH_MAX_AGE_SECONDS)
+    return user
+
 
+def _verify_init_data_signature(init_data_raw: str):
     pairs = dict(parse_qsl(init_data_raw, keep_blank_values=True))
     data_hash = pairs.pop("hash", None)
     if not data_hash:
         return None
 
     data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(pairs.items()))
-    secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode("utf-8"), hashlib.sha256).digest()
+    secret_key = _webapp_secret_key(BOT_TOKEN)
     calculated_hash = hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
 
     if not hmac.compare_digest(calculated_hash, data_hash):
@@ -494,7 +753,7 @@ def verify_telegram_init_data(init_data_raw: str):
     if "id" not in user:
         return None
 
-    return user
+    return user, auth_date
 
 
 def get_verified_webapp_user(request: web.Request):
@@ -503,371 +762,491 @@ def get_verified_webapp_user(request: web.Request):
 
 
 async def run_blocking(func, *args):
-    return await asyncio.to_thread(func, *args)
+    name = getattr(func, "__name__", "call")
+    submitted = time.perf_counter()
 
-
-def _build_start_keyboard():
-    if WEBAPP_URL.startswith("https://"):
-        return InlineKeyboardMarkup(
-            inline_keyboard=[[InlineKeyboardButton(text="🐹 Открыть Анара", web_app=WebAppInfo(url=WEBAPP_URL))]]
+    def _run():
+        started = time.perf_counter()
+        RUN_BLOCKING_WAIT_SECONDS.observe(started - submitted, name)
+        try:
+            return func(*args)
+        finally:
+            RUN_BLOCKING_SECONDS.observe(time.perf_counter() - started, name)
+
+    return await asyncio.to_thread(_run)
+
+
+class ThreadedDatabase:
+    # storage.Storage over the blocking functions above, one executor hop per
+    # call. With SQLITE_TUNED writes skip the executor and queue to the writer
+    # thread.
+    async def connect(self):
+        pass
+
+    async def close(self):
+        await asyncio.to_thread(close_db_pools)
+
+    @staticmethod
+    async def _write(tx, blocking, *args):
+        if BACKEND.writer is not None:
+            return await BACKEND.writer.run(tx, *args)
+        return await run_blocking(blocking, *args)
+
+    async def load_user(self, user_id: str, username: str | None = None, first_name: str | None = None):
+        # A plain SELECT on a read connection; only a new user goes through
+        # the write path (and the SQLite writer queue) to be created.
+        data = await run_blocking(_read_user, user_id)
+        if data is not None:
+            return data
+        return await self._write(_load_user_tx, _load_user, user_id, username, first_name)
+
+    async def save_users(self, rows):
+        if rows:
+            await self._write(_save_users_bulk_tx, _save_users_bulk, rows)
+
+    async def get_user_data(self, user_id: str, username: str | None = None, first_name: str | None = None):
+        return _present_user(await self.load_user(user_id, username, first_name), username, first_name)
+
+    async def process_user_action(
+        self,
+        user_id: str,
+        action: str,
+        username: str | None = None,
+        first_name: str | None = None,
+        action_payload: dict | None = None,
+    ):
+        results = await self.process_user_actions(user_id, [(action, action_payload)], username, first_name)
+        return results[0]
+
+    async def process_user_actions(
+        self, user_id: str, actions, username: str | None = None, first_name: str | None = None
+    ):
+        if DB_TAP_SQL and is_tap_batch(actions):
+            return await self._write(_tap_batches_tx, process_tap_batches, user_id, actions, username, first_name)
+        if DB_CONCURRENCY == "optimistic" and BACKEND.writer is None:
+            return await run_blocking(process_user_actions_optimistic, user_id, actions, username, first_name)
+        return await self._write(_user_actions_tx, process_user_actions, user_id, actions, username, first_name)
+
+    async def get_leaderboard(self):
+        return await run_blocking(get_leaderboard)
+
+    async def get_aggregates(self):
+        return await run_blocking(get_aggregates)
+
+    async def get_aggregate_drift(self):
+        return await run_blocking(get_aggregate_drift)
+
+    async def correct_aggregates(self, corrections):
+        await self._write(_correct_aggregates_tx, correct_aggregates, corrections)
+
+    async def add_to_coins_total(self, changes):
+        await self.correct_aggregates([("coins", math.fsum(coins for _, coins in changes))])
+
+    async def get_top_users(self, limit: int = 50):
+        return await run_blocking(get_top_users, limit)
+
+    async def get_ranking_rows(self):
+        return await run_blocking(get_ranking_rows)
+
+    async def get_users_page(self, cursor_key, direction: str, limit: int):
+        return await run_blocking(get_users_page, cursor_key, direction, limit)
+
+    async def export_users(self, path: str, chunk_size: int) -> int:
+        return await run_blocking(export_users, path, chunk_size)
+
+    async def give_coins(self, user_ids, coins: float):
+        return await self._write(_give_coins_tx, give_coins, user_ids, coins)
+
+    async def reset_users(self, user_ids):
+        return await self._write(_reset_users_tx, reset_users, user_ids)
+
+    async def ban_users(self, user_ids, ban_end: int):
+        return await self._write(_ban_users_tx, ban_users, user_ids, ban_end)
+
+    async def get_user_row(self, user_id: str):
+        return await run_blocking(get_user_row, user_id)
+
+    async def create_broadcast_job(self, text: str, chat_id: int, status_message_id: int, created_at: int):
+        return await self._write(
+            _create_broadcast_job_tx, create_broadcast_job, text, chat_id, status_message_id, created_at
         )
-    return None
 
+    async def get_unfinished_broadcast_jobs(self):
+        return await run_blocking(get_unfinished_broadcast_jobs)
 
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message):
-    keyboard = _build_start_keyboard()
+    async def get_broadcast_recipients(self, after_user_id: str, limit: int):
+        return await run_blocking(get_broadcast_recipients, after_user_id, limit)
 
-    admin_text = ""
-    if is_admin(message.from_user.id):
-        admin_text = "\n\n👑 Админ-команды:\n/admin - панель управления"
+    async def save_broadcast_progress(
+        self, job_id: int, status: str, last_user_id: str, sent: int, failed: int, blocked: int
+    ):
+        await self._write(
+            _save_broadcast_progress_tx, save_broadcast_progress, job_id, status, last_user_id, sent, failed, blocked
+        )
 
-    text = "Добро пожаловать в Анар тап!\n\nТапай и прокачивайся!"
-    if keyboard is None:
-        text += "\n\n⚠️ WEBAPP_URL не настроен (нужен https://...)"
+    async def set_users_blocked(self, user_ids, blocked: bool):
+        await self._write(_set_users_blocked_tx, set_users_blocked, user_ids, blocked)
 
-    await message.answer(f"{text}{admin_text}", reply_markup=keyboard)
 
+DB = MemoryStorage() if DB_DRIVER == "memory" else ThreadedDatabase()
 
-@dp.message(Command("admin"))
-async def cmd_admin(message: types.Message):
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде")
-        return
 
-    def _admin_stats():
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        cursor.execute("SELECT SUM(coins) FROM users")
-        total_coins = cursor.fetchone()[0] or 0
-        cursor.execute("SELECT first_name, coins FROM users ORDER BY coins DESC LIMIT 1")
-        top_user = cursor.fetchone()
-        close_db_connection(conn)
-        return total_users, total_coins, top_user
-
-    total_users, total_coins, top_user = await run_blocking(_admin_stats)
-
-    admin_text = (
-        "👑 АДМИН-ПАНЕЛЬ\n\n"
-        f"📊 Статистика:\n"
-        f"• Всего игроков: {total_users}\n"
-        f"• Всего монет: {int(float(total_coins))}\n"
-        f"• Топ игрок: {top_user[0] if top_user else 'Нет'} ({int(float(top_user[1])) if top_user else 0} монет)\n\n"
-        "📝 Команды:\n"
-        "/users - список всех пользователей\n"
-        "/give [user_id] [монеты] - выдать монеты\n"
-        "/reset [user_id] - сбросить прогресс\n"
-        "/ban [user_id] [минуты] - забанить пользователя\n"
-        "/stats [user_id] - статистика игрока\n"
-        "/broadcast [текст] - рассылка всем"
-    )
-    await message.answer(admin_text)
+async def _load_user_state(user_id: str, username: str | None, first_name: str | None):
+    return await DB.load_user(user_id, username, first_name)
 
 
-@dp.message(Command("users"))
-async def cmd_users(message: types.Message):
-    if not is_admin(message.from_user.id):
+async def _save_user_states(rows):
+    # PlayerStateStore passes every dirty player at once, and their actions
+    # were journaled as they were applied. The journal reaches the disk before
+    # the table does, so a crash never leaves the table ahead of it; once the
+    # table holds the batch, nothing up to it has to be replayed.
+    if JOURNAL is None:
+        await DB.save_users(rows)
         return
+    seq = JOURNAL.seq
+    await JOURNAL.flush()
+    await DB.save_users(rows)
+    await JOURNAL.checkpoint(seq)
 
-    def _get_users():
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            """
-            SELECT user_id, first_name, coins, multi_tap_level
-            FROM users
-            ORDER BY coins DESC
-            LIMIT 50
-            """
-        )
-        result = cursor.fetchall()
-        close_db_connection(conn)
-        return result
-
-    users = await run_blocking(_get_users)
-
-    if not users:
-        await message.answer("Пользователей пока нет")
-        return
 
-    text = "👥 Топ-50 пользователей:\n\n"
-    for i, (user_id, name, coins, level) in enumerate(users, 1):
-        text += f"{i}. {name} (ID: {user_id})\n   💰 {int(float(coins))} монет | 👆 Ур.{level}\n\n"
-    await message.answer(text)
+def _track_leaderboard(user_id: str, data: dict):
+    if LEADERBOARD is not None:
+        LEADERBOARD.update(user_id, data)
+        if WORKERS is not None and WORKERS.owns(user_id):
+            _RANKING_CHANGES.add(user_id)
+    return data
 
 
-@dp.message(Command("give"))
-async def cmd_give(message: types.Message):
-    if not is_admin(message.from_user.id):
+def _track_admin_update(op: str, rows):
+    if LEADERBOARD is None:
         return
+    for row in rows:
+        user_id = str(row[0])
+        if LEADERBOARD.player(user_id) is None:
+            continue
+        if op == "give_coins":
+            _track_leaderboard(user_id, {"coins": float(row[2])})
+        elif op == "reset_users":
+            _track_leaderboard(user_id, {"coins": 0, "multi_tap_level": 1})
+
+
+async def get_top_users_cached(limit: int):
+    if LEADERBOARD is None:
+        return await DB.get_top_users(limit)
+    return [
+        (player["user_id"], player["first_name"], player["coins"], player["multi_tap_level"])
+        for player in LEADERBOARD.top(limit)
+    ]
 
-    try:
-        args = message.text.split()
-        if len(args) < 3:
-            await message.answer("Использование: /give [user_id] [монеты]")
-            return
 
-        user_id = args[1]
-        coins = float(args[2])
-        if coins <= 0:
-            await message.answer("❌ Количество монет должно быть больше 0")
-            return
+def _is_coins(metric: str) -> bool:
+    # "coins", or "1/coins" from a sharded database.
+    return metric.rpartition("/")[2] == "coins"
 
-        def _give():
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            query = "SELECT coins, first_name FROM users WHERE user_id = %s" if DATABASE_URL else "SELECT coins, first_name FROM users WHERE user_id = ?"
-            cursor.execute(query, (user_id,))
-            user = cursor.fetchone()
-            if not user:
-                close_db_connection(conn)
-                return None
-            new_coins = float(user[0]) + coins
-            update_q = "UPDATE users SET coins = %s WHERE user_id = %s" if DATABASE_URL else "UPDATE users SET coins = ? WHERE user_id = ?"
-            cursor.execute(update_q, (new_coins, user_id))
-            conn.commit()
-            close_db_connection(conn)
-            return user, new_coins
 
-        result = await run_blocking(_give)
-        if result is None:
-            await message.answer(f"❌ Пользователь {user_id} не найден")
-            return
+async def reconcile_aggregates(fix: bool = True):
+    # (metric, actual, stored) of every aggregate that drifted; with fix the
+    # stored values are moved by the difference. Coin changes still held here
+    # or in the state store are written first, or the correction would count
+    # them a second time. The coins total is a running sum of floats and may
+    # drift a little (and by other workers' unflushed changes), so it is not
+    # counted in AGGREGATES_DRIFT.
+    if STATE_STORE is not None:
+        await STATE_STORE.flush()
+    await flush_coins_total()
+    with AGGREGATES_RECONCILE_SECONDS.time():
+        drifted = await DB.get_aggregate_drift()
+    AGGREGATES_DRIFT.set(sum(1 for metric, _, _ in drifted if not _is_coins(metric)))
+    if fix and drifted:
+        await DB.correct_aggregates([(metric, actual - stored) for metric, actual, stored in drifted])
+    return drifted
 
-        user, new_coins = result
-        await message.answer(
-            f"✅ Выдано {int(coins)} монет пользователю {user[1]}\n"
-            f"Было: {int(float(user[0]))} -> Стало: {int(new_coins)}"
-        )
 
+async def _reconcile_aggregates_loop():
+    while True:
+        await asyncio.sleep(AGGREGATES_RECONCILE_INTERVAL_S)
         try:
-            await bot.send_message(int(user_id), f"🎁 Вам начислено {int(coins)} монет от администратора!")
-        except Exception:
-            pass
-    except ValueError:
-        await message.answer("❌ Неверный формат монет")
-    except Exception as e:
-        await message.answer(f"❌ Ошибка: {str(e)}")
+            drifted = await reconcile_aggregates()
+            for metric, actual, stored in drifted:
+                if not _is_coins(metric):
+                    print(f"Расхождение агрегата {metric}: в таблице {actual}, в счётчике {stored}; исправлено")
+        except Exception as e:
+            print(f"Ошибка сверки агрегатов: {e}")
 
 
-@dp.message(Command("reset"))
-async def cmd_reset(message: types.Message):
-    if not is_admin(message.from_user.id):
+# user_id -> coins gained or lost since the last flush_coins_total().
+_COINS_PENDING: dict[str, float] = {}
+
+
+def _count_coins(changes):
+    if AGGREGATES_COINS_FLUSH_S <= 0:
         return
+    for user_id, coins in changes:
+        if coins:
+            _COINS_PENDING[user_id] = _COINS_PENDING.get(user_id, 0.0) + coins
 
-    try:
-        args = message.text.split()
-        if len(args) < 2:
-            await message.answer("Использование: /reset [user_id]")
-            return
 
-        user_id = args[1]
-
-        def _reset():
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            query = "SELECT first_name FROM users WHERE user_id = %s" if DATABASE_URL else "SELECT first_name FROM users WHERE user_id = ?"
-            cursor.execute(query, (user_id,))
-            user = cursor.fetchone()
-            if not user:
-                close_db_connection(conn)
-                return None
-
-            if DATABASE_URL:
-                cursor.execute(
-                    """
-                    UPDATE users SET
-                        coins = 0,
-                        energy = 1000,
-                        max_energy = 1000,
-                        multi_tap_level = 1,
-                        energy_level = 1,
-                        auto_tap_level = 0,
-                        skin_bought = FALSE,
-                        ban_end_time = 0,
-                        tap_window_start = 0,
-                        tap_count = 0,
-                        last_update = %s
-                    WHERE user_id = %s
-                    """,
-                    (int(time.time() * 1000), user_id),
-                )
-            else:
-                cursor.execute(
-                    """
-                    UPDATE users SET
-                        coins = 0,
-                        energy = 1000,
-                        max_energy = 1000,
-                        multi_tap_level = 1,
-                        energy_level = 1,
-                        auto_tap_level = 0,
-                        skin_bought = 0,
-                        ban_end_time = 0,
-                        tap_window_start = 0,
-                        tap_count = 0,
-                        last_update = ?
-                    WHERE user_id = ?
-                    """,
-                    (int(time.time() * 1000), user_id),
-                )
-            conn.commit()
-            close_db_connection(conn)
-            return user
+async def flush_coins_total():
+    # Adds the pending changes to user_aggregates as increments; on failure
+    # they are put back for the next flush.
+    global _COINS_PENDING
+    if not _COINS_PENDING:
+        return
+    pending, _COINS_PENDING = _COINS_PENDING, {}
+    try:
+        await DB.add_to_coins_total(list(pending.items()))
+    except BaseException:
+        _count_coins(pending.items())
+        raise
 
-        user = await run_blocking(_reset)
-        if not user:
-            await message.answer(f"❌ Пользователь {user_id} не найден")
-            return
 
-        await message.answer(f"✅ Прогресс пользователя {user[0]} сброшен")
+async def _flush_coins_total_loop():
+    while True:
+        await asyncio.sleep(AGGREGATES_COINS_FLUSH_S)
         try:
-            await bot.send_message(int(user_id), "⚠️ Ваш прогресс был сброшен администратором")
-        except Exception:
-            pass
-    except Exception as e:
-        await message.answer(f"❌ Ошибка: {str(e)}")
+            await flush_coins_total()
+        except Exception as e:
+            print(f"Ошибка записи суммы монет: {e}")
 
 
-@dp.message(Command("ban"))
-async def cmd_ban(message: types.Message):
-    if not is_admin(message.from_user.id):
-        return
+async def export_users_csv(path: str) -> int:
+    # Unflushed player state would be missing from the file.
+    if STATE_STORE is not None:
+        await STATE_STORE.flush()
+    return await DB.export_users(path, ADMIN_EXPORT_CHUNK_SIZE)
 
-    try:
-        args = message.text.split()
-        if len(args) < 2:
-            await message.answer("Использование: /ban [user_id] [минуты]")
-            return
 
-        user_id = args[1]
-        minutes = int(args[2]) if len(args) >= 3 else 60
-        if minutes <= 0:
-            await message.answer("❌ Минуты должны быть больше 0")
-            return
+async def fetch_user_data(user_id: str, username: str | None = None, first_name: str | None = None):
+    if WORKERS is not None and not WORKERS.owns(user_id):
+        data = await WORKERS.call(
+            WORKERS.owner(user_id), "user", {"user_id": user_id, "username": username, "first_name": first_name}
+        )
+        return _track_leaderboard(user_id, data)
+    return await _fetch_user_data_local(user_id, username, first_name)
 
-        ban_end = int(time.time() * 1000) + minutes * 60 * 1000
 
-        def _ban():
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            query = "SELECT first_name FROM users WHERE user_id = %s" if DATABASE_URL else "SELECT first_name FROM users WHERE user_id = ?"
-            cursor.execute(query, (user_id,))
-            user = cursor.fetchone()
-            if not user:
-                close_db_connection(conn)
-                return None
+async def _fetch_user_data_local(user_id: str, username: str | None, first_name: str | None):
+    if STATE_STORE is None:
+        return _track_leaderboard(user_id, await DB.get_user_data(user_id, username, first_name))
 
-            update_q = "UPDATE users SET ban_end_time = %s WHERE user_id = %s" if DATABASE_URL else "UPDATE users SET ban_end_time = ? WHERE user_id = ?"
-            cursor.execute(update_q, (ban_end, user_id))
-            conn.commit()
-            close_db_connection(conn)
-            return user
+    def _read(data):
+        result = dict(data)
+        apply_identity(result, username, first_name)
+        apply_passive_progress(result, now_ms())
+        return result
 
-        user = await run_blocking(_ban)
-        if not user:
-            await message.answer(f"❌ Пользователь {user_id} не найден")
-            return
+    return _track_leaderboard(user_id, await STATE_STORE.read(user_id, username, first_name, _read))
 
-        await message.answer(f"✅ Пользователь {user[0]} забанен на {minutes} мин.")
 
-        try:
-            await bot.send_message(int(user_id), f"⛔ Вы заблокированы администратором на {minutes} мин.")
-        except Exception:
-            pass
-    except ValueError:
-        await message.answer("❌ Неверный формат минут")
-    except Exception as e:
-        await message.answer(f"❌ Ошибка: {str(e)}")
+async def _run_user_actions(user_id: str, actions, username: str | None, first_name: str | None):
+    if STATE_STORE is None:
+        results = await DB.process_user_actions(user_id, actions, username, first_name)
+        _journal_actions(user_id, actions, results, committed=True)
+        _count_coins((user_id, result["coins_change"]) for result in results)
+        return results
+
+    def _update(data):
+        apply_identity(data, username, first_name)
+        results = resolve_actions(data, actions)
+        # Recorded before the store can flush the change (_save_user_states).
+        _journal_actions(user_id, actions, results)
+        _count_coins((user_id, result["coins_change"]) for result in results)
+        return results
+
+    return await STATE_STORE.update(user_id, username, first_name, _update)
 
 
-@dp.message(Command("stats"))
-async def cmd_stats(message: types.Message):
-    if not is_admin(message.from_user.id):
+def _journal_actions(user_id: str, actions, results, committed: bool = False):
+    if JOURNAL is None:
         return
+    for (action, _), result in zip(actions, results):
+        if result.get("delta"):
+            extra = {"committed": True} if committed else {}
+            JOURNAL.record(user_id, action, result["delta"], status=result["event"].get("status"), **extra)
 
-    try:
-        args = message.text.split()
-        if len(args) < 2:
-            await message.answer("Использование: /stats [user_id]")
-            return
 
-        user_id = args[1]
+ACTION_QUEUE = (
+    ActionQueue(_run_user_actions, ACTION_QUEUE_MAX_DEPTH, ACTION_QUEUE_MAX_BATCH) if ACTION_QUEUE_MAX_DEPTH > 0 else None
+)
 
-        def _stats():
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            query = "SELECT * FROM users WHERE user_id = %s" if DATABASE_URL else "SELECT * FROM users WHERE user_id = ?"
-            cursor.execute(query, (user_id,))
-            user = cursor.fetchone()
-            close_db_connection(conn)
-            return user
 
-        user = await run_blocking(_stats)
-        if not user:
-            await message.answer(f"❌ Пользователь {user_id} не найден")
-            return
+async def perform_user_action(
+    user_id: str,
+    action: str,
+    username: str | None = None,
+    first_name: str | None = None,
+    action_payload: dict | None = None,
+):
+    if WORKERS is not None and not WORKERS.owns(user_id):
+        result = await WORKERS.call(
+            WORKERS.owner(user_id),
+            "action",
+            {
+                "user_id": user_id,
+                "action": action,
+                "username": username,
+                "first_name": first_name,
+                "payload": action_payload,
+            },
+        )
+        if result.get("error") == "queue_full":
+            raise ActionQueueFull(user_id)
+        if result.get("error") == "state_unsaved":
+            raise StateFlushOverdue()
+        _track_leaderboard(user_id, result["data"])
+        return result
+    return await _perform_user_action_local(user_id, action, username, first_name, action_payload)
+
 
-        ban_until = int(user[11]) if len(user) > 11 else 0
-        now_ms = int(time.time() * 1000)
-        ban_text = "Нет"
-        if ban_until > now_ms:
-            remain_s = (ban_until - now_ms) // 1000
-            ban_text = f"Да ({remain_s} сек.)"
-
-        stats_text = (
-            "📊 Статистика игрока\n\n"
-            f"👤 Имя: {user[10]}\n"
-            f"🆔 ID: {user[0]}\n"
-            f"💰 Монеты: {int(float(user[1]))}\n"
-            f"⚡ Энергия: {int(float(user[2]))}/{user[3]}\n"
-            f"👆 Мульти-тап: Ур.{user[4]}\n"
-            f"🔋 Энергия+: Ур.{user[5]}\n"
-            f"🎨 Золотой скин: {'Да' if user[7] else 'Нет'}\n"
-            f"⛔ Бан: {ban_text}"
+async def _perform_user_action_local(
+    user_id: str,
+    action: str,
+    username: str | None,
+    first_name: str | None,
+    action_payload: dict | None,
+):
+    if ACTION_QUEUE is not None:
+        result = await ACTION_QUEUE.submit(user_id, action, action_payload, username, first_name)
+    else:
+        results = await _run_user_actions(user_id, [(action, action_payload)], username, first_name)
+        result = results[0]
+    result.pop("delta", None)
+    result.pop("coins_change", None)
+    _track_leaderboard(user_id, result["data"])
+    _observe_action(action, action_payload, result)
+    return result
+
+
+def _observe_action(action: str, action_payload: dict | None, result: dict):
+    event = result["event"]
+    data = result["data"]
+    if action == "tap_batch":
+        TAP_BATCH_SIZE.observe(requested_taps(action_payload), "requested")
+        TAP_BATCH_SIZE.observe(event.get("taps_processed", 0), "accepted")
+    # A ban issued by this very action ends exactly AUTOCLICK_BAN_MS after it.
+    if event.get("status") == "banned" and data["ban_end_time"] == data["last_update"] + AUTOCLICK_BAN_MS:
+        BAN_EVENTS.inc("autoclick")
+
+
+def _current_rank(user_id: str):
+    return LEADERBOARD.rank(user_id) if LEADERBOARD is not None else None
+
+
+WS_HUB = WebSocketHub(
+    verify_telegram_init_data,
+    fetch_user_data,
+    perform_user_action,
+    _current_rank,
+    max_connections=WS_MAX_CONNECTIONS,
+    idle_timeout_s=WS_IDLE_TIMEOUT_S,
+    max_queue=WS_MAX_QUEUE,
+    rank_push_interval_ms=WS_RANK_PUSH_MS,
+)
+
+
+async def _forward_update(payload: dict):
+    await WORKERS.call(0, "update", payload)
+
+
+async def _feed_forwarded_update(payload: dict):
+    if WEBHOOK.bot is None:
+        raise RuntimeError("bot is not started")
+    await WEBHOOK.feed(payload)
+    return {"ok": True}
+
+
+# Only worker 0 runs the bot; updates reaching other workers are handed to it.
+WEBHOOK = TelegramWebhook(
+    WEBHOOK_SECRET,
+    max_in_flight=WEBHOOK_MAX_IN_FLIGHT,
+    forward=_forward_update if WORKERS is not None and WORKERS.index != 0 else None,
+)
+
+
+def user_exclusive(*user_ids: str):
+    # Admin commands write straight to the database; with the state store
+    # enabled the cached players must be flushed and held while they do.
+    if STATE_STORE is None:
+        return contextlib.nullcontext()
+    return STATE_STORE.exclusive(*user_ids)
+
+
+_ADMIN_UPDATES = ("give_coins", "reset_users", "ban_users")
+
+
+async def admin_update(op: str, user_ids, *args):
+    # give_coins/reset_users/ban_users on the workers that own the users.
+    if WORKERS is None:
+        return await _admin_update_local(op, user_ids, *args)
+    groups = WORKERS.group(user_ids)
+    results = await asyncio.gather(
+        *(
+            _admin_update_local(op, ids, *args)
+            if worker == WORKERS.index
+            else WORKERS.call(worker, "admin_update", {"op": op, "user_ids": ids, "args": list(args)})
+            for worker, ids in groups.items()
         )
-        await message.answer(stats_text)
-    except Exception as e:
-        await message.answer(f"❌ Ошибка: {str(e)}")
+    )
+    return [row for rows in results for row in rows]
+
+
+async def _admin_update_local(op: str, user_ids, *args):
+    if op not in _ADMIN_UPDATES:
+        raise ValueError(f"unknown admin update {op}")
+    async with user_exclusive(*user_ids):
+        rows = await getattr(DB, op)(user_ids, *args)
+    rows = [tuple(row) for row in rows]
+    if op == "give_coins":
+        _count_coins((str(row[0]), args[0]) for row in rows)
+    if JOURNAL is not None:
+        _journal_admin_update(op, rows, *args)
+    _track_admin_update(op, rows)
+    return rows
+
+
+def _journal_admin_update(op: str, rows, *args):
+    for row in rows:
+        user_id = str(row[0])
+        if op == "give_coins":
+            JOURNAL.record(user_id, "admin_give", {"coins": float(row[2])}, amount=args[0], committed=True)
+        elif op == "reset_users":
+            JOURNAL.record(user_id, "admin_reset", {**RESET_VALUES, "last_update": now_ms()}, committed=True)
+        else:
+            JOURNAL.record(user_id, "admin_ban", {"ban_end_time": args[0]}, committed=True)
 
 
-@dp.message(Command("broadcast"))
-async def cmd_broadcast(message: types.Message):
-    if not is_admin(message.from_user.id):
-        return
+async def admin_user_row(user_id: str):
+    if WORKERS is not None and not WORKERS.owns(user_id):
+        return await WORKERS.call(WORKERS.owner(user_id), "user_row", {"user_id": user_id})
+    return await _admin_user_row_local(user_id)
 
-    try:
-        text = message.text.replace("/broadcast", "", 1).strip()
-        if not text:
-            await message.answer("Использование: /broadcast [текст сообщения]")
-            return
 
-        def _all_users():
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute("SELECT user_id FROM users")
-            rows = cursor.fetchall()
-            close_db_connection(conn)
-            return rows
+async def _admin_user_row_local(user_id: str):
+    async with user_exclusive(user_id):
+        row = await DB.get_user_row(user_id)
+    return tuple(row) if row is not None else None
 
-        users = await run_blocking(_all_users)
 
-        success = 0
-        failed = 0
-        status_msg = await message.answer(f"📤 Начинаю рассылку для {len(users)} пользователей...")
+async def _perform_forwarded_action(payload: dict):
+    try:
+        return await _perform_user_action_local(
+            payload["user_id"], payload["action"], payload["username"], payload["first_name"], payload["payload"]
+        )
+    except ActionQueueFull:
+        return {"error": "queue_full"}
+    except StateFlushOverdue:
+        return {"error": "state_unsaved"}
 
-        for (user_id,) in users:
-            try:
-                await bot.send_message(int(user_id), f"📢 Сообщение от администратора:\n\n{text}")
-                success += 1
-            except Exception:
-                failed += 1
 
-        await status_msg.edit_text(f"✅ Рассылка завершена!\n\nУспешно: {success}\nОшибок: {failed}")
-    except Exception as e:
-        await message.answer(f"❌ Ошибка: {str(e)}")
+def _worker_handlers():
+    return {
+        "user": lambda p: _fetch_user_data_local(p["user_id"], p["username"], p["first_name"]),
+        "action": _perform_forwarded_action,
+        "admin_update": lambda p: _admin_update_local(p["op"], p["user_ids"], *p["args"]),
+        "user_row": lambda p: _admin_user_row_local(p["user_id"]),
+        "update": _feed_forwarded_update,
+        "ranking": _merge_peer_ranking,
+    }
 
 
 routes = web.RouteTableDef()
@@ -885,7 +1264,7 @@ async def get_user(request):
 
     username = web_user.get("username") or "Аноним"
     first_name = web_user.get("first_name") or "Игрок"
-    data = await run_blocking(get_user_data, str(user_id), username, first_name)
+    data = await fetch_user_data(str(user_id), username, first_name)
     return web.json_response(data)
 
 
@@ -908,14 +1287,18 @@ async def user_action(request):
     if not action:
         return web.json_response({"error": "action_required"}, status=400)
 
-    result = await run_blocking(
-        process_user_action,
-        str(user_id),
-        action,
-        web_user.get("username") or "Аноним",
-        web_user.get("first_name") or "Игрок",
-        payload,
-    )
+    try:
+        result = await perform_user_action(
+            str(user_id),
+            action,
+            web_user.get("username") or "Аноним",
+            web_user.get("first_name") or "Игрок",
+            payload,
+        )
+    except ActionQueueFull:
+        return web.json_response({"error": "too_many_requests"}, status=429, headers={"Retry-After": "1"})
+    except StateFlushOverdue:
+        return web.json_response({"error": "state_unsaved"}, status=503, headers={"Retry-After": "1"})
     return web.json_response(result)
 
 
@@ -930,8 +1313,7 @@ async def update_user_deprecated(request):
         return web.json_response({"error": "forbidden"}, status=403)
 
     # Deprecated endpoint: sync and return canonical server state.
-    data = await run_blocking(
-        get_user_data,
+    data = await fetch_user_data(
         str(user_id),
         web_user.get("username") or "Аноним",
         web_user.get("first_name") or "Игрок",
@@ -945,49 +1327,288 @@ async def get_leaderboard_route(request):
     if not web_user:
         return web.json_response({"error": "unauthorized"}, status=401)
 
-    leaderboard = await run_blocking(get_leaderboard)
-    return web.json_response(leaderboard)
+    if LEADERBOARD is None:
+        with LEADERBOARD_QUERY_SECONDS.time("database"):
+            leaderboard = await DB.get_leaderboard()
+        return web.json_response(leaderboard)
+
+    with LEADERBOARD_QUERY_SECONDS.time("snapshot"):
+        body, etag = LEADERBOARD.snapshot()
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag in request.headers.get("If-None-Match", ""):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type="application/json", headers=headers)
+
+
+@routes.get("/api/leaderboard/me")
+async def get_my_rank_route(request):
+    web_user = get_verified_webapp_user(request)
+    if not web_user:
+        return web.json_response({"error": "unauthorized"}, status=401)
+    if LEADERBOARD is None:
+        return web.json_response({"error": "leaderboard_disabled"}, status=404)
+
+    user_id = str(web_user["id"])
+    player = LEADERBOARD.player(user_id)
+    return web.json_response(
+        {
+            "rank": LEADERBOARD.rank(user_id),
+            "coins": player["coins"] if player else 0,
+            "total_players": len(LEADERBOARD),
+        }
+    )
+
+
+@routes.get("/ws")
+async def websocket_route(request):
+    return await WS_HUB.handle(request)
+
+
+@routes.post(WEBHOOK_PATH)
+async def telegram_webhook_route(request):
+    return await WEBHOOK.handle(request)
+
+
+@routes.get("/metrics")
+async def metrics_route(request):
+    if METRICS_TOKEN:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(supplied, METRICS_TOKEN):
+            return web.Response(status=401, text="unauthorized")
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+def _register_runtime_metrics():
+    REGISTRY.gauge(
+        "db_pool_saturation",
+        "Share of the sync PostgreSQL pool that is checked out.",
+        callback=lambda: DB_POOL_IN_USE.value("psycopg2") / DB_POOL_MAX if BACKEND.driver == "psycopg2" and DB_POOL_MAX else 0,
+    )
+    REGISTRY.counter(
+        "auth_cache_lookups_total",
+        "initData verification cache lookups by result (hit/miss).",
+        ("result",),
+        callback=lambda: {("hit",): AUTH_CACHE.hits, ("miss",): AUTH_CACHE.misses} if AUTH_CACHE is not None else {},
+    )
+    REGISTRY.gauge("auth_cache_entries", "Verified initData headers cached.", callback=lambda: len(AUTH_CACHE or ()))
+    REGISTRY.gauge(
+        "state_store_players",
+        "Players held by the write-behind state store.",
+        ("state",),
+        callback=lambda: {("cached",): len(STATE_STORE), ("dirty",): STATE_STORE.dirty_count} if STATE_STORE else {},
+    )
+    REGISTRY.gauge("leaderboard_players", "Players in the in-memory ranking.", callback=lambda: len(LEADERBOARD or ()))
+
+
+_register_runtime_metrics()
 
 
 @routes.get("/")
 async def index(request):
-    with open("index.html", "r", encoding="utf-8") as f:
-        return web.Response(text=f.read(), content_type="text/html")
+    return STATIC_ASSETS.respond(request, "index.html")
 
 
 @routes.get("/style.css")
 async def style(request):
-    with open("style.css", "r", encoding="utf-8") as f:
-        return web.Response(text=f.read(), content_type="text/css")
+    return STATIC_ASSETS.respond(request, "style.css")
 
 
 @routes.get("/script.js")
 async def script(request):
-    with open("script.js", "r", encoding="utf-8") as f:
-        return web.Response(text=f.read(), content_type="application/javascript")
+    return STATIC_ASSETS.respond(request, "script.js")
 
 
 @routes.get("/image.jpg")
 async def image(request):
-    with open("image.jpg", "rb") as f:
-        return web.Response(body=f.read(), content_type="image/jpeg")
+    return STATIC_ASSETS.respond(request, "image.jpg")
 
 
-async def start_web_server():
-    app = web.Application()
+@routes.get("/assets/{name}")
+async def hashed_asset(request):
+    return STATIC_ASSETS.respond_hashed(request, request.match_info["name"])
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        # A WebSocket "request" lasts as long as the connection; it has its own metrics.
+        if status != 101:
+            resource = request.match_info.route.resource
+            route = resource.canonical if resource is not None else "unmatched"
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, route, status)
+
+
+def create_app():
+    app = web.Application(middlewares=[metrics_middleware])
     app.add_routes(routes)
+    return app
+
+
+async def start_web_server():
+    await asyncio.to_thread(STATIC_ASSETS.load)
+    app = create_app()
     runner = web.AppRunner(app)
     await runner.setup()
     port = int(os.getenv("PORT", "8080"))
-    site = web.TCPSite(runner, "0.0.0.0", port)
+    # Workers share the public port; the kernel spreads connections by
+    # 4-tuple and ownership is restored by forwarding (see fetch_user_data).
+    site = web.TCPSite(runner, "0.0.0.0", port, reuse_port=WORKERS is not None)
     await site.start()
-    print(f"Веб-сервер запущен на порту {port}")
+    if WORKERS is not None:
+        await WORKERS.start(_worker_handlers(), extra_routes=[("GET", "/metrics", metrics_route)])
+        print(f"Веб-воркер {WORKERS.index} из {WORKERS.count} запущен на порту {port}")
+    else:
+        print(f"Веб-сервер запущен на порту {port}")
+
+
+def _async_optimistic_retries() -> int:
+    return DB_OPTIMISTIC_RETRIES if DB_CONCURRENCY == "optimistic" else 0
+
+
+async def _connect_async_db():
+    global DB
+    if DATABASE_SHARDS and DB_DRIVER != "memory":
+        sharded = create_sharded_storage(
+            DATABASE_SHARDS,
+            DB_POOL_MIN,
+            DB_POOL_MAX,
+            DB_STATEMENT_CACHE_SIZE,
+            DB_CONNECT_TIMEOUT,
+            _async_optimistic_retries(),
+            DB_TAP_SQL,
+        )
+        await sharded.connect()
+        DB = sharded
+        print(f"Шардов БД: {len(DATABASE_SHARDS)}")
+        return
+    if DB_DRIVER != "async":
+        return
+    async_database = create_async_database(
+        DATABASE_URL,
+        SQLITE_PATH,
+        DB_POOL_MIN,
+        DB_POOL_MAX,
+        DB_STATEMENT_CACHE_SIZE,
+        DB_CONNECT_TIMEOUT,
+        _async_optimistic_retries(),
+        DB_TAP_SQL,
+    )
+    if async_database is None:
+        return
+    await async_database.connect()
+    DB = async_database
+    print(f"Асинхронный драйвер БД: {type(async_database).__name__}")
+
+
+async def _load_leaderboard():
+    global LEADERBOARD
+    if not LEADERBOARD_CACHE_ENABLED or LEADERBOARD is not None:
+        return
+    leaderboard = Leaderboard(size=100, snapshot_interval_ms=LEADERBOARD_SNAPSHOT_MS)
+    with LEADERBOARD_QUERY_SECONDS.time("seed"):
+        leaderboard.load(await DB.get_ranking_rows())
+    LEADERBOARD = leaderboard
+    print(f"Лидерборд загружен: {len(leaderboard)} игроков")
+
+
+async def _push_leaderboard():
+    # Every worker ranks all players but sees only its own players' changes:
+    # it sends those to its peers, so the cost follows traffic rather than
+    # the number of players. A peer that cannot be reached gets them on a
+    # later round.
+    pending = {index: set() for index in range(WORKERS.count) if index != WORKERS.index}
+    while True:
+        await asyncio.sleep(LEADERBOARD_RESYNC_MS / 1000)
+        changed = set(_RANKING_CHANGES)
+        _RANKING_CHANGES.clear()
+        for user_ids in pending.values():
+            user_ids |= changed
+        peers = [peer for peer, user_ids in pending.items() if user_ids]
+        results = await asyncio.gather(
+            *(WORKERS.call(peer, "ranking", {"rows": LEADERBOARD.rows(pending[peer])}) for peer in peers),
+            return_exceptions=True,
+        )
+        for peer, result in zip(peers, results):
+            if isinstance(result, Exception):
+                print(f"Ошибка отправки рейтинга воркеру {peer}: {result}")
+            else:
+                pending[peer] = set()
+
+
+async def _merge_peer_ranking(payload: dict):
+    if LEADERBOARD is not None:
+        LEADERBOARD.merge(payload["rows"])
+    return {"players": len(payload["rows"])}
+
+
+async def _start_journal():
+    global JOURNAL
+    if not JOURNAL_DIR or JOURNAL is not None:
+        return
+    directory = JOURNAL_DIR if WORKERS is None else os.path.join(JOURNAL_DIR, f"worker-{WORKERS.index}")
+    journal = ActionJournal(
+        directory,
+        flush_interval_ms=JOURNAL_FLUSH_MS,
+        segment_max_bytes=JOURNAL_SEGMENT_MAX_BYTES,
+        keep_segments=JOURNAL_KEEP_SEGMENTS,
+        fsync=JOURNAL_FSYNC,
+    )
+    # Write-behind changes after the checkpoint may be missing from users
+    # (state lost in a crash). Committed entries are already in the table.
+    entries = await asyncio.to_thread(lambda: list(read_entries(directory, journal.checkpoint_seq)))
+    rows = fold(entries, skip_committed=True)
+    if rows:
+        await DB.save_users(rows)
+        print(f"Из журнала восстановлено игроков: {len(rows)}")
+    await journal.checkpoint(journal.seq)
+    journal.start()
+    JOURNAL = journal
+    _start_background(_compact_journal())
+
+
+def _start_background(coro):
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+
+async def _stop_background():
+    tasks = list(_BACKGROUND_TASKS)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def _compact_journal():
+    while True:
+        await asyncio.sleep(JOURNAL_COMPACT_INTERVAL_S)
+        try:
+            seq = JOURNAL.seq
+            if STATE_STORE is not None:
+                await STATE_STORE.flush()
+            await JOURNAL.flush()
+            await JOURNAL.checkpoint(seq)
+        except Exception as e:
+            print(f"Ошибка сжатия журнала: {e}")
 
 
 async def ensure_db_ready():
     while True:
         try:
             await asyncio.to_thread(init_db)
+            await _connect_async_db()
+            await _start_journal()
+            await _load_leaderboard()
             print("База данных инициализирована")
             return
         except Exception as e:
@@ -995,9 +1616,127 @@ async def ensure_db_ready():
             await asyncio.sleep(5)
 
 
+def _start_state_store():
+    global STATE_STORE
+    if not STATE_STORE_ENABLED or STATE_STORE is not None:
+        return
+    STATE_STORE = PlayerStateStore(
+        _load_user_state,
+        _save_user_states,
+        flush_interval_ms=STATE_FLUSH_INTERVAL_MS,
+        max_unflushed_ms=STATE_MAX_UNFLUSHED_MS,
+        max_players=STATE_MAX_PLAYERS,
+    )
+    STATE_STORE.start()
+    print(
+        f"Кэш состояния игроков включён: сброс каждые {STATE_FLUSH_INTERVAL_MS} мс, "
+        f"не дольше {STATE_MAX_UNFLUSHED_MS} мс без записи"
+    )
+
+
+def create_bot():
+    # aiogram takes most of the import time, so it is loaded only here, by
+    # the process that runs the bot. The command handlers get this module as
+    # the "app" argument.
+    global dp
+    from aiogram import Bot, Dispatcher
+
+    from bot_commands import router
+
+    if dp is None:
+        dp = Dispatcher(app=sys.modules[__name__])
+        dp.include_router(router)
+    if TELEGRAM_API_URL:
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+
+        return Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    return Bot(token=BOT_TOKEN)
+
+
+async def _start_webhook():
+    WEBHOOK.attach(bot, dp)
+    while True:
+        try:
+            await bot.set_webhook(
+                WEBHOOK_BASE_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            return
+        except Exception as e:
+            print(f"Ошибка установки webhook: {e}. Повтор через 5 сек.")
+            await asyncio.sleep(5)
+
+
+async def _start_broadcasts():
+    global BROADCASTS
+    from broadcast import BroadcastEngine
+
+    BROADCASTS = BroadcastEngine(
+        DB,
+        bot,
+        rate=BROADCAST_RATE,
+        concurrency=BROADCAST_CONCURRENCY,
+        chunk_size=BROADCAST_CHUNK_SIZE,
+        status_interval_s=BROADCAST_STATUS_INTERVAL_S,
+    )
+    resumed = await BROADCASTS.resume()
+    if resumed:
+        print(f"Возобновлено рассылок: {resumed}")
+
+
+async def shutdown():
+    await _stop_background()
+    await WS_HUB.stop()
+    await WEBHOOK.stop()
+    if BROADCASTS is not None:
+        await BROADCASTS.stop()
+    if STATE_STORE is not None:
+        await STATE_STORE.stop()
+        print("Состояние игроков сохранено")
+    try:
+        await flush_coins_total()
+    except Exception as e:
+        print(f"Ошибка записи суммы монет: {e}")
+    if JOURNAL is not None:
+        await JOURNAL.stop()
+        await JOURNAL.checkpoint(JOURNAL.seq)
+    if WORKERS is not None:
+        await WORKERS.close()
+    if bot is not None:
+        await bot.session.close()
+    await DB.close()
+
+
 async def main():
+    main_task = asyncio.current_task()
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+    except (NotImplementedError, RuntimeError):
+        pass
+
+    try:
+        await run_app()
+    finally:
+        await shutdown()
+
+
+async def run_app():
+    _start_state_store()
     await start_web_server()
     await ensure_db_ready()
+    if WORKERS is not None and LEADERBOARD is not None and LEADERBOARD_RESYNC_MS > 0:
+        _start_background(_push_leaderboard())
+    if AGGREGATES_COINS_FLUSH_S > 0:
+        _start_background(_flush_coins_total_loop())
+    if (WORKERS is None or WORKERS.index == 0) and AGGREGATES_RECONCILE_INTERVAL_S > 0:
+        _start_background(_reconcile_aggregates_loop())
+
+    if (WORKERS is not None and WORKERS.index != 0) or not BOT_POLLING:
+        while True:
+            await asyncio.sleep(3600)
 
     if not BOT_TOKEN:
         print("BOT_TOKEN не задан. Веб-сервер работает, но бот не запущен.")
@@ -1005,10 +1744,19 @@ async def main():
             await asyncio.sleep(3600)
 
     global bot
-    bot = Bot(token=BOT_TOKEN)
+    bot = create_bot()
+    await _start_broadcasts()
+    if WEBHOOK_BASE_URL:
+        await _start_webhook()
+        print(f"Бот запущен, webhook {WEBHOOK_BASE_URL}{WEBHOOK_PATH}")
+        while True:
+            await asyncio.sleep(3600)
+
     print("Бот запущен")
     while True:
         try:
+            # A webhook left from webhook mode makes getUpdates fail.
+            await bot.delete_webhook()
             await dp.start_polling(bot)
             break
         except Exception as e:
@@ -1017,4 +1765,9 @@ async def main():
 
 
 if __name__ == "__main__":
+    if WEB_WORKERS > 1 and WEB_WORKER_INDEX < 0:
+        # Create the schema once before the workers race for it.
+        init_db()
+        close_db_pools()
+        sys.exit(run_master(WEB_WORKERS, sys.argv))
     asyncio.run(main())
@@ -0,0 +1,410 @@
+import os
+import tempfile
+import time
+
+from aiogram import F, Router, types
+from aiogram.filters import Command
+from aiogram.types import FSInputFile, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+
+from admin_ops import parse_user_ids, read_user_ids_csv
+from metrics import BAN_EVENTS
+
+# Telegram command handlers. The dispatcher is created with app=<the bot
+# module>, so every handler reads the live DB, LEADERBOARD, ... through it.
+router = Router()
+
+
+def _build_start_keyboard(app):
+    if app.WEBAPP_URL.startswith("https://"):
+        return InlineKeyboardMarkup(
+            inline_keyboard=[[InlineKeyboardButton(text="🐹 Открыть Анара", web_app=WebAppInfo(url=app.WEBAPP_URL))]]
+        )
+    return None
+
+
+@router.message(Command("start"))
+async def cmd_start(message: types.Message, app):
+    keyboard = _build_start_keyboard(app)
+
+    admin_text = ""
+    if app.is_admin(message.from_user.id):
+        admin_text = "\n\n👑 Админ-команды:\n/admin - панель управления"
+
+    text = "Добро пожаловать в Анар тап!\n\nТапай и прокачивайся!"
+    if keyboard is None:
+        text += "\n\n⚠️ WEBAPP_URL не настроен (нужен https://...)"
+
+    await message.answer(f"{text}{admin_text}", reply_markup=keyboard)
+    # Writing to the bot again means broadcasts can reach this user.
+    await app.DB.set_users_blocked([str(message.from_user.id)], False)
+
+
+@router.message(Command("admin"))
+async def cmd_admin(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде")
+        return
+
+    totals = await app.DB.get_aggregates()
+    top_users = await app.get_top_users_cached(1)
+    top_user = (top_users[0][1], top_users[0][2]) if top_users else None
+
+    admin_text = (
+        "👑 АДМИН-ПАНЕЛЬ\n\n"
+        f"📊 Статистика:\n"
+        f"• Всего игроков: {totals['users']}\n"
+        f"• Всего монет: {int(totals['coins'])}\n"
+        f"• Топ игрок: {top_user[0] if top_user else 'Нет'} ({int(float(top_user[1])) if top_user else 0} монет)\n"
+        f"{_levels_text(totals)}"
+        f"{_auth_cache_text(app)}\n"
+        "📝 Команды:\n"
+        "/users - список пользователей по страницам\n"
+        "/export - выгрузка всех игроков в CSV\n"
+        "/give [user_id] [монеты] - выдать монеты\n"
+        "/reset [user_id] - сбросить прогресс\n"
+        "/ban [user_id] [минуты] - забанить пользователя\n"
+        "/stats [user_id] - статистика игрока\n"
+        "/broadcast [текст] - рассылка всем\n"
+        "/reconcile - сверить сводные показатели с таблицей"
+    )
+    await message.answer(admin_text)
+
+
+_LEVEL_TITLES = (
+    ("multi_tap_level", "Мультитап"),
+    ("energy_level", "Энергия"),
+    ("auto_tap_level", "Автотап"),
+)
+
+
+def _levels_text(totals):
+    lines = []
+    for column, title in _LEVEL_TITLES:
+        levels = ", ".join(f"{level}: {count}" for level, count in totals[column].items())
+        lines.append(f"• {title} по уровням: {levels or 'нет'}\n")
+    return "".join(lines)
+
+
+@router.message(Command("reconcile"))
+async def cmd_reconcile(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде")
+        return
+
+    drifted = await app.reconcile_aggregates()
+    if not drifted:
+        await message.answer("✅ Сводные показатели совпадают с таблицей игроков")
+        return
+    lines = [f"• {metric}: в таблице {actual:g}, было {stored:g}" for metric, actual, stored in drifted]
+    await message.answer("⚠️ Исправлены расхождения:\n" + "\n".join(lines))
+
+
+def _auth_cache_text(app):
+    if app.AUTH_CACHE is None:
+        return ""
+    stats = app.AUTH_CACHE.stats()
+    return (
+        f"• Кэш авторизации: {stats['size']} записей, "
+        f"попаданий {stats['hits']}, промахов {stats['misses']} ({stats['hit_ratio']:.0%})\n"
+    )
+
+
+async def _users_page(app, page: int, cursor_key=None, direction: str = "next"):
+    # One more row than shown tells whether there is a page further on.
+    size = app.ADMIN_USERS_PAGE_SIZE
+    rows = [tuple(row) for row in await app.DB.get_users_page(cursor_key, direction, size + 1)]
+    more = len(rows) > size
+    rows = rows[:size]
+    if direction == "prev":
+        rows.reverse()
+    if not rows:
+        return "Пользователей пока нет" if page == 1 else "На этой странице никого нет", None
+
+    first = (page - 1) * size + 1
+    lines = [f"👥 Пользователи, страница {page} (места {first}-{first + len(rows) - 1}):\n"]
+    for place, (user_id, name, coins, level) in enumerate(rows, first):
+        lines.append(f"{place}. {name} (ID: {user_id})\n   💰 {int(float(coins))} монет | 👆 Ур.{level}\n")
+
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton(text="◀️ Назад", callback_data=_users_callback("prev", page - 1, rows[0])))
+    if more or direction == "prev":
+        buttons.append(InlineKeyboardButton(text="Вперёд ▶️", callback_data=_users_callback("next", page + 1, rows[-1])))
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), keyboard
+
+
+def _users_callback(direction: str, page: int, row) -> str:
+    # users:<direction>:<page>:<coins>:<user_id>, within Telegram's 64 bytes.
+    return f"users:{direction}:{page}:{float(row[2])!r}:{row[0]}"
+
+
+@router.message(Command("users"))
+async def cmd_users(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        return
+
+    text, keyboard = await _users_page(app, 1)
+    await message.answer(text, reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith("users:"))
+async def users_page_callback(callback: types.CallbackQuery, app):
+    if not app.is_admin(callback.from_user.id):
+        await callback.answer()
+        return
+
+    try:
+        _, direction, page, coins, user_id = callback.data.split(":", 4)
+        text, keyboard = await _users_page(app, int(page), (float(coins), user_id), direction)
+        await callback.message.edit_text(text, reply_markup=keyboard)
+        await callback.answer()
+    except Exception as e:
+        await callback.answer(f"❌ Ошибка: {str(e)}", show_alert=True)
+
+
+@router.message(Command("export"))
+async def cmd_export(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        return
+
+    fd, path = tempfile.mkstemp(prefix="users-", suffix=".csv.gz")
+    os.close(fd)
+    try:
+        status_msg = await message.answer("📦 Готовлю выгрузку игроков...")
+        rows = await app.export_users_csv(path)
+        size = os.path.getsize(path)
+        if size > app.ADMIN_EXPORT_MAX_BYTES:
+            await status_msg.edit_text(
+                f"❌ Файл выгрузки {size // (1024 * 1024)} МБ больше лимита "
+                f"{app.ADMIN_EXPORT_MAX_BYTES // (1024 * 1024)} МБ"
+            )
+            return
+        filename = f"users-{time.strftime('%Y%m%d-%H%M%S')}.csv.gz"
+        await message.answer_document(FSInputFile(path, filename=filename), caption=f"👥 Игроков: {rows}")
+        await status_msg.delete()
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {str(e)}")
+    finally:
+        os.remove(path)
+
+
+async def _admin_targets(message: types.Message, app):
+    # "/cmd id1,id2,... args" or a CSV document captioned "/cmd args".
+    args = (message.text or message.caption or "").split()
+    if message.document is not None:
+        if (message.document.file_size or 0) > app.ADMIN_CSV_MAX_BYTES:
+            raise RuntimeError(f"CSV больше {app.ADMIN_CSV_MAX_BYTES // 1024} КБ")
+        data = await app.bot.download(message.document)
+        return read_user_ids_csv(data.read()), args[1:]
+    if len(args) < 2:
+        return [], []
+    return parse_user_ids(args[1]), args[2:]
+
+
+def _bulk_limit_text(user_ids, limit: int) -> str | None:
+    if len(user_ids) > limit:
+        return f"❌ Слишком много пользователей: {len(user_ids)} (максимум {limit})"
+    return None
+
+
+def _not_found_text(user_ids) -> str:
+    return f"❌ Пользователь {user_ids[0]} не найден" if len(user_ids) == 1 else "❌ Пользователи не найдены"
+
+
+def _missing_text(user_ids, rows) -> str:
+    found = {str(row[0]) for row in rows}
+    missing = [user_id for user_id in user_ids if user_id not in found]
+    if not missing:
+        return ""
+    shown = ", ".join(missing[:10])
+    return f"\nНе найдены ({len(missing)}): {shown}{'...' if len(missing) > 10 else ''}"
+
+
+@router.message(Command("give"))
+async def cmd_give(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        return
+
+    try:
+        user_ids, args = await _admin_targets(message, app)
+        if not user_ids or not args:
+            await message.answer(
+                "Использование: /give [user_id или id1,id2,...] [монеты]\n"
+                "или CSV-файл с user_id в первой колонке и подписью /give [монеты]"
+            )
+            return
+
+        coins = float(args[0])
+        if coins <= 0:
+            await message.answer("❌ Количество монет должно быть больше 0")
+            return
+        limit_text = _bulk_limit_text(user_ids, app.ADMIN_BULK_MAX_USERS)
+        if limit_text:
+            await message.answer(limit_text)
+            return
+
+        rows = await app.admin_update("give_coins", user_ids, coins)
+        if not rows:
+            await message.answer(_not_found_text(user_ids))
+            return
+
+        if len(user_ids) > 1:
+            await message.answer(f"✅ Выдано {int(coins)} монет {len(rows)} пользователям{_missing_text(user_ids, rows)}")
+            return
+
+        user_id, first_name, new_coins = rows[0]
+        new_coins = float(new_coins)
+        await message.answer(
+            f"✅ Выдано {int(coins)} монет пользователю {first_name}\n"
+            f"Было: {int(new_coins - coins)} -> Стало: {int(new_coins)}"
+        )
+
+        try:
+            await app.bot.send_message(int(user_id), f"🎁 Вам начислено {int(coins)} монет от администратора!")
+        except Exception:
+            pass
+    except ValueError:
+        await message.answer("❌ Неверный формат монет")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {str(e)}")
+
+
+@router.message(Command("reset"))
+async def cmd_reset(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        return
+
+    try:
+        user_ids, _ = await _admin_targets(message, app)
+        if not user_ids:
+            await message.answer("Использование: /reset [user_id или id1,id2,...] или CSV-файл с подписью /reset")
+            return
+        limit_text = _bulk_limit_text(user_ids, app.ADMIN_BULK_MAX_USERS)
+        if limit_text:
+            await message.answer(limit_text)
+            return
+
+        rows = await app.admin_update("reset_users", user_ids)
+        if not rows:
+            await message.answer(_not_found_text(user_ids))
+            return
+
+        if len(user_ids) > 1:
+            await message.answer(f"✅ Прогресс сброшен у {len(rows)} пользователей{_missing_text(user_ids, rows)}")
+            return
+
+        user_id, first_name = rows[0]
+        await message.answer(f"✅ Прогресс пользователя {first_name} сброшен")
+        try:
+            await app.bot.send_message(int(user_id), "⚠️ Ваш прогресс был сброшен администратором")
+        except Exception:
+            pass
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {str(e)}")
+
+
+@router.message(Command("ban"))
+async def cmd_ban(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        return
+
+    try:
+        user_ids, args = await _admin_targets(message, app)
+        if not user_ids:
+            await message.answer(
+                "Использование: /ban [user_id или id1,id2,...] [минуты]\n"
+                "или CSV-файл с подписью /ban [минуты]"
+            )
+            return
+
+        minutes = int(args[0]) if args else 60
+        if minutes <= 0:
+            await message.answer("❌ Минуты должны быть больше 0")
+            return
+        limit_text = _bulk_limit_text(user_ids, app.ADMIN_BULK_MAX_USERS)
+        if limit_text:
+            await message.answer(limit_text)
+            return
+
+        ban_end = int(time.time() * 1000) + minutes * 60 * 1000
+
+        rows = await app.admin_update("ban_users", user_ids, ban_end)
+        if not rows:
+            await message.answer(_not_found_text(user_ids))
+            return
+
+        BAN_EVENTS.inc("admin", amount=len(rows))
+        if len(user_ids) > 1:
+            await message.answer(f"✅ Забанено {len(rows)} пользователей на {minutes} мин.{_missing_text(user_ids, rows)}")
+            return
+
+        user_id, first_name = rows[0]
+        await message.answer(f"✅ Пользователь {first_name} забанен на {minutes} мин.")
+
+        try:
+            await app.bot.send_message(int(user_id), f"⛔ Вы заблокированы администратором на {minutes} мин.")
+        except Exception:
+            pass
+    except ValueError:
+        await message.answer("❌ Неверный формат минут")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {str(e)}")
+
+
+@router.message(Command("stats"))
+async def cmd_stats(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        return
+
+    try:
+        args = message.text.split()
+        if len(args) < 2:
+            await message.answer("Использование: /stats [user_id]")
+            return
+
+        user_id = args[1]
+
+        user = await app.admin_user_row(user_id)
+        if not user:
+            await message.answer(f"❌ Пользователь {user_id} не найден")
+            return
+
+        ban_until = int(user[11]) if len(user) > 11 else 0
+        now_ms = int(time.time() * 1000)
+        ban_text = "Нет"
+        if ban_until > now_ms:
+            remain_s = (ban_until - now_ms) // 1000
+            ban_text = f"Да ({remain_s} сек.)"
+
+        stats_text = (
+            "📊 Статистика игрока\n\n"
+            f"👤 Имя: {user[10]}\n"
+            f"🆔 ID: {user[0]}\n"
+            f"💰 Монеты: {int(float(user[1]))}\n"
+            f"⚡ Энергия: {int(float(user[2]))}/{user[3]}\n"
+            f"👆 Мульти-тап: Ур.{user[4]}\n"
+            f"🔋 Энергия+: Ур.{user[5]}\n"
+            f"🎨 Золотой скин: {'Да' if user[7] else 'Нет'}\n"
+            f"⛔ Бан: {ban_text}"
+        )
+        await message.answer(stats_text)
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {str(e)}")
+
+
+@router.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message, app):
+    if not app.is_admin(message.from_user.id):
+        return
+
+    try:
+        text = message.text.replace("/broadcast", "", 1).strip()
+        if not text:
+            await message.answer("Использование: /broadcast [текст сообщения]")
+            return
+
+        status_msg = await message.answer("📤 Начинаю рассылку, статус будет обновляться в этом сообщении...")
+        await app.BROADCASTS.start(text, status_msg.chat.id, status_msg.message_id)
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {str(e)}")
@@ -0,0 +1,186 @@
+import asyncio
+import time
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from game import now_ms
+from metrics import BROADCAST_MESSAGES
+
+MESSAGE_PREFIX = "📢 Сообщение от администратора:\n\n"
+
+
+# Token bucket shared by every sender of every job. A RetryAfter from Telegram
+# pauses the whole bucket rather than only the request that received it.
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = max(0.1, rate)
+        self.capacity = max(1, burst)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._updated = self._paused_until
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class BroadcastJob:
+    __slots__ = ("id", "text", "chat_id", "status_message_id", "last_user_id", "sent", "failed", "blocked", "reported_at")
+
+    def __init__(self, job_id, text, chat_id, status_message_id, last_user_id="", sent=0, failed=0, blocked=0):
+        self.id = job_id
+        self.text = text
+        self.chat_id = chat_id
+        self.status_message_id = status_message_id
+        self.last_user_id = last_user_id or ""
+        self.sent = sent
+        self.failed = failed
+        self.blocked = blocked
+        self.reported_at = 0.0
+
+
+# Sends a broadcast as a background job. Recipients are read in user_id order
+# one chunk at a time, delivered concurrently under the shared token bucket,
+# and the job row is checkpointed after every chunk, so a restarted process
+# resumes after the last finished chunk (at most one chunk is sent twice).
+class BroadcastEngine:
+    def __init__(
+        self,
+        db,
+        bot,
+        rate: float = 25,
+        concurrency: int = 10,
+        chunk_size: int = 200,
+        status_interval_s: float = 5,
+        max_retries: int = 5,
+    ):
+        self.db = db
+        self.bot = bot
+        self.bucket = TokenBucket(rate, burst=max(1, int(rate)))
+        self.concurrency = max(1, concurrency)
+        self.chunk_size = max(1, chunk_size)
+        self.status_interval = status_interval_s
+        self.max_retries = max_retries
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    async def start(self, text: str, chat_id: int, status_message_id: int) -> int:
+        job_id = await self.db.create_broadcast_job(text, chat_id, status_message_id, now_ms())
+        self._spawn(BroadcastJob(job_id, text, chat_id, status_message_id))
+        return job_id
+
+    async def resume(self) -> int:
+        rows = await self.db.get_unfinished_broadcast_jobs()
+        for row in rows:
+            if row[0] not in self._tasks:
+                self._spawn(BroadcastJob(*row))
+        return len(rows)
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _spawn(self, job: BroadcastJob):
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job.id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job.id, None))
+
+    async def _run(self, job: BroadcastJob):
+        try:
+            while True:
+                recipients = await self.db.get_broadcast_recipients(job.last_user_id, self.chunk_size)
+                if not recipients:
+                    break
+                results = await asyncio.gather(*(self._deliver(job.text, user_id) for user_id in recipients))
+
+                blocked = [user_id for user_id, result in zip(recipients, results) if result == "blocked"]
+                job.sent += results.count("sent")
+                job.failed += results.count("failed")
+                job.blocked += len(blocked)
+                job.last_user_id = recipients[-1]
+                if blocked:
+                    await self.db.set_users_blocked(blocked, True)
+                await self._checkpoint(job, "running")
+                await self._report(job)
+
+            await self._checkpoint(job, "done")
+            await self._report(job, final=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # "failed" is not resumed on the next start; the admin sees why in
+            # the status message and can send the broadcast again.
+            print(f"Рассылка #{job.id} остановлена: {e}")
+            try:
+                await self._checkpoint(job, "failed")
+            except Exception as checkpoint_error:
+                print(f"Не удалось отметить рассылку #{job.id} как прерванную: {checkpoint_error}")
+            await self._report(job, final=True, error=e)
+
+    async def _checkpoint(self, job: BroadcastJob, status: str):
+        await self.db.save_broadcast_progress(job.id, status, job.last_user_id, job.sent, job.failed, job.blocked)
+
+    async def _deliver(self, text: str, user_id: str) -> str:
+        async with self._semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self.bucket.acquire()
+                try:
+                    await self.bot.send_message(int(user_id), MESSAGE_PREFIX + text)
+                    result = "sent"
+                except TelegramRetryAfter as e:
+                    BROADCAST_MESSAGES.inc("retry_after")
+                    self.bucket.pause(e.retry_after)
+                    continue
+                except TelegramForbiddenError:
+                    result = "blocked"
+                except (TelegramNetworkError, TelegramServerError):
+                    await asyncio.sleep(min(2**attempt, 30))
+                    continue
+                except Exception:
+                    result = "failed"
+                break
+            else:
+                result = "failed"
+        BROADCAST_MESSAGES.inc(result)
+        return result
+
+    async def _report(self, job: BroadcastJob, final: bool = False, error: Exception | None = None):
+        now = time.monotonic()
+        if not final and now - job.reported_at < self.status_interval:
+            return
+        job.reported_at = now
+        if error is not None:
+            title = f"❌ Рассылка #{job.id} прервана: {error}"
+        elif final:
+            title = "✅ Рассылка завершена!"
+        else:
+            title = f"📤 Рассылка #{job.id} идёт..."
+        try:
+            await self.bot.edit_message_text(
+                f"{title}\n\nУспешно: {job.sent}\nОшибок: {job.failed}\nЗаблокировали бота: {job.blocked}",
+                chat_id=job.chat_id,
+                message_id=job.status_message_id,
+            )
+        except Exception:
+            pass
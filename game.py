@@ -0,0 +1,259 @@
+import math
+import os
+import random
+import time
+
+from user_record import UserRecord
+
+# Security and gameplay constants
+MAX_CLICKS_PER_SECOND = 20
+AUTOCLICK_BAN_MS = 2 * 60 * 1000
+MAX_TAP_BATCH = 50
+COMBO_CHANCE = 0.05
+COMBO_MULTIPLIER = 4
+
+# "exact" draws one number per accepted tap (same results as a per-tap loop
+# under a seeded RNG), "binomial" samples the combo count with a single draw.
+COMBO_SAMPLING = os.getenv("COMBO_SAMPLING", "exact").strip().lower()
+
+DEFAULT_USERNAME = "Аноним"
+DEFAULT_FIRST_NAME = "Игрок"
+
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def row_to_data(row) -> UserRecord:
+    return UserRecord(
+        {
+            "coins": float(row[1]),
+            "energy": float(row[2]),
+            "max_energy": int(row[3]),
+            "multi_tap_level": int(row[4]),
+            "energy_level": int(row[5]),
+            "auto_tap_level": int(row[6]),
+            "skin_bought": bool(row[7]),
+            "last_update": int(row[8]),
+            "username": row[9] or DEFAULT_USERNAME,
+            "first_name": row[10] or DEFAULT_FIRST_NAME,
+            "ban_end_time": int(row[11]) if len(row) > 11 else 0,
+            "tap_window_start": int(row[12]) if len(row) > 12 else 0,
+            "tap_count": int(row[13]) if len(row) > 13 else 0,
+        }
+    )
+
+
+def energy_at(data, now: int) -> float:
+    # Energy regenerates one point per second since last_update, so the
+    # current value is derived on read and never has to be written back.
+    last_update = int(data.get("last_update", 0))
+    elapsed_seconds = (now - last_update) / 1000
+    if last_update <= 0 or elapsed_seconds <= 0:
+        return data["energy"]
+    return min(data["max_energy"], data["energy"] + elapsed_seconds)
+
+
+def apply_passive_progress(data: dict, now: int):
+    energy = energy_at(data, now)
+    if energy != data["energy"]:
+        data["energy"] = energy
+    data["last_update"] = now
+
+
+def apply_identity(data: dict, username: str | None, first_name: str | None):
+    if username:
+        data["username"] = username
+    if first_name:
+        data["first_name"] = first_name
+
+
+def _binomial_hits(taps: int, u: float) -> int:
+    # Inverse-CDF draw of Binomial(taps, COMBO_CHANCE) from the uniform u.
+    q = 1 - COMBO_CHANCE
+    ratio = COMBO_CHANCE / q
+    pmf = q**taps
+    cdf = pmf
+    hits = 0
+    while u >= cdf and hits < taps:
+        pmf *= (taps - hits) / (hits + 1) * ratio
+        hits += 1
+        cdf += pmf
+    return hits
+
+
+def _combo_draws(taps: int, rng, sampling: str) -> list[float]:
+    # The uniforms a batch of taps consumes: one per tap, or one in all.
+    if taps <= 0:
+        return []
+    if sampling == "binomial":
+        return [rng.random()]
+    return [rng.random() for _ in range(taps)]
+
+
+def _combo_hits(draws: list[float], taps: int, sampling: str) -> int:
+    # Hits among the first taps of the batch _combo_draws was drawn for.
+    if taps <= 0:
+        return 0
+    if sampling == "binomial":
+        return _binomial_hits(taps, draws[0])
+    # One draw per accepted tap, in order: identical to the per-tap loop.
+    chance = COMBO_CHANCE
+    return sum(draw < chance for draw in draws[:taps])
+
+
+def sample_combo_hits(taps: int, rng=random, sampling: str | None = None) -> int:
+    sampling = sampling or COMBO_SAMPLING
+    return _combo_hits(_combo_draws(taps, rng, sampling), taps, sampling)
+
+
+def combo_hits_table(taps: int, rng=random, sampling: str | None = None) -> list[int]:
+    # table[k] is the combo_hits evaluate_tap_batch(taps) gives when it
+    # accepts k taps, from the same draws, for every k up to taps: for when
+    # the number of accepted taps is only known later, by the database
+    # (tap_sql.py).
+    if taps <= 0:
+        return [0]
+    if (sampling or COMBO_SAMPLING) == "binomial":
+        u = rng.random()
+        return [_binomial_hits(k, u) for k in range(taps + 1)]
+    chance = COMBO_CHANCE
+    table = [0]
+    for _ in range(taps):
+        table.append(table[-1] + (rng.random() < chance))
+    return table
+
+
+def evaluate_tap_batch(data: dict, taps_requested: int, now: int, rng=random, sampling: str | None = None) -> dict:
+    # Every tap of a batch lands at the same instant, so the rate window, the
+    # autoclick ban and the energy limit reduce to a few comparisons.
+    # The combo is drawn for every requested tap before the limits are
+    # applied, banned or not, because tap_sql.py has to draw its table before
+    # the database knows them: both paths take the same draws from one RNG,
+    # batch after batch.
+    sampling = sampling or COMBO_SAMPLING
+    draws = _combo_draws(taps_requested, rng, sampling)
+    if data["ban_end_time"] > now:
+        return {"status": "banned", "ban_end_time": data["ban_end_time"]}
+
+    if now - data["tap_window_start"] >= 1000:
+        data["tap_window_start"] = now
+        window_count = 0
+    else:
+        window_count = data["tap_count"]
+
+    allowed = max(0, MAX_CLICKS_PER_SECOND - window_count)
+    affordable = max(0, math.floor(data["energy"]))
+    event = None
+
+    if affordable < min(taps_requested, allowed):
+        # The tap that finds no energy is still counted against the window.
+        taps_processed = affordable
+        data["tap_count"] = window_count + taps_processed + 1
+    elif taps_requested <= allowed:
+        taps_processed = taps_requested
+        data["tap_count"] = window_count + taps_processed
+    else:
+        taps_processed = allowed
+        data["ban_end_time"] = now + AUTOCLICK_BAN_MS
+        data["tap_count"] = 0
+        event = {"status": "banned", "ban_end_time": data["ban_end_time"]}
+
+    combo_hits = _combo_hits(draws, taps_processed, sampling)
+    coins_earned = data["multi_tap_level"] * (taps_processed + (COMBO_MULTIPLIER - 1) * combo_hits)
+    data["energy"] -= taps_processed
+    data["coins"] += coins_earned
+
+    if event is not None:
+        return event
+    if taps_processed == 0:
+        return {"status": "no_energy"}
+    return {
+        "status": "ok",
+        "coins_earned": coins_earned,
+        "combo_hits": combo_hits,
+        "taps_processed": taps_processed,
+    }
+
+
+def requested_taps(payload: dict | None) -> int:
+    raw_count = (payload or {}).get("count", 1)
+    try:
+        taps_requested = int(raw_count)
+    except (TypeError, ValueError):
+        taps_requested = 1
+    return max(1, min(taps_requested, MAX_TAP_BATCH))
+
+
+def apply_action(data: dict, action: str, payload: dict | None, now: int, rng=random) -> dict:
+    event = {"status": "ok"}
+    payload = payload or {}
+    taps_requested = 1
+
+    if action == "tap_batch":
+        taps_requested = requested_taps(payload)
+        action = "tap"
+
+    if action == "tap":
+        event = evaluate_tap_batch(data, taps_requested, now, rng)
+        if event["status"] == "ok":
+            event["taps_requested"] = taps_requested
+
+    elif action == "buy_multitap":
+        price = int(100 * (1.2 ** (data["multi_tap_level"] - 1)))
+        if data["coins"] < price:
+            event = {"status": "not_enough_coins", "required": price}
+        else:
+            data["coins"] -= price
+            data["multi_tap_level"] += 1
+
+    elif action == "buy_energy":
+        price = int(200 * (1.2 ** (data["energy_level"] - 1)))
+        if data["coins"] < price:
+            event = {"status": "not_enough_coins", "required": price}
+        else:
+            data["coins"] -= price
+            data["energy_level"] += 1
+            data["max_energy"] += 500
+            data["energy"] = data["max_energy"]
+
+    elif action == "buy_autotap":
+        event = {"status": "feature_disabled"}
+
+    elif action == "buy_skin":
+        if data["skin_bought"]:
+            event = {"status": "already_bought"}
+        elif data["coins"] < 1000:
+            event = {"status": "not_enough_coins", "required": 1000}
+        else:
+            data["coins"] -= 1000
+            data["skin_bought"] = True
+
+    else:
+        event = {"status": "invalid_action"}
+
+    data["last_update"] = now
+    return event
+
+
+def resolve_action(data: dict, action: str, payload: dict | None):
+    now = now_ms()
+    apply_passive_progress(data, now)
+    event = apply_action(data, action, payload, now)
+    return {"event": event, "data": dict(data)}
+
+
+def resolve_actions(data: dict, actions) -> list:
+    # Several queued actions of one player, applied in order, one result each.
+    # Every result also carries "delta", the columns that action changed, and
+    # "coins_change", by how much its coins moved (for the /admin total).
+    results = []
+    before = dict(data)
+    for action, payload in actions:
+        result = resolve_action(data, action, payload)
+        after = result["data"]
+        result["delta"] = {key: value for key, value in after.items() if before[key] != value}
+        result["coins_change"] = after["coins"] - before["coins"]
+        before = after
+        results.append(result)
+    return results
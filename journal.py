@@ -0,0 +1,205 @@
+import asyncio
+import functools
+import json
+import os
+import time
+
+from metrics import JOURNAL_ENTRIES, JOURNAL_FLUSH_SECONDS
+from user_record import FIELDS
+
+_dumps = functools.partial(json.dumps, separators=(",", ":"), ensure_ascii=False)
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".jsonl"
+CHECKPOINT_FILE = "checkpoint"
+
+
+def segment_paths(directory: str) -> list[tuple[int, str]]:
+    # (first seq, path) of every segment, oldest first.
+    if not os.path.isdir(directory):
+        return []
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            segments.append((int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]), os.path.join(directory, name)))
+    return sorted(segments)
+
+
+def read_checkpoint(directory: str) -> int:
+    try:
+        with open(os.path.join(directory, CHECKPOINT_FILE), encoding="utf-8") as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def read_entries(directory: str, after_seq: int = 0):
+    segments = segment_paths(directory)
+    for index, (first_seq, path) in enumerate(segments):
+        if index + 1 < len(segments) and segments[index + 1][0] <= after_seq + 1:
+            continue
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A torn last line after a crash.
+                    break
+                if entry["seq"] > after_seq:
+                    yield entry
+
+
+def fold(entries, skip_committed: bool = False) -> list[tuple[str, dict]]:
+    # Deltas hold absolute column values, so the state after any prefix of the
+    # journal is simply the last value of every column per user. Returned as
+    # (user_id, changes) pairs in table column order, ready for save_users.
+    # skip_committed leaves out entries recorded after their change was
+    # already in the table; replaying one of those could undo a newer change
+    # that reached the table before its own entry reached the disk.
+    state: dict[str, dict] = {}
+    for entry in entries:
+        if skip_committed and entry.get("committed"):
+            continue
+        columns = state.get(entry["user_id"])
+        if columns is None:
+            columns = state[entry["user_id"]] = {}
+        columns.update(entry["delta"])
+    return [(user_id, {name: columns[name] for name in FIELDS if name in columns}) for user_id, columns in state.items()]
+
+
+# Append-only log of accepted actions and admin changes. record() only appends
+# to a buffer; a background task writes the buffer to the current JSON-lines
+# segment every flush_interval_ms (and fsyncs it), starting a new segment once
+# one grows past segment_max_bytes. A checkpoint seq means the users table
+# already holds every change up to it; segments entirely below the checkpoint
+# are compacted away, except the newest keep_segments kept for auditing.
+# Changes that reach the table before they are recorded (direct database
+# writes, admin updates) are recorded with committed=True and are not
+# replayed; write-behind changes are recorded first and flushed to disk before
+# the table gets them (see bot.py's _save_user_states).
+class ActionJournal:
+    def __init__(
+        self,
+        directory: str,
+        flush_interval_ms: int = 200,
+        segment_max_bytes: int = 64 * 1024 * 1024,
+        keep_segments: int = 24,
+        fsync: bool = True,
+    ):
+        self.directory = directory
+        self.flush_interval = max(0.01, flush_interval_ms / 1000)
+        self.segment_max_bytes = max(1024, segment_max_bytes)
+        self.keep_segments = max(0, keep_segments)
+        self.fsync = fsync
+        self._buffer: list[str] = []
+        self._file = None
+        self._file_size = 0
+        self._task = None
+        self._write_lock = asyncio.Lock()
+        self._checkpoint_lock = asyncio.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoint_seq = read_checkpoint(directory)
+        self.seq = max(self.checkpoint_seq, self._last_seq_on_disk())
+        self.written_seq = self.seq
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def _last_seq_on_disk(self) -> int:
+        segments = segment_paths(self.directory)
+        if not segments:
+            return 0
+        last = segments[-1][0] - 1
+        for entry in read_entries(self.directory, last):
+            last = entry["seq"]
+        return last
+
+    def record(self, user_id: str, action: str, delta: dict, **extra):
+        if not delta:
+            return
+        self.seq += 1
+        entry = {"seq": self.seq, "ts": int(time.time() * 1000), "user_id": user_id, "action": action, "delta": delta}
+        entry.update(extra)
+        self._buffer.append(_dumps(entry))
+        JOURNAL_ENTRIES.inc()
+
+    async def flush(self):
+        async with self._write_lock:
+            if not self._buffer:
+                return
+            lines, self._buffer = self._buffer, []
+            last_seq = self.seq
+            try:
+                with JOURNAL_FLUSH_SECONDS.time():
+                    await asyncio.to_thread(self._write, lines, last_seq - len(lines) + 1)
+            except Exception:
+                self._buffer[:0] = lines
+                raise
+            self.written_seq = last_seq
+
+    def _write(self, lines: list[str], first_seq: int):
+        if self._file is None or self._file_size >= self.segment_max_bytes:
+            if self._file is not None:
+                self._file.close()
+            path = os.path.join(self.directory, f"{SEGMENT_PREFIX}{first_seq:016d}{SEGMENT_SUFFIX}")
+            self._file = open(path, "a", encoding="utf-8")
+            self._file_size = self._file.tell()
+        data = "\n".join(lines) + "\n"
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file_size += len(data.encode("utf-8"))
+
+    async def checkpoint(self, seq: int):
+        # Called once the users table holds every change up to seq. Calls are
+        # serialized, so a slower one cannot move the file back.
+        async with self._checkpoint_lock:
+            if seq <= self.checkpoint_seq:
+                return
+            await asyncio.to_thread(self._checkpoint, seq)
+            self.checkpoint_seq = seq
+
+    def _checkpoint(self, seq: int):
+        path = os.path.join(self.directory, CHECKPOINT_FILE)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(str(seq))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        current = self._file.name if self._file is not None else None
+        segments = segment_paths(self.directory)
+        compacted = [
+            path
+            for index, (_, path) in enumerate(segments[:-1])
+            if segments[index + 1][0] - 1 <= seq and path != current
+        ]
+        for path in compacted[: max(0, len(compacted) - self.keep_segments)]:
+            os.remove(path)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Ошибка записи журнала действий: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import time
+
+from sortedcontainers import SortedList
+
+
+# In-memory ranking kept in sync with every coin change the process makes.
+# Players are ordered by the key (-coins, user_id) in a SortedList, a list of
+# sorted blocks, so moving a player, a rank lookup and indexing are all
+# logarithmic and the top N is a slice. Readers share one serialized snapshot
+# that is rebuilt at most every snapshot_interval_ms.
+class Leaderboard:
+    def __init__(self, size: int = 100, snapshot_interval_ms: int = 500):
+        self.size = size
+        self.snapshot_interval = snapshot_interval_ms / 1000
+        self._keys = SortedList()
+        self._players: dict[str, dict] = {}
+        self._changed = True
+        self._snapshot = (b"[]", '"0"')
+        self._snapshot_at = 0.0
+
+    def __len__(self):
+        return len(self._players)
+
+    def load(self, rows):
+        # rows as RANKING_ROWS returns them.
+        players = {}
+        for user_id, username, first_name, coins, multi_tap_level in rows:
+            players[str(user_id)] = {
+                "user_id": str(user_id),
+                "username": username,
+                "first_name": first_name,
+                "coins": float(coins),
+                "multi_tap_level": int(multi_tap_level),
+            }
+        self._players = players
+        self._keys = SortedList((-player["coins"], user_id) for user_id, player in players.items())
+        self._changed = True
+
+    def update(self, user_id: str, data: dict):
+        player = self._players.get(user_id)
+        coins = float(data["coins"])
+        if player is None:
+            player = self._players[user_id] = {
+                "user_id": user_id,
+                "username": data.get("username"),
+                "first_name": data.get("first_name"),
+                "coins": coins,
+                "multi_tap_level": int(data.get("multi_tap_level", 1)),
+            }
+            self._keys.add((-coins, user_id))
+            self._changed = True
+            return
+
+        old_key = (-player["coins"], user_id)
+        top_before = self._in_top(old_key)
+        if coins != player["coins"]:
+            self._keys.remove(old_key)
+            self._keys.add((-coins, user_id))
+            player["coins"] = coins
+        for field in ("username", "first_name", "multi_tap_level"):
+            if field in data:
+                player[field] = data[field]
+        if top_before or self._in_top((-coins, user_id)):
+            self._changed = True
+
+    def merge(self, rows):
+        # Changes another process made, in the shape of rows().
+        for user_id, username, first_name, coins, multi_tap_level in rows:
+            self.update(
+                str(user_id),
+                {"username": username, "first_name": first_name, "coins": coins, "multi_tap_level": int(multi_tap_level)},
+            )
+
+    def rows(self, user_ids) -> list:
+        # The given players as RANKING_ROWS would return them.
+        players = (self._players.get(user_id) for user_id in user_ids)
+        return [
+            [player["user_id"], player["username"], player["first_name"], player["coins"], player["multi_tap_level"]]
+            for player in players
+            if player is not None
+        ]
+
+    def _in_top(self, key) -> bool:
+        return len(self._keys) <= self.size or key <= self._keys[self.size - 1]
+
+    def rank(self, user_id: str):
+        player = self._players.get(user_id)
+        if player is None:
+            return None
+        return self._keys.bisect_left((-player["coins"], user_id)) + 1
+
+    def player(self, user_id: str):
+        return self._players.get(user_id)
+
+    def top(self, limit: int | None = None):
+        limit = self.size if limit is None else limit
+        return [dict(self._players[user_id]) for _, user_id in self._keys.islice(0, limit)]
+
+    def snapshot(self):
+        now = time.monotonic()
+        if self._changed and now - self._snapshot_at >= self.snapshot_interval:
+            body = json.dumps(self.top(), ensure_ascii=False).encode("utf-8")
+            etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+            self._snapshot = (body, etag)
+            self._snapshot_at = now
+            self._changed = False
+        return self._snapshot
@@ -0,0 +1,249 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# Minimal Prometheus-style metrics. Updates may come from the event loop and
+# from run_blocking worker threads, so every metric guards its values with a
+# lock.
+class _Metric:
+    kind = ""
+    _callback = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        return tuple(str(value) for value in labels)
+
+    def _items(self):
+        if self._callback is not None:
+            # Callback metrics are read at scrape time: {labels tuple: value}.
+            values = self._callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return sorted((self._key(key), value) for key, value in values.items())
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        # For totals another object already keeps (they must only grow).
+        self._callback = callback
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple, float] = {}
+        self._callback = callback
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        for key, value in self._items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, (list(state[0]), state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames=(), callback=None) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, callback))
+
+    def gauge(self, name: str, documentation: str, labelnames=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route.", ("method", "route", "status")
+)
+RUN_BLOCKING_WAIT_SECONDS = REGISTRY.histogram(
+    "run_blocking_wait_seconds", "Time a run_blocking call waited for an executor thread.", ("func",)
+)
+RUN_BLOCKING_SECONDS = REGISTRY.histogram(
+    "run_blocking_duration_seconds", "Time a run_blocking call spent running in its thread.", ("func",)
+)
+DB_POOL_WAIT_SECONDS = REGISTRY.histogram(
+    "db_pool_checkout_wait_seconds", "Time spent checking a connection out of the pool.", ("driver",)
+)
+DB_POOL_IN_USE = REGISTRY.gauge("db_pool_connections_in_use", "Connections currently checked out.", ("driver",))
+DB_POOL_EXHAUSTED = REGISTRY.counter(
+    "db_pool_exhausted_total", "Checkouts that failed because the pool was exhausted.", ("driver",)
+)
+DB_OPTIMISTIC_CONFLICTS = REGISTRY.counter(
+    "db_optimistic_conflicts_total", "Optimistic player updates that lost to a concurrent write and retried.", ("driver",)
+)
+DB_OPTIMISTIC_FALLBACKS = REGISTRY.counter(
+    "db_optimistic_fallbacks_total", "Player actions that ran out of optimistic retries and took the row lock.", ("driver",)
+)
+DB_TRANSACTION_SECONDS = REGISTRY.histogram(
+    "db_transaction_duration_seconds", "Duration of the process_user_action transaction.", ("driver",)
+)
+TAP_BATCH_SIZE = REGISTRY.histogram(
+    "tap_batch_size", "Taps per tap_batch request.", ("kind",), buckets=(1, 2, 5, 10, 15, 20, 30, 40, 50)
+)
+BAN_EVENTS = REGISTRY.counter("ban_events_total", "Bans issued.", ("reason",))
+LEADERBOARD_QUERY_SECONDS = REGISTRY.histogram(
+    "leaderboard_query_duration_seconds", "Time spent building leaderboard data.", ("source",)
+)
+BROADCAST_MESSAGES = REGISTRY.counter(
+    "broadcast_messages_total", "Broadcast deliveries by outcome (sent/failed/blocked/retry_after).", ("result",)
+)
+WS_CONNECTIONS = REGISTRY.gauge("ws_connections", "Open WebSocket connections.")
+WS_ACTION_SECONDS = REGISTRY.histogram(
+    "ws_action_duration_seconds", "Time to process an action received over WebSocket.", ("action",)
+)
+WS_DROPPED = REGISTRY.counter(
+    "ws_dropped_frames_total", "Outgoing WebSocket frames dropped because the client queue was full.", ("reason",)
+)
+WEBHOOK_UPDATES = REGISTRY.counter(
+    "webhook_updates_total", "Telegram webhook updates by outcome (accepted/forwarded/rejected/failed).", ("result",)
+)
+WEBHOOK_IN_FLIGHT = REGISTRY.gauge("webhook_updates_in_flight", "Webhook updates being processed.")
+SQLITE_WRITE_BATCH_SIZE = REGISTRY.histogram(
+    "sqlite_write_batch_size", "Writes group-committed per SQLite writer transaction.",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500),
+)
+ACTION_BATCH_SIZE = REGISTRY.histogram(
+    "action_batch_size", "Queued actions of one player applied in one transaction.", buckets=(1, 2, 3, 5, 10, 20, 32)
+)
+ACTION_QUEUE_REJECTED = REGISTRY.counter(
+    "action_queue_rejected_total", "Actions refused with 429 because the player's queue was full."
+)
+AGGREGATES_DRIFT = REGISTRY.gauge(
+    "aggregates_drifted_metrics", "Aggregates that disagreed with the users table at the last reconciliation."
+)
+AGGREGATES_RECONCILE_SECONDS = REGISTRY.histogram(
+    "aggregates_reconcile_duration_seconds", "Time to recount the users table and compare it with the aggregates."
+)
+JOURNAL_ENTRIES = REGISTRY.counter("journal_entries_total", "Entries appended to the action journal.")
+JOURNAL_FLUSH_SECONDS = REGISTRY.histogram(
+    "journal_flush_duration_seconds", "Time to write and fsync one batch of journal entries."
+)
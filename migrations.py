@@ -0,0 +1,172 @@
+import time
+
+import aggregates
+import tap_sql
+
+# dialect is "postgresql" or "sqlite".
+
+SCHEMA_VERSION_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT NOT NULL,
+        applied_at BIGINT NOT NULL
+    )
+"""
+# Any constant key; migrations of concurrent starts wait on it in turn.
+_PG_LOCK_KEY = 727_105_001
+
+
+def _sqlite_column_exists(cursor, table_name: str, column_name: str) -> bool:
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    return any(row[1] == column_name for row in cursor.fetchall())
+
+
+def _add_column(cursor, dialect: str, table_name: str, column_name: str, definition: str):
+    if dialect == "postgresql":
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS {column_name} {definition}")
+    elif not _sqlite_column_exists(cursor, table_name, column_name):
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {definition}")
+
+
+def _v1_initial(cursor, dialect: str):
+    # The schema init_db used to ensure on every start. Databases created
+    # before schema_version existed already have part of it, so every step
+    # is idempotent.
+    integer, boolean = ("BIGINT", "BOOLEAN DEFAULT FALSE") if dialect == "postgresql" else ("INTEGER", "INTEGER DEFAULT 0")
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS users (
+            user_id TEXT PRIMARY KEY,
+            coins REAL DEFAULT 0,
+            energy REAL DEFAULT 1000,
+            max_energy INTEGER DEFAULT 1000,
+            multi_tap_level INTEGER DEFAULT 1,
+            energy_level INTEGER DEFAULT 1,
+            auto_tap_level INTEGER DEFAULT 0,
+            skin_bought {boolean},
+            last_update {integer} DEFAULT 0,
+            username TEXT DEFAULT 'Аноним',
+            first_name TEXT DEFAULT 'Игрок',
+            ban_end_time {integer} DEFAULT 0,
+            tap_window_start {integer} DEFAULT 0,
+            tap_count INTEGER DEFAULT 0
+        )
+        """
+    )
+    _add_column(cursor, dialect, "users", "ban_end_time", f"{integer} DEFAULT 0")
+    _add_column(cursor, dialect, "users", "tap_window_start", f"{integer} DEFAULT 0")
+    _add_column(cursor, dialect, "users", "tap_count", "INTEGER DEFAULT 0")
+    _add_column(cursor, dialect, "users", "blocked_bot", boolean)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_coins_desc ON users (coins DESC)")
+    job_id = "SERIAL PRIMARY KEY" if dialect == "postgresql" else "INTEGER PRIMARY KEY AUTOINCREMENT"
+    cursor.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id {job_id},
+            text TEXT NOT NULL,
+            chat_id {integer} NOT NULL,
+            status_message_id {integer} NOT NULL,
+            status TEXT DEFAULT 'running',
+            last_user_id TEXT DEFAULT '',
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            created_at {integer} DEFAULT 0,
+            updated_at {integer} DEFAULT 0
+        )
+        """
+    )
+
+
+def _v2_users_page_index(cursor, dialect: str):
+    # Keyset pages of /users order by (coins, user_id); the old index on coins
+    # alone is a prefix of the new one and no longer needed.
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_coins_user ON users (coins DESC, user_id DESC)")
+    cursor.execute("DROP INDEX IF EXISTS idx_users_coins_desc")
+
+
+def _v3_user_aggregates(cursor, dialect: str):
+    # Trigger-maintained totals for /admin (aggregates.py), seeded by one scan.
+    aggregates.install(cursor, dialect)
+
+
+def _v4_users_version(cursor, dialect: str):
+    # Row version for optimistic updates (DB_CONCURRENCY=optimistic); every
+    # UPDATE of a player increments it.
+    _add_column(cursor, dialect, "users", "version", "BIGINT NOT NULL DEFAULT 0")
+
+
+def _v5_tap_batch_function(cursor, dialect: str):
+    # apply_tap_batch() for DB_TAP_SQL on PostgreSQL (tap_sql.py).
+    tap_sql.install(cursor, dialect)
+
+
+def _v6_aggregates_without_coin_updates(cursor, dialect: str):
+    # The UPDATE triggers of step 3 fired on coins, i.e. on every tap; they
+    # now watch the levels only (aggregates.py).
+    aggregates.install(cursor, dialect)
+
+
+def _v7_tap_batch_real_results(cursor, dialect: str):
+    # apply_tap_batch() returned coins and energy as DOUBLE PRECISION computed
+    # from the REAL columns, which psycopg2 showed as 4274.43994140625 where
+    # the transaction path gives 4274.44.
+    tap_sql.install(cursor, dialect)
+
+
+# (version, description, fn(cursor, dialect)), in order. Append new steps;
+# never edit one that has shipped.
+MIGRATIONS = (
+    (1, "users and broadcast_jobs", _v1_initial),
+    (2, "users (coins, user_id) index", _v2_users_page_index),
+    (3, "user_aggregates with triggers", _v3_user_aggregates),
+    (4, "users.version", _v4_users_version),
+    (5, "apply_tap_batch function", _v5_tap_batch_function),
+    (6, "user_aggregates triggers off the tap path", _v6_aggregates_without_coin_updates),
+    (7, "apply_tap_batch returns REAL coins and energy", _v7_tap_batch_real_results),
+)
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cursor, missing_table_errors) -> int:
+    # missing_table_errors is what the driver raises for an unknown table.
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+    except missing_table_errors:
+        return 0
+    row = cursor.fetchone()
+    return int(row[0] or 0)
+
+
+def migrate(conn, dialect: str, missing_table_errors) -> list[int]:
+    # Brings the schema to LATEST_VERSION and returns the versions applied.
+    # An up-to-date database costs the one SELECT in current_version. Pending
+    # steps run in a single transaction together with their schema_version
+    # rows, under a lock, so concurrent starts apply each step once.
+    cursor = conn.cursor()
+    if current_version(cursor, missing_table_errors) >= LATEST_VERSION:
+        return []
+
+    applied = []
+    cursor.execute("BEGIN" if dialect == "postgresql" else "BEGIN IMMEDIATE")
+    try:
+        if dialect == "postgresql":
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (_PG_LOCK_KEY,))
+        cursor.execute(SCHEMA_VERSION_TABLE)
+        version = current_version(cursor, ())
+        placeholder = "%s" if dialect == "postgresql" else "?"
+        for step, description, fn in MIGRATIONS:
+            if step <= version:
+                continue
+            fn(cursor, dialect)
+            cursor.execute(
+                f"INSERT INTO schema_version (version, description, applied_at) "
+                f"VALUES ({placeholder}, {placeholder}, {placeholder})",
+                (step, description, int(time.time() * 1000)),
+            )
+            applied.append(step)
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    return applied
@@ -110,10 +110,82 @@ async function loadUserData() {
     }
 }
 
+// Actions go over one authenticated WebSocket when it is open; the server
+// answers with only the fields that changed and pushes rank changes. REST
+// stays as the fallback while the socket is connecting or unavailable.
+const WS_RECONNECT_MS = 5000;
+let socket = null;
+let socketReady = false;
+let socketSeq = 0;
+let myRank = null;
+const socketPending = new Map();
+
+function connectSocket() {
+    if (!userId || !initDataRaw || socket || !("WebSocket" in window)) {
+        return;
+    }
+
+    const protocol = window.location.protocol === "https:" ? "wss:" : "ws:";
+    const ws = new WebSocket(`${protocol}//${window.location.host}/ws`);
+    socket = ws;
+    ws.addEventListener("open", () => {
+        ws.send(JSON.stringify({ type: "auth", init_data: initDataRaw }));
+    });
+    ws.addEventListener("message", (event) => handleSocketMessage(event.data));
+    ws.addEventListener("close", () => {
+        socket = null;
+        socketReady = false;
+        socketPending.forEach((resolve) => resolve(null));
+        socketPending.clear();
+        if (!document.hidden) {
+            setTimeout(connectSocket, WS_RECONNECT_MS);
+        }
+    });
+}
+
+function handleSocketMessage(raw) {
+    let frame;
+    try {
+        frame = JSON.parse(raw);
+    } catch (error) {
+        return;
+    }
+
+    if (frame.rank) {
+        myRank = frame.rank;
+    }
+    if (frame.type === "state") {
+        socketReady = true;
+        setGameState(frame.data);
+    } else if (frame.type === "delta") {
+        setGameState(frame.delta);
+    } else if (frame.type === "result" || frame.type === "error") {
+        if (frame.delta) {
+            setGameState(frame.delta);
+        }
+        const resolve = socketPending.get(frame.id);
+        if (resolve) {
+            socketPending.delete(frame.id);
+            resolve(frame.type === "result" ? { event: frame.event, data: frame.delta } : null);
+        }
+    }
+}
+
+function socketAction(action, extra) {
+    return new Promise((resolve) => {
+        socketSeq += 1;
+        socketPending.set(socketSeq, resolve);
+        socket.send(JSON.stringify({ type: "action", id: socketSeq, action, ...extra }));
+    });
+}
+
 async function performAction(action, extra = {}) {
     if (!userId || !initDataRaw) {
         return null;
     }
+    if (socketReady) {
+        return socketAction(action, extra);
+    }
 
     try {
         const result = await apiPost(`/api/action/${encodeURIComponent(userId)}`, { action, ...extra });
@@ -391,6 +463,21 @@ async function loadLeaderboard() {
             const item = createLeaderboardItem(player, index + 1);
             listEl.appendChild(item);
         });
+
+        const isListed = leaderboard.some((player) => String(player.user_id) === String(userId));
+        if (!isListed) {
+            // The socket keeps the rank current; without it ask the server.
+            const me = socketReady && myRank
+                ? { rank: myRank, coins: gameState.coins }
+                : await apiGet("/api/leaderboard/me").catch(() => null);
+            if (me?.rank) {
+                const item = createLeaderboardItem(
+                    { user_id: userId, first_name: initDataUnsafe?.user?.first_name, coins: me.coins, multi_tap_level: gameState.multi_tap_level },
+                    me.rank,
+                );
+                listEl.appendChild(item);
+            }
+        }
     } catch (error) {
         console.error("Ошибка загрузки лидерборда:", error);
         listEl.textContent = "Ошибка загрузки";
@@ -398,7 +485,12 @@ async function loadLeaderboard() {
 }
 
 setInterval(() => {
-    if (!document.hidden) {
+    if (document.hidden) {
+        return;
+    }
+    if (socketReady) {
+        socket.send(JSON.stringify({ type: "sync" }));
+    } else {
         loadUserData();
     }
 }, 15000);
@@ -406,7 +498,9 @@ setInterval(() => {
 document.addEventListener("visibilitychange", () => {
     if (!document.hidden) {
         loadUserData();
+        connectSocket();
     }
 });
 
 loadUserData();
+connectSocket();
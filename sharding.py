@@ -0,0 +1,232 @@
+import asyncio
+import hashlib
+import heapq
+from bisect import bisect_right
+
+from admin_ops import EXPORT_COLUMNS, CsvGzipWriter
+from async_db import AsyncPostgresDatabase, AsyncSqliteDatabase
+from game import apply_identity, apply_passive_progress, now_ms
+
+
+def _point(key: str) -> int:
+    # Stable across processes and restarts, unlike hash().
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+# Consistent hashing of user ids onto shards. Every shard owns
+# points_per_shard points on a 64-bit ring and a user belongs to the shard of
+# the first point after the hash of its id. Shards are named by position, so
+# appending one to the list moves only the users it takes over (about 1/N of
+# them) and reordering the list moves almost everyone.
+class HashRing:
+    def __init__(self, shards: int, points_per_shard: int = 160):
+        ring = sorted(
+            (_point(f"shard-{shard}-{index}"), shard) for shard in range(shards) for index in range(points_per_shard)
+        )
+        self._points = [point for point, _ in ring]
+        self._shards = [shard for _, shard in ring]
+
+    def shard(self, user_id: str) -> int:
+        index = bisect_right(self._points, _point(str(user_id)))
+        return self._shards[index % len(self._shards)]
+
+    def group(self, user_ids) -> dict[int, list[str]]:
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.shard(user_id), []).append(user_id)
+        return groups
+
+
+def _merge_aggregates(totals: list[dict]) -> dict:
+    merged = {}
+    for shard_totals in totals:
+        for key, value in shard_totals.items():
+            if isinstance(value, dict):
+                levels = merged.setdefault(key, {})
+                for level, count in value.items():
+                    levels[level] = levels.get(level, 0) + count
+            else:
+                merged[key] = merged.get(key, 0) + value
+    for key, value in merged.items():
+        if isinstance(value, dict):
+            merged[key] = dict(sorted(value.items()))
+    return merged
+
+
+# storage.Storage over several databases, each holding the users of its part
+# of the ring in its own users table, with its own pool. Per-user calls go to
+# one shard; rankings, /users pages, totals and broadcast recipients are asked
+# of every shard concurrently and merged (all of them are ordered or summable,
+# so each shard only returns its own first rows). Broadcast jobs live on shard 0.
+class ShardedStorage:
+    driver = "sharded"
+
+    def __init__(self, shards: list):
+        self.shards = shards
+        self.ring = HashRing(len(shards))
+
+    def _owner(self, user_id: str):
+        return self.shards[self.ring.shard(user_id)]
+
+    async def _gather(self, method: str, *args) -> list:
+        return await asyncio.gather(*(getattr(shard, method)(*args) for shard in self.shards))
+
+    async def _per_owner(self, method: str, user_ids, *args) -> list:
+        groups = self.ring.group(dict.fromkeys(user_ids))
+        results = await asyncio.gather(
+            *(getattr(self.shards[shard], method)(ids, *args) for shard, ids in groups.items())
+        )
+        return [row for rows in results for row in rows or ()]
+
+    async def connect(self):
+        await self._gather("connect")
+
+    async def close(self):
+        await self._gather("close")
+
+    async def load_user(self, user_id: str, username: str | None = None, first_name: str | None = None):
+        return await self._owner(user_id).load_user(user_id, username, first_name)
+
+    async def save_users(self, rows):
+        groups = {}
+        for user_id, changes in rows:
+            groups.setdefault(self.ring.shard(user_id), []).append((user_id, changes))
+        await asyncio.gather(*(self.shards[shard].save_users(shard_rows) for shard, shard_rows in groups.items()))
+
+    async def get_user_data(self, user_id: str, username: str | None = None, first_name: str | None = None):
+        data = await self.load_user(user_id, username, first_name)
+        apply_identity(data, username, first_name)
+        apply_passive_progress(data, now_ms())
+        return dict(data)
+
+    async def process_user_action(
+        self,
+        user_id: str,
+        action: str,
+        username: str | None = None,
+        first_name: str | None = None,
+        action_payload: dict | None = None,
+    ):
+        results = await self.process_user_actions(user_id, [(action, action_payload)], username, first_name)
+        return results[0]
+
+    async def process_user_actions(
+        self, user_id: str, actions, username: str | None = None, first_name: str | None = None
+    ):
+        return await self._owner(user_id).process_user_actions(user_id, actions, username, first_name)
+
+    async def get_leaderboard(self):
+        entries = await self._gather("get_leaderboard")
+        return heapq.nlargest(100, (entry for rows in entries for entry in rows), key=lambda entry: entry["coins"])
+
+    async def get_aggregates(self):
+        return _merge_aggregates(await self._gather("get_aggregates"))
+
+    async def get_aggregate_drift(self):
+        # Metrics are prefixed with their shard ("1/users") so that the
+        # corrections go back to the shard that drifted.
+        drifted = await self._gather("get_aggregate_drift")
+        return [
+            (f"{shard}/{metric}", actual, stored) for shard, rows in enumerate(drifted) for metric, actual, stored in rows
+        ]
+
+    async def correct_aggregates(self, corrections):
+        groups = {}
+        for metric, delta in corrections:
+            shard, _, metric = metric.partition("/")
+            groups.setdefault(int(shard), []).append((metric, delta))
+        await asyncio.gather(*(self.shards[shard].correct_aggregates(rows) for shard, rows in groups.items()))
+
+    async def add_to_coins_total(self, changes):
+        # Each shard's total covers its own players.
+        groups = {}
+        for user_id, coins in changes:
+            groups.setdefault(self.ring.shard(user_id), []).append((user_id, coins))
+        await asyncio.gather(*(self.shards[shard].add_to_coins_total(rows) for shard, rows in groups.items()))
+
+    async def get_top_users(self, limit: int = 50):
+        rows = await self._gather("get_top_users", limit)
+        return heapq.nlargest(limit, (tuple(row) for shard_rows in rows for row in shard_rows), key=lambda row: row[2])
+
+    async def get_ranking_rows(self):
+        rows = await self._gather("get_ranking_rows")
+        return [row for shard_rows in rows for row in shard_rows]
+
+    async def get_users_page(self, cursor_key, direction: str, limit: int):
+        # Each shard returns its own page from the same cursor, already in
+        # page order: (coins, user_id) descending, or ascending for "prev".
+        pages = await self._gather("get_users_page", cursor_key, direction, limit)
+        merged = heapq.merge(
+            *([tuple(row) for row in page] for page in pages),
+            key=lambda row: (float(row[2]), row[0]),
+            reverse=direction != "prev" or cursor_key is None,
+        )
+        return [row for row, _ in zip(merged, range(limit))]
+
+    async def export_users(self, path: str, chunk_size: int) -> int:
+        # Shard after shard; rows are in user_id order within each shard.
+        writer = CsvGzipWriter(path, EXPORT_COLUMNS)
+        try:
+            for shard in self.shards:
+                async for rows in shard.export_rows(chunk_size):
+                    await asyncio.to_thread(writer.write_rows, rows)
+        finally:
+            await asyncio.to_thread(writer.close)
+        return writer.rows
+
+    async def give_coins(self, user_ids, coins: float):
+        return await self._per_owner("give_coins", user_ids, coins)
+
+    async def reset_users(self, user_ids):
+        return await self._per_owner("reset_users", user_ids)
+
+    async def ban_users(self, user_ids, ban_end: int):
+        return await self._per_owner("ban_users", user_ids, ban_end)
+
+    async def get_user_row(self, user_id: str):
+        return await self._owner(user_id).get_user_row(user_id)
+
+    async def create_broadcast_job(self, text: str, chat_id: int, status_message_id: int, created_at: int):
+        return await self.shards[0].create_broadcast_job(text, chat_id, status_message_id, created_at)
+
+    async def get_unfinished_broadcast_jobs(self):
+        return await self.shards[0].get_unfinished_broadcast_jobs()
+
+    async def get_broadcast_recipients(self, after_user_id: str, limit: int):
+        recipients = await self._gather("get_broadcast_recipients", after_user_id, limit)
+        return [user_id for user_id, _ in zip(heapq.merge(*recipients), range(limit))]
+
+    async def save_broadcast_progress(
+        self, job_id: int, status: str, last_user_id: str, sent: int, failed: int, blocked: int
+    ):
+        await self.shards[0].save_broadcast_progress(job_id, status, last_user_id, sent, failed, blocked)
+
+    async def set_users_blocked(self, user_ids, blocked: bool):
+        await self._per_owner("set_users_blocked", user_ids, blocked)
+
+
+def create_sharded_storage(
+    shards: list[str],
+    pool_min: int,
+    pool_max: int,
+    statement_cache_size: int,
+    connect_timeout: int,
+    optimistic_retries: int = 0,
+    tap_sql: bool = False,
+) -> ShardedStorage:
+    # A postgresql:// (or postgres://) DSN per shard, or a SQLite file path.
+    databases = []
+    for shard in shards:
+        if shard.startswith(("postgresql://", "postgres://")):
+            databases.append(
+                AsyncPostgresDatabase(
+                    shard, pool_min, pool_max, statement_cache_size, connect_timeout, optimistic_retries, tap_sql
+                )
+            )
+        else:
+            databases.append(
+                AsyncSqliteDatabase(
+                    shard, pool_max, statement_cache_size, connect_timeout, optimistic_retries, tap_sql
+                )
+            )
+    return ShardedStorage(databases)
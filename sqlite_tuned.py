@@ -0,0 +1,134 @@
+import asyncio
+import concurrent.futures
+import queue
+import sqlite3
+import threading
+import time
+
+from metrics import DB_POOL_WAIT_SECONDS, DB_TRANSACTION_SECONDS, SQLITE_WRITE_BATCH_SIZE
+
+_STOP = object()
+
+
+def connect(path: str, synchronous: str = "NORMAL", mmap_size: int = 0, busy_timeout_ms: int = 5000, autocommit=False):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None if autocommit else "")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+    conn.execute(f"PRAGMA busy_timeout={int(busy_timeout_ms)}")
+    return conn
+
+
+# Persistent read connections handed out like psycopg2's pool (getconn/putconn).
+# In WAL mode readers never wait for the writer.
+class SQLiteReadPool:
+    def __init__(self, path: str, size: int, **pragmas):
+        self._idle = queue.LifoQueue()
+        for _ in range(max(1, size)):
+            self._idle.put(connect(path, **pragmas))
+
+    def getconn(self):
+        started = time.perf_counter()
+        conn = self._idle.get()
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, "sqlite3")
+        return conn
+
+    def putconn(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def closeall(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+# The only connection that writes. Callers queue fn(cursor, *args); the thread
+# takes everything queued (up to max_batch) and runs it in one transaction,
+# each task under its own SAVEPOINT so a failing task is rolled back alone.
+# Results are delivered after COMMIT, so a caller never sees a write that
+# could still be lost. max_delay_ms > 0 waits that long for more tasks when
+# the queue runs dry, trading latency for larger commits.
+class SQLiteWriter:
+    def __init__(self, path: str, max_batch: int = 256, max_delay_ms: float = 0, **pragmas):
+        self.max_batch = max(1, max_batch)
+        self.max_delay = max_delay_ms / 1000
+        self._conn = connect(path, autocommit=True, **pragmas)
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    def call(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < self.max_batch and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get(timeout=self.max_delay) if self.max_delay else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        cursor = self._conn.cursor()
+        while True:
+            batch = self._next_batch()
+            stopping = batch[-1] is _STOP
+            tasks = batch[:-1] if stopping else batch
+            if tasks:
+                self._commit(cursor, tasks)
+            if stopping:
+                self._conn.close()
+                return
+
+    def _commit(self, cursor, tasks):
+        started = time.perf_counter()
+        outcomes = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for future, fn, args in tasks:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cursor.execute("SAVEPOINT task")
+                try:
+                    outcomes.append((future, fn(cursor, *args), None))
+                    cursor.execute("RELEASE task")
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO task")
+                    cursor.execute("RELEASE task")
+                    outcomes.append((future, None, e))
+            cursor.execute("COMMIT")
+        except Exception as e:
+            if self._conn.in_transaction:
+                self._conn.rollback()
+            for future, _, _ in tasks:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, "sqlite-writer")
+            SQLITE_WRITE_BATCH_SIZE.observe(len(tasks))
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self):
+        # Finishes everything queued before the call.
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
@@ -0,0 +1,207 @@
+import asyncio
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+
+class StateFlushOverdue(Exception):
+    pass
+
+
+class _Entry:
+    __slots__ = ("data", "dirty", "dirty_since")
+
+    def __init__(self, data: dict):
+        self.data = data
+        self.dirty = False
+        self.dirty_since = 0.0
+
+
+# Authoritative in-process player state with write-behind flushing.
+# load_user(user_id, username, first_name) returns the stored row as a
+# UserRecord, save_users(rows) persists a list of (user_id, changed columns)
+# pairs in one transaction. Every call carries all the players that were dirty,
+# so once it returns the table holds every change made before it was called.
+class PlayerStateStore:
+    def __init__(
+        self,
+        load_user,
+        save_users,
+        flush_interval_ms: int = 1000,
+        max_unflushed_ms: int = 5000,
+        max_players: int = 50000,
+    ):
+        self._load_user = load_user
+        self._save_users = save_users
+        self.flush_interval = max(0.05, flush_interval_ms / 1000)
+        self.max_unflushed = max(self.flush_interval, max_unflushed_ms / 1000)
+        self.max_players = max(1, max_players)
+
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self._failed_at = float("-inf")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def items(self):
+        return [(user_id, entry.data) for user_id, entry in self._entries.items()]
+
+    @property
+    def dirty_count(self) -> int:
+        return sum(1 for entry in self._entries.values() if entry.dirty)
+
+    async def _acquire(self, user_id: str) -> asyncio.Lock:
+        # Eviction drops the lock object, so a waiter that wakes up on a stale
+        # lock has to retry with the current one.
+        while True:
+            lock = self._locks.get(user_id)
+            if lock is None:
+                lock = self._locks[user_id] = asyncio.Lock()
+            await lock.acquire()
+            if self._locks.get(user_id) is lock:
+                return lock
+            lock.release()
+
+    async def _entry(self, user_id: str, username: str | None, first_name: str | None) -> _Entry:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            data = await self._load_user(user_id, username, first_name)
+            entry = self._entries[user_id] = _Entry(data)
+        else:
+            self._entries.move_to_end(user_id)
+        return entry
+
+    def _mark_dirty(self, entry: _Entry):
+        if not entry.dirty:
+            entry.dirty = True
+            entry.dirty_since = time.monotonic()
+
+    def _overdue(self, entry: _Entry) -> bool:
+        return entry.dirty and time.monotonic() - entry.dirty_since >= self.max_unflushed
+
+    async def _flush_overdue(self, entry: _Entry):
+        # Changes older than max_unflushed are only possible while flushes
+        # fail. The player's next change waits for one that succeeds, or is
+        # refused with StateFlushOverdue, so that unsaved state stops growing
+        # past the bound. One attempt per flush_interval, however many
+        # players are waiting.
+        async with self._flush_lock:
+            if not self._overdue(entry):
+                return
+            if time.monotonic() - self._failed_at < self.flush_interval:
+                raise StateFlushOverdue()
+            try:
+                await self._flush_dirty()
+            except Exception as e:
+                raise StateFlushOverdue() from e
+
+    async def read(self, user_id: str, username: str | None, first_name: str | None, fn):
+        lock = await self._acquire(user_id)
+        try:
+            entry = await self._entry(user_id, username, first_name)
+            return fn(entry.data)
+        finally:
+            lock.release()
+
+    async def update(self, user_id: str, username: str | None, first_name: str | None, fn):
+        lock = await self._acquire(user_id)
+        try:
+            entry = await self._entry(user_id, username, first_name)
+            if self._overdue(entry):
+                await self._flush_overdue(entry)
+            result = fn(entry.data)
+            self._mark_dirty(entry)
+            return result
+        finally:
+            lock.release()
+
+    # Flushes (all dirty players) and drops the cached players and keeps them
+    # locked for the block, so direct database mutations are neither
+    # overwritten nor served stale. Locks are taken in sorted order, so
+    # overlapping bulk calls cannot deadlock.
+    @asynccontextmanager
+    async def exclusive(self, *user_ids: str):
+        locks = []
+        try:
+            for user_id in sorted(set(user_ids)):
+                locks.append((user_id, await self._acquire(user_id)))
+            # Waiting for an in-flight flush keeps an older snapshot from
+            # landing on top of the direct mutation.
+            async with self._flush_lock:
+                await self._flush_dirty()
+                for user_id, _ in locks:
+                    self._entries.pop(user_id, None)
+            yield
+        finally:
+            for user_id, lock in locks:
+                if self._locks.get(user_id) is lock:
+                    del self._locks[user_id]
+                lock.release()
+
+    async def flush(self) -> int:
+        async with self._flush_lock:
+            return await self._flush_dirty()
+
+    async def _flush_dirty(self) -> int:
+        batch = []
+        for user_id, entry in self._entries.items():
+            if entry.dirty:
+                batch.append((user_id, entry, entry.dirty_since, entry.data.take_changes()))
+                entry.dirty = False
+        if not batch:
+            return 0
+
+        try:
+            await self._save_users([(user_id, changes) for user_id, _, _, changes in batch])
+        except Exception:
+            self._failed_at = time.monotonic()
+            for _, entry, dirty_since, changes in batch:
+                entry.data.mark_dirty(changes)
+                if entry.dirty:
+                    entry.dirty_since = min(entry.dirty_since, dirty_since)
+                else:
+                    entry.dirty = True
+                    entry.dirty_since = dirty_since
+            raise
+        return len(batch)
+
+    def _evict_idle(self):
+        overflow = len(self._entries) - self.max_players
+        if overflow <= 0:
+            return
+        for user_id in list(self._entries):
+            if overflow <= 0:
+                break
+            entry = self._entries[user_id]
+            lock = self._locks.get(user_id)
+            if entry.dirty or (lock is not None and lock.locked()):
+                continue
+            del self._entries[user_id]
+            self._locks.pop(user_id, None)
+            overflow -= 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Ошибка сохранения состояния игроков: {e}")
+            self._evict_idle()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
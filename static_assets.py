@@ -0,0 +1,242 @@
+import asyncio
+import gzip
+import hashlib
+import os
+import re
+import time
+
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/html", "text/css", "application/javascript")
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def accepted_encodings(header: str) -> dict[str, float]:
+    # Accept-Encoding as {coding: q}; "*" stands for codings not listed.
+    # A malformed q counts as 0, so a coding the client refused is never sent.
+    accepted = {}
+    for token in header.split(","):
+        coding, *params = token.split(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(header: str, available) -> str | None:
+    # The available coding with the highest q above 0, earlier ones on ties.
+    accepted = accepted_encodings(header)
+    best, best_q = None, 0.0
+    for coding in available:
+        q = accepted.get(coding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class StaticAsset:
+    __slots__ = ("name", "path", "content_type", "body", "gzip", "br", "content_hash", "hashed_name", "size", "mtime")
+
+    def __init__(self, name: str, path: str, content_type: str):
+        self.name = name
+        self.path = path
+        self.content_type = content_type
+        self.body = None
+        self.gzip = None
+        self.br = None
+        self.content_hash = ""
+        self.hashed_name = name
+        self.size = 0
+        self.mtime = 0.0
+
+    def etag(self, encoding: str | None = None) -> str:
+        # Strong ETags must differ between representations: the gzip and br
+        # bodies get their own.
+        return f'"{self.content_hash}-{encoding}"' if encoding else f'"{self.content_hash}"'
+
+
+# Loads, hashes and pre-compresses the mini app files once (and again when a
+# file changes on disk) so requests are served from memory. Files larger than
+# sendfile_min_bytes are not kept in memory and go out through FileResponse.
+# Reloads after startup run in a thread (brotli at quality 11 takes a while)
+# and swap the new assets in at once; requests keep getting the old ones
+# until then.
+class StaticAssets:
+    def __init__(
+        self,
+        root: str,
+        assets: dict[str, str],
+        index_name: str = "index.html",
+        sendfile_min_bytes: int = 1024 * 1024,
+        check_interval_ms: int = 2000,
+    ):
+        self.root = root
+        self.index_name = index_name
+        self.sendfile_min_bytes = sendfile_min_bytes
+        self.check_interval = check_interval_ms / 1000
+        self._assets = {
+            name: StaticAsset(name, os.path.join(root, name), content_type) for name, content_type in assets.items()
+        }
+        self._by_hashed_name = {}
+        self._checked_at = None
+        self._reloading = None
+
+    def _read(self, asset: StaticAsset, stat: os.stat_result, body: bytes | None = None) -> StaticAsset:
+        asset = StaticAsset(asset.name, asset.path, asset.content_type)
+        if body is None:
+            digest = hashlib.sha256()
+            with open(asset.path, "rb") as f:
+                if stat.st_size < self.sendfile_min_bytes:
+                    body = f.read()
+                    digest.update(body)
+                else:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+        else:
+            digest = hashlib.sha256(body)
+
+        content_hash = digest.hexdigest()[:12]
+        stem, ext = os.path.splitext(asset.name)
+        asset.hashed_name = f"{stem}.{content_hash}{ext}"
+        asset.content_hash = content_hash
+        asset.body = body
+        asset.size = len(body) if body is not None else stat.st_size
+        asset.mtime = stat.st_mtime
+        if body is not None and asset.content_type in COMPRESSIBLE_TYPES:
+            asset.gzip = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                asset.br = brotli.compress(body, quality=11)
+        return asset
+
+    def _render_index(self, index: StaticAsset, assets: dict[str, StaticAsset]) -> bytes:
+        with open(index.path, "rb") as f:
+            html = f.read().decode("utf-8")
+        for name, asset in assets.items():
+            if name != self.index_name:
+                html = re.sub(rf'(src|href)="{re.escape(name)}"', rf'\1="/assets/{asset.hashed_name}"', html)
+        return html.encode("utf-8")
+
+    def load(self):
+        assets = dict(self._assets)
+        changed = False
+        for name, asset in self._assets.items():
+            if name == self.index_name:
+                continue
+            stat = os.stat(asset.path)
+            if stat.st_mtime != asset.mtime:
+                assets[name] = self._read(asset, stat)
+                changed = True
+
+        index = assets.get(self.index_name)
+        if index is not None:
+            stat = os.stat(index.path)
+            if changed or stat.st_mtime != index.mtime:
+                assets[self.index_name] = self._read(index, stat, self._render_index(index, assets))
+
+        # New hashed names first: the new index.html may link to them.
+        self._by_hashed_name = {asset.hashed_name: asset for asset in assets.values()}
+        self._assets = assets
+        self._checked_at = time.monotonic()
+
+    async def _reload(self):
+        try:
+            await asyncio.to_thread(self.load)
+        except OSError as e:
+            print(f"Не удалось перечитать статические файлы: {e}")
+        finally:
+            self._checked_at = time.monotonic()
+            self._reloading = None
+
+    def _refresh(self):
+        if self._checked_at is None:
+            self.load()
+        elif (
+            self.check_interval > 0
+            and self._reloading is None
+            and time.monotonic() - self._checked_at >= self.check_interval
+        ):
+            self._reloading = asyncio.get_running_loop().create_task(self._reload())
+
+    def url(self, name: str) -> str:
+        self._refresh()
+        return f"/assets/{self._assets[name].hashed_name}"
+
+    def respond(self, request: web.Request, name: str) -> web.StreamResponse:
+        self._refresh()
+        return self._respond(request, self._assets[name], REVALIDATE_CACHE)
+
+    def respond_hashed(self, request: web.Request, hashed_name: str) -> web.StreamResponse:
+        self._refresh()
+        asset = self._by_hashed_name.get(hashed_name)
+        if asset is None:
+            raise web.HTTPNotFound()
+        return self._respond(request, asset, IMMUTABLE_CACHE)
+
+    def _respond(self, request: web.Request, asset: StaticAsset, cache_control: str) -> web.StreamResponse:
+        # Ranges are served from the identity body; otherwise pick the
+        # encoding first, since the ETag depends on it.
+        range_header = request.headers.get("Range") if asset.body is not None else None
+        if_range = request.headers.get("If-Range")
+        ranged = range_header and (not if_range or if_range == asset.etag())
+        encoding = None
+        if not ranged:
+            available = [coding for coding, body in (("br", asset.br), ("gzip", asset.gzip)) if body is not None]
+            encoding = choose_encoding(request.headers.get("Accept-Encoding", ""), available)
+
+        etag = asset.etag(encoding)
+        headers = {"ETag": etag, "Cache-Control": cache_control, "Accept-Ranges": "bytes"}
+        if asset.gzip is not None:
+            headers["Vary"] = "Accept-Encoding"
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in if_none_match):
+            return web.Response(status=304, headers=headers)
+
+        if asset.body is None:
+            # FileResponse uses sendfile() and handles Range itself.
+            return web.FileResponse(asset.path, headers={**headers, "Content-Type": asset.content_type})
+        if ranged:
+            return self._range_response(asset, range_header, headers)
+        if encoding is not None:
+            body = asset.br if encoding == "br" else asset.gzip
+            return web.Response(body=body, content_type=asset.content_type, headers={**headers, "Content-Encoding": encoding})
+        return web.Response(body=asset.body, content_type=asset.content_type, headers=headers)
+
+    def _range_response(self, asset: StaticAsset, range_header: str, headers: dict) -> web.Response:
+        match = _RANGE.match(range_header.strip())
+        size = asset.size
+        if match is None or match.group(1) == match.group(2) == "":
+            return web.Response(status=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+        first, last = match.groups()
+        if first == "":
+            start = max(0, size - int(last))
+            end = size - 1
+        else:
+            start = int(first)
+            end = min(size - 1, int(last)) if last else size - 1
+        if start >= size or start > end:
+            return web.Response(status=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+        return web.Response(
+            status=206,
+            body=asset.body[start : end + 1],
+            content_type=asset.content_type,
+            headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}"},
+        )
@@ -0,0 +1,576 @@
+import asyncio
+import re
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right, insort
+from typing import Protocol
+
+from admin_ops import EXPORT_COLUMNS, RESET_VALUES, AdminQueries, CsvGzipWriter
+from aggregates import LEVEL_COLUMNS, summary
+from game import DEFAULT_FIRST_NAME, DEFAULT_USERNAME, apply_identity, apply_passive_progress, now_ms, resolve_actions, row_to_data
+from metrics import DB_POOL_EXHAUSTED, DB_POOL_IN_USE, DB_POOL_WAIT_SECONDS, DB_TRANSACTION_SECONDS
+from migrations import migrate
+from sqlite_tuned import SQLiteReadPool, SQLiteWriter
+from tap_sql import PG_TAP_BATCH, SQLITE_TAP_BATCH
+
+# Queries are written once with PostgreSQL $n placeholders; the sync backends
+# and the aiosqlite connection rewrite them to their driver's style (every
+# parameter is used once, in order).
+FETCH_USER = "SELECT * FROM users WHERE user_id = $1"
+FETCH_USER_FOR_UPDATE = "SELECT * FROM users WHERE user_id = $1 FOR UPDATE"
+# The row version first, then the row as FETCH_USER returns it.
+FETCH_USER_VERSIONED = "SELECT version, * FROM users WHERE user_id = $1"
+INSERT_USER = """
+    INSERT INTO users (user_id, username, first_name, last_update)
+    VALUES ($1, $2, $3, $4)
+    ON CONFLICT (user_id) DO NOTHING
+"""
+LEADERBOARD = """
+    SELECT user_id, username, first_name, coins, multi_tap_level
+    FROM users
+    ORDER BY coins DESC
+    LIMIT 100
+"""
+TOP_USERS = "SELECT user_id, first_name, coins, multi_tap_level FROM users ORDER BY coins DESC LIMIT $1"
+RANKING_ROWS = "SELECT user_id, username, first_name, coins, multi_tap_level FROM users"
+CREATE_BROADCAST_JOB = """
+    INSERT INTO broadcast_jobs (text, chat_id, status_message_id, created_at, updated_at)
+    VALUES ($1, $2, $3, $4, $5)
+    RETURNING id
+"""
+UNFINISHED_BROADCAST_JOBS = """
+    SELECT id, text, chat_id, status_message_id, last_user_id, sent, failed, blocked
+    FROM broadcast_jobs
+    WHERE status = 'running'
+    ORDER BY id
+"""
+BROADCAST_RECIPIENTS = "SELECT user_id FROM users WHERE user_id > $1 AND blocked_bot = $2 ORDER BY user_id LIMIT $3"
+SAVE_BROADCAST_PROGRESS = """
+    UPDATE broadcast_jobs SET
+        status = $1,
+        last_user_id = $2,
+        sent = $3,
+        failed = $4,
+        blocked = $5,
+        updated_at = $6
+    WHERE id = $7
+"""
+SET_USER_BLOCKED = "UPDATE users SET blocked_bot = $1 WHERE user_id = $2 AND blocked_bot <> $3"
+
+PG_PLACEHOLDER = re.compile(r"\$\d+")
+
+
+def leaderboard_entry(row):
+    return {
+        "user_id": row[0],
+        "username": row[1],
+        "first_name": row[2],
+        "coins": float(row[3]),
+        "multi_tap_level": int(row[4]),
+    }
+
+
+# What bot.DB offers the rest of the app. Implemented by ThreadedDatabase in
+# bot.py (psycopg2/sqlite3 through a backend below), the asyncpg/aiosqlite
+# databases in async_db.py and MemoryStorage. DB_DRIVER picks one at start.
+class Storage(Protocol):
+    async def connect(self): ...
+
+    async def close(self): ...
+
+    async def load_user(self, user_id: str, username: str | None = None, first_name: str | None = None): ...
+
+    async def save_users(self, rows): ...
+
+    async def get_user_data(self, user_id: str, username: str | None = None, first_name: str | None = None): ...
+
+    async def process_user_actions(
+        self, user_id: str, actions, username: str | None = None, first_name: str | None = None
+    ): ...
+
+    async def get_leaderboard(self): ...
+
+    async def get_aggregates(self): ...
+
+    async def get_aggregate_drift(self): ...
+
+    async def correct_aggregates(self, corrections): ...
+
+    # (user_id, coins) pairs: coin changes to add to the coins total.
+    async def add_to_coins_total(self, changes): ...
+
+    async def get_top_users(self, limit: int = 50): ...
+
+    async def get_ranking_rows(self): ...
+
+    async def get_users_page(self, cursor_key, direction: str, limit: int): ...
+
+    async def export_users(self, path: str, chunk_size: int) -> int: ...
+
+    async def give_coins(self, user_ids, coins: float): ...
+
+    async def reset_users(self, user_ids): ...
+
+    async def ban_users(self, user_ids, ban_end: int): ...
+
+    async def get_user_row(self, user_id: str): ...
+
+    async def create_broadcast_job(self, text: str, chat_id: int, status_message_id: int, created_at: int): ...
+
+    async def get_unfinished_broadcast_jobs(self): ...
+
+    async def get_broadcast_recipients(self, after_user_id: str, limit: int): ...
+
+    async def save_broadcast_progress(
+        self, job_id: int, status: str, last_user_id: str, sent: int, failed: int, blocked: int
+    ): ...
+
+    async def set_users_blocked(self, user_ids, blocked: bool): ...
+
+
+# Blocking connections and the few things the psycopg2 and sqlite3 dialects
+# do differently, for the functions behind ThreadedDatabase. One is created
+# at import from DATABASE_URL; open() builds its pools.
+class SqlBackend(ABC):
+    dialect = ""
+    driver = ""
+    paramstyle = ""
+    placeholder = ""
+    begin = "BEGIN"
+    # SELECT ... FOR UPDATE before read-modify-write; SQLite's BEGIN IMMEDIATE
+    # already holds the only write lock.
+    lock_rows = False
+    # A SQLiteWriter that runs write transactions instead of the executor.
+    writer = None
+    # The statement that applies one tap batch (tap_sql.py).
+    tap_batch = ""
+
+    def __init__(self):
+        self.admin = AdminQueries(self.dialect == "postgresql", self.paramstyle)
+        self._statements = {}
+
+    def sql(self, query: str) -> str:
+        sql = self._statements.get(query)
+        if sql is None:
+            sql = self._statements[query] = PG_PLACEHOLDER.sub(self.placeholder, query)
+        return sql
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def getconn(self): ...
+
+    @abstractmethod
+    def putconn(self, conn): ...
+
+    @abstractmethod
+    def migrate(self, conn) -> list[int]: ...
+
+    def executemany(self, cursor, query: str, params):
+        cursor.executemany(self.sql(query), params)
+
+    # End a transaction opened with `begin`.
+    def commit(self, conn):
+        conn.commit()
+
+    def rollback(self, conn):
+        conn.rollback()
+
+    def export_cursor(self, conn, chunk_size: int):
+        # A cursor that fetches the export in chunks; conn.rollback() ends it.
+        return conn.cursor()
+
+
+class PostgresBackend(SqlBackend):
+    dialect = "postgresql"
+    driver = "psycopg2"
+    paramstyle = "format"
+    placeholder = "%s"
+    lock_rows = True
+    tap_batch = PG_TAP_BATCH
+
+    def __init__(self, dsn: str, pool_min: int, pool_max: int, connect_timeout: int):
+        # Imported here so SQLite deployments never load the driver.
+        import psycopg2.errors
+        import psycopg2.extras
+        from psycopg2 import pool
+
+        super().__init__()
+        self._errors = psycopg2.errors
+        self._extras = psycopg2.extras
+        self._pool_module = pool
+        self.dsn = dsn
+        self.pool_min = pool_min
+        self.pool_max = pool_max
+        self.connect_timeout = connect_timeout
+        self.pool = None
+
+    def open(self):
+        if self.pool is None:
+            self.pool = self._pool_module.ThreadedConnectionPool(
+                minconn=self.pool_min,
+                maxconn=self.pool_max,
+                dsn=self.dsn,
+                sslmode="require",
+                connect_timeout=self.connect_timeout,
+            )
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+
+    def getconn(self):
+        if self.pool is None:
+            raise RuntimeError("PostgreSQL pool is not initialized")
+        started = time.perf_counter()
+        try:
+            conn = self.pool.getconn()
+        except self._pool_module.PoolError:
+            DB_POOL_EXHAUSTED.inc(self.driver)
+            raise
+        DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started, self.driver)
+        DB_POOL_IN_USE.inc(self.driver)
+        conn.autocommit = True
+        return conn
+
+    def putconn(self, conn):
+        if self.pool is not None:
+            self.pool.putconn(conn)
+            DB_POOL_IN_USE.dec(self.driver)
+
+    def migrate(self, conn) -> list[int]:
+        return migrate(conn, self.dialect, self._errors.UndefinedTable)
+
+    # Pooled connections are in autocommit mode, where psycopg2's commit()
+    # and rollback() do nothing: an explicit BEGIN would stay open, locks
+    # and all, when the connection goes back to the pool.
+    def commit(self, conn):
+        conn.cursor().execute("COMMIT")
+
+    def rollback(self, conn):
+        conn.cursor().execute("ROLLBACK")
+
+    def executemany(self, cursor, query: str, params):
+        self._extras.execute_batch(cursor, self.sql(query), params, page_size=500)
+
+    def export_cursor(self, conn, chunk_size: int):
+        # A named cursor is a server-side one; it needs a transaction.
+        conn.autocommit = False
+        cursor = conn.cursor(name="users_export")
+        cursor.itersize = chunk_size
+        return cursor
+
+
+class SqliteBackend(SqlBackend):
+    dialect = "sqlite"
+    driver = "sqlite3"
+    paramstyle = "qmark"
+    placeholder = "?"
+    begin = "BEGIN IMMEDIATE"
+    tap_batch = SQLITE_TAP_BATCH
+
+    def __init__(
+        self,
+        path: str,
+        tuned: bool = False,
+        read_pool_size: int = 4,
+        write_batch: int = 256,
+        write_delay_ms: float = 0,
+        **pragmas,
+    ):
+        super().__init__()
+        self.path = path
+        self.tuned = tuned
+        self.read_pool_size = read_pool_size
+        self.write_batch = write_batch
+        self.write_delay_ms = write_delay_ms
+        self.pragmas = pragmas
+        self.readers = None
+
+    def open(self):
+        if self.tuned and self.readers is None:
+            self.readers = SQLiteReadPool(self.path, self.read_pool_size, **self.pragmas)
+            self.writer = SQLiteWriter(self.path, self.write_batch, self.write_delay_ms, **self.pragmas)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.readers is not None:
+            self.readers.closeall()
+            self.readers = None
+
+    def getconn(self):
+        if self.readers is not None:
+            return self.readers.getconn()
+        return sqlite3.connect(self.path)
+
+    def putconn(self, conn):
+        if self.readers is not None:
+            self.readers.putconn(conn)
+            return
+        conn.close()
+
+    def migrate(self, conn) -> list[int]:
+        return migrate(conn, self.dialect, sqlite3.OperationalError)
+
+
+def create_backend(database_url: str, sqlite_path: str, pool_min: int, pool_max: int, connect_timeout: int, **sqlite):
+    if database_url:
+        return PostgresBackend(database_url, pool_min, pool_max, connect_timeout)
+    return SqliteBackend(sqlite_path, **sqlite)
+
+
+def _new_row(user_id: str, username: str, first_name: str, last_update: int) -> dict:
+    # A users row with the table's defaults, keyed by EXPORT_COLUMNS.
+    return {
+        "user_id": user_id,
+        "coins": 0.0,
+        "energy": 1000.0,
+        "max_energy": 1000,
+        "multi_tap_level": 1,
+        "energy_level": 1,
+        "auto_tap_level": 0,
+        "skin_bought": False,
+        "last_update": last_update,
+        "username": username,
+        "first_name": first_name,
+        "ban_end_time": 0,
+        "tap_window_start": 0,
+        "tap_count": 0,
+        "blocked_bot": False,
+        "version": 0,
+    }
+
+
+# The whole game in process memory: rows in a dict, a sorted (coins, user_id)
+# list standing in for idx_users_coins_user and a sorted list of user ids for
+# broadcasts. Nothing is persisted, so it is for tests and for benchmarks
+# that should measure the game and the web layer rather than a database.
+# Every method runs without awaiting, so each one is atomic on the loop.
+class MemoryStorage:
+    driver = "memory"
+
+    def __init__(self):
+        self._rows: dict[str, dict] = {}
+        self._ranking: list[tuple[float, str]] = []
+        self._user_ids: list[str] = []
+        self._jobs: dict[int, dict] = {}
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def _row_tuple(self, row: dict) -> tuple:
+        return tuple(row[column] for column in EXPORT_COLUMNS)
+
+    def _fetch_or_create(self, user_id: str, username: str | None, first_name: str | None) -> dict:
+        row = self._rows.get(user_id)
+        if row is None:
+            row = self._rows[user_id] = _new_row(
+                user_id, username or DEFAULT_USERNAME, first_name or DEFAULT_FIRST_NAME, now_ms()
+            )
+            insort(self._ranking, (row["coins"], user_id))
+            insort(self._user_ids, user_id)
+        return row
+
+    def _update(self, row: dict, changes: dict):
+        coins = changes.get("coins")
+        if coins is not None and float(coins) != row["coins"]:
+            del self._ranking[bisect_left(self._ranking, (row["coins"], row["user_id"]))]
+            insort(self._ranking, (float(coins), row["user_id"]))
+        row.update(changes)
+        if coins is not None:
+            row["coins"] = float(coins)
+        row["version"] += 1
+
+    def _selected(self, user_ids):
+        for user_id in dict.fromkeys(user_ids):
+            row = self._rows.get(user_id)
+            if row is not None:
+                yield row
+
+    def _descending(self):
+        for coins, user_id in reversed(self._ranking):
+            yield self._rows[user_id]
+
+    async def load_user(self, user_id: str, username: str | None = None, first_name: str | None = None):
+        return row_to_data(self._row_tuple(self._fetch_or_create(user_id, username, first_name)))
+
+    async def save_users(self, rows):
+        for user_id, changes in rows:
+            row = self._rows.get(user_id)
+            if row is not None:
+                self._update(row, changes)
+
+    async def get_user_data(self, user_id: str, username: str | None = None, first_name: str | None = None):
+        data = await self.load_user(user_id, username, first_name)
+        apply_identity(data, username, first_name)
+        apply_passive_progress(data, now_ms())
+        return dict(data)
+
+    async def process_user_action(
+        self,
+        user_id: str,
+        action: str,
+        username: str | None = None,
+        first_name: str | None = None,
+        action_payload: dict | None = None,
+    ):
+        results = await self.process_user_actions(user_id, [(action, action_payload)], username, first_name)
+        return results[0]
+
+    async def process_user_actions(
+        self, user_id: str, actions, username: str | None = None, first_name: str | None = None
+    ):
+        started = time.perf_counter()
+        row = self._fetch_or_create(user_id, username, first_name)
+        data = row_to_data(self._row_tuple(row))
+        apply_identity(data, username, first_name)
+        results = resolve_actions(data, actions)
+        changes = data.take_changes()
+        if changes:
+            self._update(row, changes)
+        DB_TRANSACTION_SECONDS.observe(time.perf_counter() - started, self.driver)
+        return results
+
+    async def get_leaderboard(self):
+        return [
+            leaderboard_entry((row["user_id"], row["username"], row["first_name"], row["coins"], row["multi_tap_level"]))
+            for row, _ in zip(self._descending(), range(100))
+        ]
+
+    async def get_aggregates(self):
+        counts = {}
+        for row in self._rows.values():
+            for column in LEVEL_COLUMNS:
+                metric = f"{column}={row[column]}"
+                counts[metric] = counts.get(metric, 0) + 1
+        coins = sum(row["coins"] for row in self._rows.values())
+        return summary([("users", len(self._rows)), ("coins", coins)] + list(counts.items()))
+
+    async def get_aggregate_drift(self):
+        # Totals are counted from the rows on every read; nothing can drift.
+        return []
+
+    async def correct_aggregates(self, corrections):
+        pass
+
+    async def add_to_coins_total(self, changes):
+        pass
+
+    async def get_top_users(self, limit: int = 50):
+        return [
+            (row["user_id"], row["first_name"], row["coins"], row["multi_tap_level"])
+            for row, _ in zip(self._descending(), range(limit))
+        ]
+
+    async def get_ranking_rows(self):
+        return [
+            (row["user_id"], row["username"], row["first_name"], row["coins"], row["multi_tap_level"])
+            for row in self._rows.values()
+        ]
+
+    async def get_users_page(self, cursor_key, direction: str, limit: int):
+        # Same rows and order as AdminQueries.users_page: "prev" pages come
+        # nearest first, in ascending order.
+        if cursor_key is None:
+            keys = self._ranking[-limit:][::-1] if limit else []
+        elif direction == "prev":
+            start = bisect_right(self._ranking, (float(cursor_key[0]), cursor_key[1]))
+            keys = self._ranking[start : start + limit]
+        else:
+            end = bisect_left(self._ranking, (float(cursor_key[0]), cursor_key[1]))
+            keys = self._ranking[max(0, end - limit) : end][::-1]
+        return [
+            (user_id, self._rows[user_id]["first_name"], coins, self._rows[user_id]["multi_tap_level"])
+            for coins, user_id in keys
+        ]
+
+    async def export_users(self, path: str, chunk_size: int) -> int:
+        writer = CsvGzipWriter(path, EXPORT_COLUMNS)
+        try:
+            user_ids = list(self._user_ids)
+            for start in range(0, len(user_ids), max(1, chunk_size)):
+                rows = [self._row_tuple(row) for row in self._selected(user_ids[start : start + chunk_size])]
+                await asyncio.to_thread(writer.write_rows, rows)
+        finally:
+            await asyncio.to_thread(writer.close)
+        return writer.rows
+
+    async def give_coins(self, user_ids, coins: float):
+        result = []
+        for row in self._selected(user_ids):
+            self._update(row, {"coins": row["coins"] + coins})
+            result.append((row["user_id"], row["first_name"], row["coins"]))
+        return result
+
+    async def reset_users(self, user_ids):
+        result = []
+        for row in self._selected(user_ids):
+            self._update(row, dict(RESET_VALUES, last_update=now_ms()))
+            result.append((row["user_id"], row["first_name"]))
+        return result
+
+    async def ban_users(self, user_ids, ban_end: int):
+        result = []
+        for row in self._selected(user_ids):
+            row["ban_end_time"] = ban_end
+            row["version"] += 1
+            result.append((row["user_id"], row["first_name"]))
+        return result
+
+    async def get_user_row(self, user_id: str):
+        row = self._rows.get(user_id)
+        return self._row_tuple(row) + (row["version"],) if row is not None else None
+
+    async def create_broadcast_job(self, text: str, chat_id: int, status_message_id: int, created_at: int):
+        job_id = max(self._jobs, default=0) + 1
+        self._jobs[job_id] = {
+            "id": job_id,
+            "text": text,
+            "chat_id": chat_id,
+            "status_message_id": status_message_id,
+            "status": "running",
+            "last_user_id": "",
+            "sent": 0,
+            "failed": 0,
+            "blocked": 0,
+            "created_at": created_at,
+            "updated_at": created_at,
+        }
+        return job_id
+
+    async def get_unfinished_broadcast_jobs(self):
+        columns = ("id", "text", "chat_id", "status_message_id", "last_user_id", "sent", "failed", "blocked")
+        return [tuple(job[column] for column in columns) for job in self._jobs.values() if job["status"] == "running"]
+
+    async def get_broadcast_recipients(self, after_user_id: str, limit: int):
+        recipients = []
+        for user_id in self._user_ids[bisect_right(self._user_ids, after_user_id) :]:
+            if len(recipients) >= limit:
+                break
+            if not self._rows[user_id]["blocked_bot"]:
+                recipients.append(user_id)
+        return recipients
+
+    async def save_broadcast_progress(
+        self, job_id: int, status: str, last_user_id: str, sent: int, failed: int, blocked: int
+    ):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.update(
+                status=status, last_user_id=last_user_id, sent=sent, failed=failed, blocked=blocked, updated_at=now_ms()
+            )
+
+    async def set_users_blocked(self, user_ids, blocked: bool):
+        for row in self._selected(user_ids):
+            row["blocked_bot"] = blocked
@@ -0,0 +1,315 @@
+import json
+import random
+
+import game
+from game import DEFAULT_FIRST_NAME, DEFAULT_USERNAME, combo_hits_table, now_ms, requested_taps, row_to_data
+from user_record import FIELDS, IDENTITY_FIELDS
+
+# Tap batches applied by the database in one statement (bot.py's DB_TAP_SQL),
+# by the rules of game.evaluate_tap_batch: passive energy, the autoclick ban,
+# the one-second rate window, the energy limit and the combo bonus. The RNG
+# stays in Python: every statement gets combo_hits_table() as a JSON array and
+# takes the entry for the number of taps it accepted. That table uses the same
+# draws resolve_actions would, so a seeded RNG gives both paths the same
+# combos over any sequence of batches. Statements return the
+# player row as FETCH_USER orders it (user_id and FIELDS), then the number of
+# taps accepted.
+# dialect is "postgresql" or "sqlite", as in migrations.py.
+
+TAP_ACTIONS = ("tap", "tap_batch")
+# Columns a tap batch may change: a result's "delta" carries all of them,
+# which is a superset of what changed and all the journal needs.
+TAP_COLUMNS = ("coins", "energy", "last_update", "ban_end_time", "tap_window_start", "tap_count")
+_ROW = ", ".join(("user_id",) + FIELDS)
+
+# PostgreSQL: a function that locks the row, so concurrent batches of one
+# player queue on it like the FOR UPDATE transaction does. One round trip.
+# coins and energy come back as REAL, the column type, so that a driver reads
+# them exactly as it reads them from the table (psycopg2 as the shortest
+# decimal, asyncpg as the float4).
+PG_SIGNATURE = "apply_tap_batch(TEXT, TEXT, TEXT, BIGINT, INTEGER, JSONB, INTEGER, BIGINT, INTEGER)"
+PG_FUNCTION = f"""
+    CREATE OR REPLACE FUNCTION apply_tap_batch(
+        p_user_id TEXT,
+        p_username TEXT,
+        p_first_name TEXT,
+        p_now BIGINT,
+        p_taps INTEGER,
+        p_combo JSONB,
+        p_max_clicks INTEGER,
+        p_ban_ms BIGINT,
+        p_combo_multiplier INTEGER
+    ) RETURNS TABLE (
+        user_id TEXT,
+        coins REAL,
+        energy REAL,
+        max_energy INTEGER,
+        multi_tap_level INTEGER,
+        energy_level INTEGER,
+        auto_tap_level INTEGER,
+        skin_bought BOOLEAN,
+        last_update BIGINT,
+        username TEXT,
+        first_name TEXT,
+        ban_end_time BIGINT,
+        tap_window_start BIGINT,
+        tap_count INTEGER,
+        taps_processed INTEGER
+    ) LANGUAGE plpgsql AS $$
+    #variable_conflict use_column
+    DECLARE
+        u users%ROWTYPE;
+        v_coins DOUBLE PRECISION;
+        v_energy DOUBLE PRECISION;
+        v_window_count INTEGER;
+        v_allowed INTEGER;
+        v_affordable BIGINT;
+    BEGIN
+        SELECT * INTO u FROM users WHERE users.user_id = p_user_id FOR UPDATE;
+        IF NOT FOUND THEN
+            INSERT INTO users (user_id, username, first_name, last_update)
+            VALUES (
+                p_user_id,
+                COALESCE(NULLIF(p_username, ''), '{DEFAULT_USERNAME}'),
+                COALESCE(NULLIF(p_first_name, ''), '{DEFAULT_FIRST_NAME}'),
+                p_now
+            )
+            ON CONFLICT DO NOTHING;
+            SELECT * INTO u FROM users WHERE users.user_id = p_user_id FOR UPDATE;
+        END IF;
+
+        v_coins := u.coins;
+        IF u.last_update <= 0 OR p_now - u.last_update <= 0 THEN
+            v_energy := u.energy;
+        ELSE
+            v_energy := LEAST(u.max_energy, u.energy + (p_now - u.last_update)::DOUBLE PRECISION / 1000);
+        END IF;
+        taps_processed := 0;
+
+        IF u.ban_end_time <= p_now THEN
+            IF p_now - u.tap_window_start >= 1000 THEN
+                u.tap_window_start := p_now;
+                v_window_count := 0;
+            ELSE
+                v_window_count := u.tap_count;
+            END IF;
+            v_allowed := GREATEST(0, p_max_clicks - v_window_count);
+            v_affordable := GREATEST(0, floor(v_energy));
+            IF v_affordable < LEAST(p_taps, v_allowed) THEN
+                taps_processed := v_affordable;
+                u.tap_count := v_window_count + v_affordable + 1;
+            ELSIF p_taps <= v_allowed THEN
+                taps_processed := p_taps;
+                u.tap_count := v_window_count + p_taps;
+            ELSE
+                taps_processed := v_allowed;
+                u.ban_end_time := p_now + p_ban_ms;
+                u.tap_count := 0;
+            END IF;
+            v_coins := v_coins + u.multi_tap_level
+                * (taps_processed + (p_combo_multiplier - 1) * (p_combo ->> taps_processed)::INTEGER);
+            v_energy := v_energy - taps_processed;
+        END IF;
+
+        UPDATE users SET
+            coins = v_coins,
+            energy = v_energy,
+            last_update = p_now,
+            username = COALESCE(NULLIF(p_username, ''), u.username),
+            first_name = COALESCE(NULLIF(p_first_name, ''), u.first_name),
+            ban_end_time = u.ban_end_time,
+            tap_window_start = u.tap_window_start,
+            tap_count = u.tap_count,
+            version = u.version + 1
+        WHERE users.user_id = p_user_id;
+
+        user_id := u.user_id;
+        coins := v_coins;
+        energy := v_energy;
+        max_energy := u.max_energy;
+        multi_tap_level := u.multi_tap_level;
+        energy_level := u.energy_level;
+        auto_tap_level := u.auto_tap_level;
+        skin_bought := u.skin_bought;
+        last_update := p_now;
+        username := COALESCE(NULLIF(p_username, ''), u.username);
+        first_name := COALESCE(NULLIF(p_first_name, ''), u.first_name);
+        ban_end_time := u.ban_end_time;
+        tap_window_start := u.tap_window_start;
+        tap_count := u.tap_count;
+        RETURN NEXT;
+    END
+    $$
+"""
+PG_TAP_BATCH = "SELECT * FROM apply_tap_batch($1, $2, $3, $4, $5, $6, $7, $8, $9)"
+
+# SQLite: one UPSERT over a chain of CTEs: the row (or a new player's
+# defaults, as INSERT_USER leaves them), then passive energy and the rate
+# window, then the limits, then the branch. SQLite has a single writer, so
+# reading the row in the same statement is as good as a lock. RETURNING can
+# only see the new row, but batch is MATERIALIZED: it is computed once,
+# before the write, and the subquery below reads the taps it accepted. That
+# subquery is compiled apart and makes the statement slow to prepare (about
+# 1 ms), which pays off only on connections that keep it cached.
+SQLITE_TAP_BATCH = f"""
+    WITH input AS (
+        SELECT
+            $1 AS user_id,
+            $2 AS new_username,
+            $3 AS new_first_name,
+            $4 AS now,
+            $5 AS taps,
+            $6 AS combo,
+            $7 AS max_clicks,
+            $8 AS ban_ms,
+            $9 AS combo_multiplier
+    ),
+    stored AS (
+        SELECT {", ".join(FIELDS)} FROM users WHERE user_id = (SELECT user_id FROM input)
+        UNION ALL
+        SELECT 0, 1000, 1000, 1, 1, 0, 0, now, '{DEFAULT_USERNAME}', '{DEFAULT_FIRST_NAME}', 0, 0, 0
+        FROM input
+        WHERE NOT EXISTS (SELECT 1 FROM users WHERE users.user_id = input.user_id)
+    ),
+    player AS (
+        SELECT
+            input.*,
+            stored.*,
+            CASE
+                WHEN last_update <= 0 OR now - last_update <= 0 THEN energy
+                ELSE MIN(max_energy, energy + (now - last_update) / 1000.0)
+            END AS energy_now,
+            CASE WHEN now - tap_window_start >= 1000 THEN now ELSE tap_window_start END AS window_start,
+            CASE WHEN now - tap_window_start >= 1000 THEN 0 ELSE tap_count END AS window_count
+        FROM input, stored
+    ),
+    limits AS (
+        SELECT
+            player.*,
+            MAX(0, CAST(energy_now AS INTEGER)) AS affordable,
+            MAX(0, max_clicks - window_count) AS allowed
+        FROM player
+    ),
+    batch AS MATERIALIZED (
+        SELECT
+            limits.*,
+            CASE
+                WHEN ban_end_time > now THEN 'banned'
+                WHEN affordable < MIN(taps, allowed) THEN 'energy'
+                WHEN taps <= allowed THEN 'taps'
+                ELSE 'autoclick'
+            END AS branch,
+            CASE
+                WHEN ban_end_time > now THEN 0
+                WHEN affordable < MIN(taps, allowed) THEN affordable
+                WHEN taps <= allowed THEN taps
+                ELSE allowed
+            END AS processed
+        FROM limits
+    )
+    INSERT INTO users ({_ROW})
+    SELECT
+        user_id,
+        coins + multi_tap_level * (processed + (combo_multiplier - 1) * json_extract(combo, '$[' || processed || ']')),
+        energy_now - processed,
+        max_energy,
+        multi_tap_level,
+        energy_level,
+        auto_tap_level,
+        skin_bought,
+        now,
+        COALESCE(NULLIF(new_username, ''), username),
+        COALESCE(NULLIF(new_first_name, ''), first_name),
+        CASE WHEN branch = 'autoclick' THEN now + ban_ms ELSE ban_end_time END,
+        CASE WHEN branch = 'banned' THEN tap_window_start ELSE window_start END,
+        CASE branch
+            WHEN 'banned' THEN tap_count
+            WHEN 'energy' THEN window_count + affordable + 1
+            WHEN 'taps' THEN window_count + taps
+            ELSE 0
+        END
+    FROM batch
+    WHERE true
+    ON CONFLICT (user_id) DO UPDATE SET
+        coins = excluded.coins,
+        energy = excluded.energy,
+        last_update = excluded.last_update,
+        username = excluded.username,
+        first_name = excluded.first_name,
+        ban_end_time = excluded.ban_end_time,
+        tap_window_start = excluded.tap_window_start,
+        tap_count = excluded.tap_count,
+        version = version + 1
+    RETURNING {_ROW}, (SELECT processed FROM batch)
+"""
+
+
+def install(cursor, dialect: str):
+    # apply_tap_batch on PostgreSQL; SQLite needs nothing. Used by schema
+    # migrations 5 and 7; a changed function ships as a new step calling this
+    # again. Dropped first: CREATE OR REPLACE cannot change the result type.
+    if dialect == "postgresql":
+        cursor.execute(f"DROP FUNCTION IF EXISTS {PG_SIGNATURE}")
+        cursor.execute(PG_FUNCTION)
+
+
+def is_tap_batch(actions) -> bool:
+    return all(action in TAP_ACTIONS for action, _ in actions)
+
+
+# One tap action as the parameters of the dialect's statement, and the same
+# result resolve_actions would give, built back from the row it returns.
+class TapBatch:
+    def __init__(
+        self,
+        user_id: str,
+        action: str,
+        payload: dict | None,
+        username: str | None,
+        first_name: str | None,
+        now: int | None = None,
+        rng=random,
+    ):
+        self.now = now_ms() if now is None else now
+        self.taps = requested_taps(payload) if action == "tap_batch" else 1
+        self.combo = combo_hits_table(self.taps, rng)
+        self.combo_multiplier = game.COMBO_MULTIPLIER
+        self.params = (
+            user_id,
+            username,
+            first_name,
+            self.now,
+            self.taps,
+            json.dumps(self.combo),
+            game.MAX_CLICKS_PER_SECOND,
+            game.AUTOCLICK_BAN_MS,
+            self.combo_multiplier,
+        )
+        self.columns = TAP_COLUMNS + tuple(
+            field for field, value in zip(IDENTITY_FIELDS, (username, first_name)) if value
+        )
+
+    def result(self, row) -> dict:
+        row = tuple(row)
+        processed = int(row[-1])
+        data = row_to_data(row[:-1])
+        # A ban that was running, or the one this batch earned.
+        if data["ban_end_time"] > self.now:
+            event = {"status": "banned", "ban_end_time": data["ban_end_time"]}
+        elif processed == 0:
+            event = {"status": "no_energy"}
+        else:
+            combo_hits = self.combo[processed]
+            event = {
+                "status": "ok",
+                "coins_earned": data["multi_tap_level"] * (processed + (self.combo_multiplier - 1) * combo_hits),
+                "combo_hits": combo_hits,
+                "taps_processed": processed,
+                "taps_requested": self.taps,
+            }
+        return {
+            "event": event,
+            "data": dict(data),
+            "delta": {column: data[column] for column in self.columns},
+            "coins_change": float(event.get("coins_earned", 0)),
+        }
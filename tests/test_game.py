@@ -0,0 +1,141 @@
+import random
+
+import pytest
+
+import game
+from game import (
+    AUTOCLICK_BAN_MS,
+    COMBO_CHANCE,
+    COMBO_MULTIPLIER,
+    MAX_CLICKS_PER_SECOND,
+    MAX_TAP_BATCH,
+    combo_hits_table,
+    evaluate_tap_batch,
+    requested_taps,
+    sample_combo_hits,
+)
+
+NOW = 1_700_000_000_000
+
+
+def per_tap_loop(data: dict, taps_requested: int, now: int, rng) -> dict:
+    # The per-tap loop evaluate_tap_batch replaced, with time.time() frozen.
+    event = {"status": "ok"}
+    coins_earned_total = 0
+    combo_hits = 0
+    taps_processed = 0
+
+    for _ in range(taps_requested):
+        if data["ban_end_time"] > now:
+            event = {"status": "banned", "ban_end_time": data["ban_end_time"]}
+            break
+
+        if now - data["tap_window_start"] >= 1000:
+            data["tap_window_start"] = now
+            data["tap_count"] = 1
+        else:
+            data["tap_count"] += 1
+
+        if data["tap_count"] > MAX_CLICKS_PER_SECOND:
+            data["ban_end_time"] = now + AUTOCLICK_BAN_MS
+            data["tap_count"] = 0
+            event = {"status": "banned", "ban_end_time": data["ban_end_time"]}
+            break
+
+        if data["energy"] < 1:
+            break
+
+        data["energy"] -= 1
+        is_combo = rng.random() < COMBO_CHANCE
+        coins_earned = data["multi_tap_level"] * (COMBO_MULTIPLIER if is_combo else 1)
+        data["coins"] += coins_earned
+        coins_earned_total += coins_earned
+        combo_hits += int(is_combo)
+        taps_processed += 1
+
+    if event["status"] != "banned":
+        if taps_processed == 0:
+            event = {"status": "no_energy"}
+        else:
+            event = {
+                "status": "ok",
+                "coins_earned": coins_earned_total,
+                "combo_hits": combo_hits,
+                "taps_processed": taps_processed,
+            }
+    return event
+
+
+def random_state(rng: random.Random) -> dict:
+    return {
+        "coins": float(rng.randrange(0, 10**6)),
+        "energy": rng.choice([0.0, 0.5, 1.0, 3.25, 19.9, float(rng.randrange(0, 5000)) + rng.random()]),
+        "multi_tap_level": rng.randrange(1, 30),
+        "ban_end_time": rng.choice([0, NOW - 1, NOW, NOW + 1, NOW + 60000]),
+        "tap_window_start": rng.choice([0, NOW - 1000, NOW - 999, NOW - 500, NOW]),
+        "tap_count": rng.randrange(0, MAX_CLICKS_PER_SECOND + 2),
+    }
+
+
+def test_exact_batch_matches_per_tap_loop():
+    states = random.Random(12345)
+    mismatches = []
+    for case in range(5000):
+        state = random_state(states)
+        taps = states.randrange(1, MAX_TAP_BATCH + 1)
+
+        loop_data = dict(state)
+        loop_event = per_tap_loop(loop_data, taps, NOW, random.Random(case))
+        batch_data = dict(state)
+        batch_event = evaluate_tap_batch(batch_data, taps, NOW, random.Random(case), sampling="exact")
+
+        if (loop_event, loop_data) != (batch_event, batch_data):
+            mismatches.append((state, taps, loop_event, batch_event))
+    assert mismatches == []
+
+
+def test_binomial_batch_is_deterministic_per_seed():
+    states = random.Random(54321)
+    for case in range(1000):
+        state = random_state(states)
+        first, second = dict(state), dict(state)
+        one = evaluate_tap_batch(first, MAX_TAP_BATCH, NOW, random.Random(case), sampling="binomial")
+        two = evaluate_tap_batch(second, MAX_TAP_BATCH, NOW, random.Random(case), sampling="binomial")
+        assert (one, first) == (two, second)
+
+
+def test_binomial_combo_rate():
+    rng = random.Random(7)
+    hits = taps = 0
+    for _ in range(20000):
+        data = {"coins": 0.0, "energy": 1000.0, "multi_tap_level": 1, "ban_end_time": 0, "tap_window_start": 0, "tap_count": 0}
+        event = evaluate_tap_batch(data, MAX_CLICKS_PER_SECOND, 10_000, rng, sampling="binomial")
+        hits += event["combo_hits"]
+        taps += event["taps_processed"]
+    assert hits / taps == pytest.approx(COMBO_CHANCE, abs=0.005)
+
+
+@pytest.mark.parametrize("sampling", ["exact", "binomial"])
+def test_combo_hits_table_matches_sample_combo_hits(sampling):
+    for seed in range(200):
+        table = combo_hits_table(MAX_TAP_BATCH, random.Random(seed), sampling)
+        assert len(table) == MAX_TAP_BATCH + 1
+        for taps in range(MAX_TAP_BATCH + 1):
+            assert table[taps] == sample_combo_hits(taps, random.Random(seed), sampling)
+
+
+def test_combo_multiplier_applies_to_hits(monkeypatch):
+    monkeypatch.setattr(game, "COMBO_CHANCE", 1.0)
+    data = {"coins": 0.0, "energy": 10.0, "multi_tap_level": 3, "ban_end_time": 0, "tap_window_start": 0, "tap_count": 0}
+    event = evaluate_tap_batch(data, 5, NOW, random.Random(1), sampling="exact")
+    assert event == {"status": "ok", "coins_earned": 3 * 5 * COMBO_MULTIPLIER, "combo_hits": 5, "taps_processed": 5}
+    assert data["energy"] == 5.0
+
+
+@pytest.mark.parametrize(
+    "payload, taps",
+    [(None, 1), ({}, 1), ({"count": 5}, 5), ({"count": "7"}, 7), ({"count": 0}, 1), ({"count": -3}, 1),
+     ({"count": 10**6}, MAX_TAP_BATCH), ({"count": "x"}, 1), ({"count": None}, 1)],
+)
+def test_requested_taps(payload, taps):
+    assert requested_taps(payload) == taps
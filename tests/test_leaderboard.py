@@ -0,0 +1,33 @@
+import random
+
+from leaderboard import Leaderboard
+
+
+def ranking(coins: dict) -> list:
+    return sorted(coins, key=lambda user_id: (-coins[user_id], user_id))
+
+
+def test_ranks_and_top_follow_every_update():
+    rng = random.Random(3)
+    board = Leaderboard(size=10)
+    board.load([(str(user_id), "u", "U", rng.randint(0, 50), 1) for user_id in range(200)])
+    coins = {player["user_id"]: player["coins"] for player in board.top(len(board))}
+    for _ in range(2000):
+        user_id = str(rng.randrange(250))
+        # Ties on coins are common at this range; user_id breaks them.
+        coins[user_id] = float(rng.randint(0, 60))
+        board.update(user_id, {"coins": coins[user_id]})
+    expected = ranking(coins)
+    assert len(board) == len(coins)
+    assert [player["user_id"] for player in board.top(len(board))] == expected
+    assert [board.rank(user_id) for user_id in expected] == list(range(1, len(expected) + 1))
+    assert board.rank("unknown") is None
+
+
+def test_merge_moves_players_from_another_worker():
+    board = Leaderboard(size=2)
+    board.load([("a", "a", "A", 10, 1), ("b", "b", "B", 20, 1), ("c", "c", "C", 30, 1)])
+    board.merge([["a", "a", "A", 40.0, 2], ["d", "d", "D", 25.0, 1]])
+    assert [player["user_id"] for player in board.top()] == ["a", "c"]
+    assert board.rank("d") == 3 and board.rank("b") == 4
+    assert board.rows(["a", "x"]) == [["a", "a", "A", 40.0, 2]]
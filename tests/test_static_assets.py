@@ -0,0 +1,31 @@
+import pytest
+
+from static_assets import accepted_encodings, choose_encoding
+
+
+def test_accepted_encodings_reads_q_values():
+    assert accepted_encodings("gzip, br;q=0.5, identity; q=0, *;q=0.1") == {
+        "gzip": 1.0,
+        "br": 0.5,
+        "identity": 0.0,
+        "*": 0.1,
+    }
+
+
+@pytest.mark.parametrize(
+    "header, expected",
+    [
+        ("", None),
+        ("gzip, deflate, br", "br"),
+        ("br;q=0, gzip", "gzip"),
+        ("gzip;q=0", None),
+        ("gzip;q=0.9, br;q=0.5", "gzip"),
+        ("*", "br"),
+        ("br;q=0, *", "gzip"),
+        ("*;q=0", None),
+        ("GZIP;Q=1", "gzip"),
+        ("gzip;q=oops", None),
+    ],
+)
+def test_choose_encoding_honours_q(header, expected):
+    assert choose_encoding(header, ["br", "gzip"]) == expected
@@ -0,0 +1,165 @@
+import math
+import os
+import random
+import sqlite3
+
+import pytest
+
+import game
+from game import MAX_CLICKS_PER_SECOND, resolve_actions, row_to_data
+from migrations import migrate
+from storage import FETCH_USER, PG_PLACEHOLDER
+from tap_sql import PG_TAP_BATCH, SQLITE_TAP_BATCH, TapBatch
+from user_record import FIELDS
+
+NOW = 1_700_000_000_000
+# A scratch PostgreSQL database for apply_tap_batch(); without it only SQLite
+# is checked. Players named taptest-* are written there.
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "").strip()
+STATE_UPDATE = """
+    UPDATE users SET
+        coins = $1,
+        energy = $2,
+        max_energy = $3,
+        multi_tap_level = $4,
+        last_update = $5,
+        ban_end_time = $6,
+        tap_window_start = $7,
+        tap_count = $8
+    WHERE user_id = $9
+"""
+
+
+class Statements:
+    def __init__(self, conn, placeholder: str, tap_query: str, exact: bool):
+        self.cursor = conn.cursor()
+        self.placeholder = placeholder
+        self.tap_query = tap_query
+        # PostgreSQL keeps coins and energy as REAL. The function computes
+        # from the stored float4, while psycopg2 reads its shortest decimal
+        # text, so the two sides agree to REAL precision only.
+        self.exact = exact
+
+    def execute(self, query: str, params):
+        self.cursor.execute(PG_PLACEHOLDER.sub(self.placeholder, query), params)
+        return self.cursor.fetchone() if self.cursor.description else None
+
+    def tap(self, batch: TapBatch) -> dict:
+        return batch.result(self.execute(self.tap_query, batch.params))
+
+    def fetch(self, user_id: str):
+        return self.execute(FETCH_USER, (user_id,))
+
+    def same(self, got: dict, expected: dict) -> bool:
+        if self.exact:
+            return dict(got) == dict(expected)
+        return all(
+            math.isclose(got[name], expected[name], rel_tol=1e-6, abs_tol=1e-6)
+            if isinstance(expected[name], float)
+            else got[name] == expected[name]
+            for name in FIELDS
+        )
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def statements(request, tmp_path):
+    if request.param == "sqlite":
+        conn = sqlite3.connect(str(tmp_path / "users.db"), isolation_level=None)
+        migrate(conn, "sqlite", sqlite3.OperationalError)
+        yield Statements(conn, "?", SQLITE_TAP_BATCH, exact=True)
+    else:
+        if not TEST_DATABASE_URL:
+            pytest.skip("TEST_DATABASE_URL is not set")
+        psycopg2 = pytest.importorskip("psycopg2")
+        import psycopg2.errors
+
+        conn = psycopg2.connect(TEST_DATABASE_URL)
+        conn.autocommit = True
+        migrate(conn, "postgresql", psycopg2.errors.UndefinedTable)
+        conn.cursor().execute("DELETE FROM users WHERE user_id LIKE 'taptest-%'")
+        yield Statements(conn, "%s", PG_TAP_BATCH, exact=False)
+        conn.cursor().execute("DELETE FROM users WHERE user_id LIKE 'taptest-%'")
+    conn.close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # resolve_actions reads the time from game.now_ms and draws from the
+    # random module; both are pinned here and the RNG state put back after.
+    now = [NOW]
+    monkeypatch.setattr(game, "now_ms", lambda: now[0])
+    state = random.getstate()
+    yield now
+    random.setstate(state)
+
+
+def random_state(rng: random.Random, now: int) -> tuple:
+    return (
+        round(rng.uniform(0, 5000), 3),
+        rng.choice((0, 0.4, 1, 3.75, 19.5, 49.99, 500, 1000)),
+        rng.choice((1000, 1500, 2000)),
+        rng.randint(1, 5),
+        now - rng.choice((0, 1, 250, 999, 1000, 60_000)),
+        rng.choice((0, 0, now - 1, now, now + 1, now + 90_000)),
+        now - rng.choice((0, 1, 500, 999, 1000, 1001)),
+        rng.choice((0, 1, 5, 19, 20, 21, 40)),
+    )
+
+
+@pytest.mark.parametrize("sampling", ["exact", "binomial"])
+def test_statement_matches_resolve_actions_on_random_rows(statements, clock, monkeypatch, sampling):
+    monkeypatch.setattr(game, "COMBO_SAMPLING", sampling)
+    cases = random.Random(2024)
+    players = [f"taptest-{sampling}-{index}" for index in range(8)]
+    for player in players:
+        statements.tap(TapBatch(player, "tap", None, None, None, clock[0]))
+    mismatches = []
+    for case in range(1500):
+        clock[0] += cases.choice((0, 1, 40, 400, 1000, 2500))
+        user_id = cases.choice(players)
+        if cases.random() < 0.4:
+            statements.execute(STATE_UPDATE, random_state(cases, clock[0]) + (user_id,))
+        data = row_to_data(statements.fetch(user_id))
+        action = cases.choice(("tap", "tap_batch", "tap_batch"))
+        payload = {"count": cases.choice((1, 2, 5, 19, 20, 21, 50, "x"))} if action == "tap_batch" else None
+        seed = cases.random()
+
+        random.seed(seed)
+        expected = resolve_actions(data, [(action, payload)])[0]
+        result = statements.tap(TapBatch(user_id, action, payload, None, None, clock[0], random.Random(seed)))
+        stored = statements.fetch(user_id)
+
+        if (
+            result["event"] != expected["event"]
+            or not statements.same(result["data"], expected["data"])
+            or not statements.same(row_to_data(stored), expected["data"])
+        ):
+            mismatches.append((case, expected["event"], result["event"]))
+    assert mismatches == []
+
+
+@pytest.mark.parametrize("sampling", ["exact", "binomial"])
+def test_one_rng_gives_the_same_combos_over_many_batches(statements, clock, monkeypatch, sampling):
+    # One seeded RNG per side for a whole session of one player: every batch,
+    # accepted, cut short by energy or the rate limit, or refused during a
+    # ban, has to take as many draws on both sides.
+    monkeypatch.setattr(game, "COMBO_SAMPLING", sampling)
+    steps = random.Random(99)
+    user_id = f"taptest-session-{sampling}"
+    # Little energy, so that some batches run dry.
+    statements.tap(TapBatch(user_id, "tap", None, None, None, clock[0]))
+    statements.execute(STATE_UPDATE, (0.0, 10.0, 60, 1, clock[0], 0, 0, 0, user_id))
+    data = row_to_data(statements.fetch(user_id))
+    sql_rng = random.Random(7)
+    random.seed(7)
+    statuses = set()
+    for step in range(600):
+        clock[0] += steps.choice((0, 5, 50, 300, 1000, 4000, 31_000))
+        count = steps.choice((1, 3, 8, MAX_CLICKS_PER_SECOND, MAX_CLICKS_PER_SECOND + 1, 50))
+        expected = resolve_actions(data, [("tap_batch", {"count": count})])[0]
+        result = statements.tap(TapBatch(user_id, "tap_batch", {"count": count}, None, None, clock[0], sql_rng))
+        assert result["event"] == expected["event"], step
+        assert statements.same(result["data"], expected["data"]), step
+        statuses.add(expected["event"]["status"])
+        data = row_to_data(statements.fetch(user_id))
+    assert statuses == {"ok", "banned", "no_energy"}
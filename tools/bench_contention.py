@@ -0,0 +1,188 @@
+"""Row contention: locked versus optimistic player updates.
+
+--threads worker threads (like the server's executor) send tap_batch actions
+for a few --hot players through bot.py's sync functions, bypassing the
+in-process action queue so that actions of one player really race. The
+pessimistic mode is process_user_actions (BEGIN, SELECT ... FOR UPDATE on
+PostgreSQL, BEGIN IMMEDIATE on SQLite); the optimistic mode is
+process_user_actions_optimistic (plain SELECT, then UPDATE ... WHERE version
+= ?, with DB_OPTIMISTIC_RETRIES attempts before it takes the lock); the sql
+mode is process_tap_batches (DB_TAP_SQL: one statement per batch).
+--pause-ms sleeps inside the game computation to stand in for a GIL or
+thread-pool stall while the row would be locked.
+
+Players are seeded with unlimited energy and the autoclick limit is lifted,
+so every action earns coins. The run then checks that the coins in the table
+equal the sum of coins_earned that the actions reported, which catches lost
+updates.
+
+Runs on a temporary SQLite file by default, or on PostgreSQL with
+--database-url (a scratch database: its users table gets the benchmark
+players).
+
+    python tools/bench_contention.py --threads 8 --hot 4 --actions 200 --pause-ms 2
+    python tools/bench_contention.py --database-url postgresql://... --threads 16 --hot 2
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from common import RESULTS_DIR, git_revision, latency_summary, write_results
+
+
+def load_bot(args):
+    os.environ.setdefault("BOT_TOKEN", "123456:TEST-LOADTEST-TOKEN")
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-contention-"), "users.db")
+    os.environ["SQLITE_TUNED"] = "0"
+    os.environ["DB_POOL_MAX"] = str(max(args.threads + 2, 4))
+    import bot
+    import game
+
+    # One client hammering a player would be banned and run dry otherwise.
+    game.MAX_CLICKS_PER_SECOND = 10**9
+    bot.DB_OPTIMISTIC_RETRIES = args.retries
+    if args.pause_ms > 0:
+        resolve_actions = bot.resolve_actions
+
+        def paused_resolve_actions(data, actions):
+            time.sleep(args.pause_ms / 1000)
+            return resolve_actions(data, actions)
+
+        bot.resolve_actions = paused_resolve_actions
+    bot.init_db()
+    return bot
+
+
+def seed_players(bot, user_ids):
+    conn = bot.get_db_connection()
+    cursor = conn.cursor()
+    for user_id in user_ids:
+        bot._load_user_tx(cursor, user_id, "bench", "Bench")
+    cursor.executemany(
+        bot.BACKEND.sql("UPDATE users SET coins = 0, energy = $1, max_energy = $2 WHERE user_id = $3"),
+        # max_energy is an INTEGER column.
+        [(2e9, 2 * 10**9, user_id) for user_id in user_ids],
+    )
+    conn.commit()
+    bot.close_db_connection(conn)
+
+
+def total_coins(bot, user_ids) -> float:
+    return sum(bot.get_user_row(user_id)[1] for user_id in user_ids)
+
+
+def run_mode(bot, mode: str, args) -> dict:
+    user_ids = [f"{mode}-{index}" for index in range(args.hot)]
+    seed_players(bot, user_ids)
+    process = {
+        "pessimistic": bot.process_user_actions,
+        "optimistic": bot.process_user_actions_optimistic,
+        "sql": bot.process_tap_batches,
+    }[mode]
+    driver = bot.BACKEND.driver
+    conflicts_before = bot.DB_OPTIMISTIC_CONFLICTS.value(driver)
+    fallbacks_before = bot.DB_OPTIMISTIC_FALLBACKS.value(driver)
+
+    latencies, earned, errors = [], [], []
+    lock = threading.Lock()
+
+    def worker(index: int):
+        local_latencies, local_earned = [], 0.0
+        for step in range(args.actions):
+            user_id = user_ids[(index + step) % len(user_ids)]
+            started = time.perf_counter()
+            try:
+                result = process(user_id, [("tap_batch", {"count": args.taps})])[0]
+            except Exception as e:
+                with lock:
+                    errors.append(repr(e))
+                continue
+            local_latencies.append(time.perf_counter() - started)
+            local_earned += result["event"].get("coins_earned", 0)
+        with lock:
+            latencies.extend(local_latencies)
+            earned.append(local_earned)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    stored = total_coins(bot, user_ids)
+    return {
+        **latency_summary(latencies, elapsed),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "conflicts": bot.DB_OPTIMISTIC_CONFLICTS.value(driver) - conflicts_before,
+        "fallbacks": bot.DB_OPTIMISTIC_FALLBACKS.value(driver) - fallbacks_before,
+        "coins_reported": sum(earned),
+        "coins_stored": stored,
+        "lost_updates": abs(stored - sum(earned)) > 1e-6 * max(1.0, stored),
+    }
+
+
+def run(args) -> dict:
+    bot = load_bot(args)
+    try:
+        modes = {mode: run_mode(bot, mode, args) for mode in args.modes}
+    finally:
+        bot.close_db_pools()
+    return {
+        "timestamp": int(time.time()),
+        "git_revision": git_revision(),
+        "config": {
+            "database": bot.BACKEND.dialect,
+            "threads": args.threads,
+            "hot": args.hot,
+            "actions": args.actions,
+            "taps": args.taps,
+            "pause_ms": args.pause_ms,
+            "retries": args.retries,
+        },
+        "modes": modes,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="", help="PostgreSQL DSN; a temporary SQLite file by default")
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--hot", type=int, default=4, help="players all threads act on")
+    parser.add_argument("--actions", type=int, default=200, help="actions per thread")
+    parser.add_argument("--taps", type=int, default=5, help="taps per tap_batch")
+    parser.add_argument("--pause-ms", type=float, default=0, help="stall inside the game computation")
+    parser.add_argument("--retries", type=int, default=5, help="DB_OPTIMISTIC_RETRIES")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["pessimistic", "optimistic", "sql"],
+        default=["pessimistic", "optimistic", "sql"],
+    )
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    print(f"{'mode':<12} {'actions/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'conflicts':>10} {'fallbacks':>10} {'errors':>7}  lost")
+    for mode, stats in results["modes"].items():
+        print(
+            f"{mode:<12} {stats['rps']:>10.1f} {stats['p50_ms']:>8.2f} {stats['p99_ms']:>8.2f} "
+            f"{stats['conflicts']:>10.0f} {stats['fallbacks']:>10.0f} {stats['errors']:>7}  "
+            f"{'YES' if stats['lost_updates'] else 'no'}"
+        )
+    write_results(
+        args.output or os.path.join(RESULTS_DIR, f"bench-contention-{results['timestamp']}.json"), results
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""Start-up time of the server, cold and warm.
+
+Each run starts `python bot.py` with polling disabled and measures the time
+until /api/leaderboard answers, i.e. until the schema is checked and the
+caches are loaded. "cold" runs start on a fresh SQLite file every time (all
+migrations apply), "warm" runs reuse one file (a single schema_version
+query). Separately it times `import bot` on its own and the import of aiogram,
+which only a process that runs the bot pays for now.
+
+--root points at another checkout to compare against, for example one made
+with `git worktree add /tmp/before <revision>`.
+
+    python tools/bench_startup.py --runs 5
+    python tools/bench_startup.py --runs 5 --root /tmp/before
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_workers import free_port, stop_server
+from common import RESULTS_DIR, ROOT, TEST_BOT_TOKEN, git_revision, sign_init_data, write_results
+
+
+def time_import(root: str, module: str) -> float:
+    code = f"import time; started = time.perf_counter(); import {module}; print(time.perf_counter() - started)"
+    env = dict(os.environ, BOT_TOKEN=TEST_BOT_TOKEN, PYTHONPATH=root)
+    output = subprocess.check_output([sys.executable, "-c", code], env=env, cwd=tempfile.gettempdir(), text=True)
+    return float(output.strip().splitlines()[-1])
+
+
+async def wait_ready(base_url: str, timeout_s: float) -> bool:
+    import aiohttp
+
+    headers = {"X-Telegram-Init-Data": sign_init_data(1, TEST_BOT_TOKEN)}
+    deadline = time.monotonic() + timeout_s
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f"{base_url}/api/leaderboard", headers=headers) as response:
+                    if response.status == 200:
+                        return True
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.01)
+    return False
+
+
+def time_start(root: str, sqlite_path: str, args) -> float:
+    port = free_port()
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TEST_BOT_TOKEN,
+        BOT_POLLING="0",
+        PORT=str(port),
+        WEB_WORKERS="1",
+        DATABASE_URL=args.database_url,
+        SQLITE_PATH=sqlite_path,
+    )
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(root, "bot.py")], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        if not asyncio.run(wait_ready(f"http://127.0.0.1:{port}", args.timeout)):
+            raise RuntimeError(f"{root}/bot.py did not start within {args.timeout} s")
+        return time.perf_counter() - started
+    finally:
+        stop_server(process)
+
+
+def summary(values) -> dict:
+    ordered = sorted(values)
+    return {"min_s": ordered[0], "median_s": ordered[len(ordered) // 2], "max_s": ordered[-1]}
+
+
+def run(args) -> dict:
+    root = os.path.abspath(args.root)
+    workdir = tempfile.mkdtemp(prefix="bench-startup-")
+    warm_path = os.path.join(workdir, "warm.db")
+    time_start(root, warm_path, args)
+
+    cold, warm, imports = [], [], []
+    for index in range(args.runs):
+        cold.append(time_start(root, os.path.join(workdir, f"cold-{index}.db"), args))
+        warm.append(time_start(root, warm_path, args))
+        imports.append(time_import(root, "bot"))
+
+    return {
+        "timestamp": int(time.time()),
+        "git_revision": git_revision(),
+        "config": {"root": root, "runs": args.runs, "database": "postgresql" if args.database_url else "sqlite"},
+        "import_bot": summary(imports),
+        "import_aiogram": summary([time_import(root, "aiogram") for _ in range(args.runs)]),
+        "cold_start": summary(cold),
+        "warm_start": summary(warm),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default=ROOT, help="checkout whose bot.py to start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database-url", default="", help="PostgreSQL DSN (cold runs then reuse it too)")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    for name in ("import_bot", "import_aiogram", "cold_start", "warm_start"):
+        stats = results[name]
+        print(
+            f"{name:<15} median {stats['median_s'] * 1000:8.1f} ms  "
+            f"min {stats['min_s'] * 1000:8.1f} ms  max {stats['max_s'] * 1000:8.1f} ms"
+        )
+    write_results(args.output or os.path.join(RESULTS_DIR, f"bench-startup-{results['timestamp']}.json"), results)
+
+
+if __name__ == "__main__":
+    main()
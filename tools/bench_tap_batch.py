@@ -0,0 +1,48 @@
+"""Microbenchmark for the closed-form tap batch.
+
+Times game.evaluate_tap_batch against the per-tap loop it replaced (kept in
+tests/test_game.py, which checks that both give the same results).
+
+    python tools/bench_tap_batch.py [--repeat 5] [--number 20000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from game import MAX_CLICKS_PER_SECOND, MAX_TAP_BATCH, evaluate_tap_batch  # noqa: E402
+from tests.test_game import per_tap_loop  # noqa: E402
+
+
+def bench(repeat: int, number: int):
+    now = 1_700_000_000_000
+    base = {"coins": 0.0, "energy": 5000.0, "multi_tap_level": 3, "ban_end_time": 0, "tap_window_start": 0, "tap_count": 0}
+    rng = random.Random(1)
+    print(f"{'taps':>5} {'legacy us':>10} {'exact us':>10} {'binomial us':>12}")
+    for taps in (1, 10, MAX_CLICKS_PER_SECOND, MAX_TAP_BATCH):
+        timings = []
+        for func in (
+            lambda: per_tap_loop(dict(base), taps, now, rng),
+            lambda: evaluate_tap_batch(dict(base), taps, now, rng, sampling="exact"),
+            lambda: evaluate_tap_batch(dict(base), taps, now, rng, sampling="binomial"),
+        ):
+            best = min(timeit.repeat(func, repeat=repeat, number=number))
+            timings.append(best / number * 1e6)
+        print(f"{taps:>5} {timings[0]:>10.2f} {timings[1]:>10.2f} {timings[2]:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    bench(args.repeat, args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Throughput of the multi-process mode (WEB_WORKERS) for several worker counts.
+
+For every value of --workers the script starts `python bot.py` with that many
+web workers on a fresh temporary SQLite file (polling disabled), runs the
+loadtest players against it for --duration seconds and stops it again, so the
+counts are compared on the same workload. Scaling only shows up on a machine
+with at least as many free cores as workers.
+
+    python tools/bench_workers.py --workers 1 2 4 --users 400 --duration 30
+    STATE_STORE=1 python tools/bench_workers.py --workers 1 4
+"""
+
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import RESULTS_DIR, ROOT, TEST_BOT_TOKEN, git_revision, sign_init_data, write_results
+from loadtest import parse_args as loadtest_args
+from loadtest import run as run_loadtest
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(base_url: str, bot_token: str, timeout_s: float = 30):
+    import aiohttp
+
+    deadline = time.monotonic() + timeout_s
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(
+                    f"{base_url}/api/leaderboard", headers={"X-Telegram-Init-Data": sign_init_data(1, bot_token)}
+                ) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.3)
+    raise RuntimeError(f"server at {base_url} did not start")
+
+
+def start_server(workers: int, port: int, args) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        BOT_TOKEN=args.bot_token,
+        BOT_POLLING="0",
+        PORT=str(port),
+        WEB_WORKERS=str(workers),
+        WORKER_BASE_PORT=str(free_port()),
+        DATABASE_URL="",
+        SQLITE_PATH=os.path.join(tempfile.mkdtemp(prefix="bench-workers-"), "users.db"),
+    )
+    env.pop("WEB_WORKER_INDEX", None)
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")], env=env, stdout=subprocess.DEVNULL)
+
+
+def stop_server(process: subprocess.Popen):
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=40)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+async def measure(workers: int, args) -> dict:
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    process = start_server(workers, port, args)
+    try:
+        await wait_ready(base_url, args.bot_token)
+        load_args = loadtest_args(
+            [
+                "--url", base_url,
+                "--bot-token", args.bot_token,
+                "--users", str(args.users),
+                "--duration", str(args.duration),
+                "--tap-rate", str(args.tap_rate),
+                "--flush-ms", str(args.flush_ms),
+            ]
+        )
+        return await run_loadtest(load_args)
+    finally:
+        stop_server(process)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--bot-token", default=TEST_BOT_TOKEN)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--tap-rate", type=float, default=8.0)
+    parser.add_argument("--flush-ms", type=int, default=120)
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    runs = {}
+    for workers in args.workers:
+        runs[str(workers)] = asyncio.run(measure(workers, args))["total"]
+
+    print(f"{'workers':<8} {'count':>7} {'rps':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for workers, total in runs.items():
+        print(
+            f"{workers:<8} {total['count']:>7} {total['rps']:>8.1f} "
+            f"{total['p50_ms']:>8.2f} {total['p99_ms']:>8.2f} {total['errors']:>7}"
+        )
+
+    results = {
+        "timestamp": int(time.time()),
+        "git_revision": git_revision(),
+        "config": {
+            "cpus": os.cpu_count(),
+            "state_store": os.getenv("STATE_STORE", "0"),
+            "users": args.users,
+            "duration_s": args.duration,
+        },
+        "workers": runs,
+    }
+    write_results(args.output or os.path.join(RESULTS_DIR, f"bench-workers-{results['timestamp']}.json"), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Action latency over WebSocket (/ws) versus REST (POST /api/action).
+
+Every client sends --actions tap_batch actions one after another, --pause-ms
+apart (below the autoclick limit), first over REST and then over one
+authenticated WebSocket, and the per-action round-trip times are compared.
+The server runs in-process on a temporary SQLite file unless --url is given.
+
+    python tools/bench_ws.py --clients 50 --actions 100
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+
+from common import RESULTS_DIR, TEST_BOT_TOKEN, git_revision, latency_summary, sign_init_data, write_results
+from loadtest import start_in_process_server
+
+
+async def rest_client(session, base_url: str, user_id: int, args, latencies: list):
+    headers = {"X-Telegram-Init-Data": sign_init_data(user_id, args.bot_token), "Content-Type": "application/json"}
+    url = f"{base_url}/api/action/{user_id}"
+    body = json.dumps({"action": "tap_batch", "count": 1})
+    for _ in range(args.actions):
+        started = time.perf_counter()
+        async with session.post(url, data=body, headers=headers) as response:
+            await response.read()
+            if response.status != 200:
+                raise RuntimeError(f"REST {response.status}")
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(args.pause_ms / 1000)
+
+
+async def ws_client(session, base_url: str, user_id: int, args, latencies: list):
+    async with session.ws_connect(f"{base_url}/ws") as ws:
+        await ws.send_str(json.dumps({"type": "auth", "init_data": sign_init_data(user_id, args.bot_token)}))
+        hello = json.loads((await ws.receive()).data)
+        if hello.get("type") != "state":
+            raise RuntimeError(f"WebSocket auth failed: {hello}")
+        for index in range(args.actions):
+            started = time.perf_counter()
+            await ws.send_str(json.dumps({"type": "action", "id": index, "action": "tap_batch", "count": 1}))
+            while True:
+                frame = json.loads((await ws.receive()).data)
+                if frame.get("id") == index:
+                    break
+            latencies.append(time.perf_counter() - started)
+            await asyncio.sleep(args.pause_ms / 1000)
+
+
+async def measure(client, session, base_url: str, args, first_user_id: int) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(client(session, base_url, first_user_id + index, args, latencies) for index in range(args.clients))
+    )
+    return latency_summary(latencies, time.perf_counter() - started)
+
+
+async def run(args) -> dict:
+    import aiohttp
+
+    stop = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        base_url, _, stop = await start_in_process_server(args)
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            # Separate users per transport so neither inherits the other's tap window.
+            rest = await measure(rest_client, session, base_url, args, args.first_user_id)
+            ws = await measure(ws_client, session, base_url, args, args.first_user_id + args.clients)
+    finally:
+        if stop is not None:
+            await stop()
+
+    return {
+        "timestamp": int(time.time()),
+        "git_revision": git_revision(),
+        "config": {
+            "backend": "external" if args.url else args.backend,
+            "driver": args.driver,
+            "state_store": os.getenv("STATE_STORE", "0"),
+            "clients": args.clients,
+            "actions": args.actions,
+            "pause_ms": args.pause_ms,
+        },
+        "rest": rest,
+        "ws": ws,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="benchmark a running server instead of starting one in-process")
+    parser.add_argument("--backend", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--driver", choices=["sync", "async", "memory"], default=os.getenv("DB_DRIVER", "sync"))
+    parser.add_argument("--database-url", default="")
+    parser.add_argument("--bot-token", default=TEST_BOT_TOKEN)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--actions", type=int, default=100, help="actions per client and transport")
+    parser.add_argument("--pause-ms", type=int, default=60)
+    parser.add_argument("--first-user-id", type=int, default=20_000_000)
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print(f"{'transport':<10} {'count':>7} {'rps':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for transport in ("rest", "ws"):
+        summary = results[transport]
+        print(
+            f"{transport:<10} {summary['count']:>7} {summary['rps']:>8.1f} "
+            f"{summary['p50_ms']:>8.2f} {summary['p99_ms']:>8.2f}"
+        )
+    output = args.output or os.path.join(RESULTS_DIR, f"bench-ws-{results['config']['backend']}-{results['timestamp']}.json")
+    write_results(output, results)
+
+
+if __name__ == "__main__":
+    main()
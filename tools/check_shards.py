@@ -0,0 +1,164 @@
+"""Checks the sharding layer on local SQLite files.
+
+Creates --shards SQLite files (schema through migrations.py), then runs the
+same seeded mix of new players, actions, admin changes and blocked flags
+against sharding.ShardedStorage and storage.MemoryStorage as the reference.
+It compares everything that is answered by scatter-gather: every /users
+page forwards and backwards, the leaderboard's coins, the totals and the
+broadcast recipient walk. It also reports the number of players per shard
+and the share of players that would move if one more shard were appended.
+
+    python tools/check_shards.py --shards 4 --users 5000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from common import RESULTS_DIR, git_revision, write_results
+
+from migrations import migrate
+from sharding import HashRing, create_sharded_storage
+from storage import MemoryStorage
+
+
+async def users_walk(db, page_size: int):
+    pages, cursor = [], None
+    while True:
+        rows = [tuple(row) for row in await db.get_users_page(cursor, "next", page_size)]
+        if not rows:
+            break
+        pages.append(rows)
+        cursor = (rows[-1][2], rows[-1][0])
+    backwards, cursor = [], (pages[-1][0][2], pages[-1][0][0]) if pages else None
+    while cursor is not None:
+        rows = [tuple(row) for row in await db.get_users_page(cursor, "prev", page_size)]
+        if not rows:
+            break
+        backwards.append(rows)
+        cursor = (rows[-1][2], rows[-1][0])
+    return pages, backwards
+
+
+async def recipients_walk(db, chunk: int):
+    recipients, after = [], ""
+    while True:
+        batch = await db.get_broadcast_recipients(after, chunk)
+        if not batch:
+            return recipients
+        recipients += batch
+        after = batch[-1]
+
+
+async def apply_workload(databases, users: int, actions: int, seed: int):
+    rng = random.Random(seed)
+    user_ids = [str(1_000_000 + index) for index in range(users)]
+    for user_id in user_ids:
+        for db in databases:
+            await db.get_user_data(user_id, "load", f"P{user_id}")
+    for _ in range(actions):
+        user_id = rng.choice(user_ids)
+        coins = rng.choice((1, 5, 5, 10, 250))
+        for db in databases:
+            await db.give_coins([user_id], coins)
+        if rng.random() < 0.2:
+            for db in databases:
+                await db.process_user_action(user_id, "upgrade_multitap")
+    blocked = rng.sample(user_ids, max(1, users // 20))
+    banned = rng.sample(user_ids, max(1, users // 50))
+    for db in databases:
+        await db.set_users_blocked(blocked, True)
+        await db.ban_users(banned, 1)
+
+
+async def run_checks(args, paths: list[str]) -> dict:
+    sharded = create_sharded_storage(paths, 1, 4, 100, 5)
+    reference = MemoryStorage()
+    await sharded.connect()
+    try:
+        started = time.perf_counter()
+        await apply_workload((sharded, reference), args.users, args.actions, args.seed)
+        workload_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        pages = await users_walk(sharded, args.page_size)
+        pages_s = time.perf_counter() - started
+        checks = {
+            "users_pages": pages == await users_walk(reference, args.page_size),
+            "leaderboard_coins": [entry["coins"] for entry in await sharded.get_leaderboard()]
+            == [entry["coins"] for entry in await reference.get_leaderboard()],
+            "aggregates": await sharded.get_aggregates() == await reference.get_aggregates(),
+            "aggregate_drift": await sharded.get_aggregate_drift() == [],
+            "broadcast_recipients": await recipients_walk(sharded, args.page_size)
+            == await recipients_walk(reference, args.page_size),
+        }
+    finally:
+        await sharded.close()
+    return {"checks": checks, "workload_s": workload_s, "users_walk_s": pages_s, "pages": len(pages[0])}
+
+
+def ring_movement(shards: int, users: int) -> float:
+    before, after = HashRing(shards), HashRing(shards + 1)
+    user_ids = [str(1_000_000 + index) for index in range(users)]
+    return sum(before.shard(user_id) != after.shard(user_id) for user_id in user_ids) / users
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="check-shards-")
+    paths = [os.path.join(workdir, f"shard-{index}.db") for index in range(args.shards)]
+    for path in paths:
+        conn = sqlite3.connect(path)
+        migrate(conn, "sqlite", sqlite3.OperationalError)
+        conn.close()
+
+    results = asyncio.run(run_checks(args, paths))
+    per_shard = []
+    for path in paths:
+        conn = sqlite3.connect(path)
+        per_shard.append(conn.execute("SELECT COUNT(*) FROM users").fetchone()[0])
+        conn.close()
+    results.update(
+        {
+            "timestamp": int(time.time()),
+            "git_revision": git_revision(),
+            "config": {"shards": args.shards, "users": args.users, "actions": args.actions, "seed": args.seed},
+            "users_per_shard": per_shard,
+            "moved_on_append": ring_movement(args.shards, args.users),
+        }
+    )
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--actions", type=int, default=5000)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    for name, passed in results["checks"].items():
+        print(f"{name:<22} {'ok' if passed else 'MISMATCH'}")
+    print(f"players per shard: {results['users_per_shard']}")
+    print(
+        f"appending shard {args.shards + 1} would move {results['moved_on_append']:.1%} of players "
+        f"(ideal {1 / (args.shards + 1):.1%})"
+    )
+    print(f"/users walk over {results['pages']} pages: {results['users_walk_s'] * 1000:.1f} ms")
+    write_results(args.output or os.path.join(RESULTS_DIR, f"check-shards-{results['timestamp']}.json"), results)
+    if not all(results["checks"].values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
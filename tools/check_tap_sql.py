@@ -0,0 +1,226 @@
+"""Checks the SQL tap path (DB_TAP_SQL, tap_sql.py) against game.py.
+
+Runs --cases tap actions against --players players, each time through the
+dialect's statement (the UPSERT on SQLite, apply_tap_batch() on PostgreSQL)
+and through game.py's rules on the row as it was before. Before a case the
+player's row is often rewritten with random coins, fractional or empty
+energy, a stale or future last_update, an active or expired ban and a full
+or fresh rate window; otherwise successive cases continue from the state the
+previous batch left, so rate windows fill up and autoclick bans are issued.
+Some cases go to players that do not exist yet. Both combo samplings are
+covered, with the same seeded draws on both sides.
+
+Compares the event the action returns exactly, and the player data it returns
+and the row stored afterwards exactly on SQLite and to float precision on
+PostgreSQL, which keeps coins and energy in REAL columns: the function computes
+from the stored float4 while psycopg2 reads its shortest decimal. Then times
+the statement alone.
+
+Runs on a temporary SQLite file by default, or on PostgreSQL with
+--database-url (a scratch database: migrations are applied and players named
+tapcheck-* are written).
+
+    python tools/check_tap_sql.py --cases 20000
+    python tools/check_tap_sql.py --database-url postgresql://... --cases 5000
+"""
+
+import argparse
+import math
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from common import RESULTS_DIR, git_revision, write_results
+
+import game
+from game import DEFAULT_FIRST_NAME, DEFAULT_USERNAME, apply_action, apply_identity, apply_passive_progress, row_to_data
+from migrations import migrate
+from storage import FETCH_USER, PG_PLACEHOLDER, PG_TAP_BATCH, SQLITE_TAP_BATCH
+from tap_sql import TapBatch
+from user_record import FIELDS
+
+BASE_NOW = 1_700_000_000_000
+STATE_UPDATE = """
+    UPDATE users SET
+        coins = $1,
+        energy = $2,
+        max_energy = $3,
+        multi_tap_level = $4,
+        last_update = $5,
+        ban_end_time = $6,
+        tap_window_start = $7,
+        tap_count = $8
+    WHERE user_id = $9
+"""
+
+
+def connect(args):
+    # (connection, placeholder, tap statement); statements autocommit.
+    if args.database_url:
+        import psycopg2
+        import psycopg2.errors
+
+        conn = psycopg2.connect(args.database_url)
+        conn.autocommit = True
+        migrate(conn, "postgresql", psycopg2.errors.UndefinedTable)
+        conn.cursor().execute("DELETE FROM users WHERE user_id LIKE 'tapcheck-%'")
+        return conn, "%s", PG_TAP_BATCH
+    path = os.path.join(tempfile.mkdtemp(prefix="check-tap-sql-"), "users.db")
+    conn = sqlite3.connect(path, isolation_level=None)
+    migrate(conn, "sqlite", sqlite3.OperationalError)
+    return conn, "?", SQLITE_TAP_BATCH
+
+
+def random_state(rng, now: int) -> tuple:
+    return (
+        round(rng.uniform(0, 5000), 3),
+        rng.choice((0, 0.4, 1, 3.75, 19.5, 49.99, 500, 1000, 1500.25)),
+        rng.choice((1000, 1500, 2000)),
+        rng.randint(1, 5),
+        now - rng.choice((0, 0, 1, 250, 999, 1000, 60_000, now)) + rng.choice((0, 0, 0, 5)),
+        rng.choice((0, 0, 0, now - 1, now, now + 1, now + 90_000)),
+        now - rng.choice((0, 1, 500, 999, 1000, 1001, 30_000)),
+        rng.choice((0, 1, 5, 19, 20, 21, 40)),
+    )
+
+
+def expected(row, user_id: str, username, first_name, now: int, action: str, payload, draws: random.Random):
+    # resolve_action on the row as stored, or as INSERT_USER would create it.
+    if row is None:
+        row = (user_id, 0.0, 1000.0, 1000, 1, 1, 0, False, now, username or DEFAULT_USERNAME, first_name or DEFAULT_FIRST_NAME, 0, 0, 0)
+    data = row_to_data(row)
+    apply_identity(data, username, first_name)
+    apply_passive_progress(data, now)
+    event = apply_action(data, action, payload, now, draws)
+    return event, dict(data)
+
+
+def same_values(stored: dict, data: dict) -> bool:
+    for name in FIELDS:
+        if isinstance(data[name], float):
+            if not math.isclose(stored[name], data[name], rel_tol=1e-6, abs_tol=1e-6):
+                return False
+        elif stored[name] != data[name]:
+            return False
+    return True
+
+
+def run_cases(args, conn, placeholder: str, tap_query: str) -> dict:
+    exact = not args.database_url
+    rng = random.Random(args.seed)
+    cursor = conn.cursor()
+    tap_sql = PG_PLACEHOLDER.sub(placeholder, tap_query)
+    fetch_sql = PG_PLACEHOLDER.sub(placeholder, FETCH_USER)
+    state_sql = PG_PLACEHOLDER.sub(placeholder, STATE_UPDATE)
+    players = [f"tapcheck-{index}" for index in range(args.players)]
+    counts = {"cases": 0, "new_players": 0, "event_mismatches": 0, "data_mismatches": 0, "stored_mismatches": 0}
+    statuses, mismatches = {}, []
+    now = BASE_NOW
+    sampling = game.COMBO_SAMPLING
+    try:
+        for case in range(args.cases):
+            game.COMBO_SAMPLING = ("exact", "binomial")[case % 2]
+            now += rng.choice((0, 1, 40, 120, 400, 1000, 2500))
+            if rng.random() < 0.05:
+                user_id = f"tapcheck-new-{case}"
+                counts["new_players"] += 1
+            else:
+                user_id = rng.choice(players)
+            cursor.execute(fetch_sql, (user_id,))
+            row = cursor.fetchone()
+            if row is not None and rng.random() < 0.4:
+                cursor.execute(state_sql, random_state(rng, now) + (user_id,))
+                cursor.execute(fetch_sql, (user_id,))
+                row = cursor.fetchone()
+            username = rng.choice((None, "", "tapper"))
+            first_name = rng.choice((None, "", "Tap"))
+            action = rng.choice(("tap_batch", "tap_batch", "tap_batch", "tap"))
+            payload = {"count": rng.choice((1, 2, 5, 19, 20, 21, 50, 80, "x"))} if action == "tap_batch" else None
+            seed = rng.random()
+
+            event, data = expected(row, user_id, username, first_name, now, action, payload, random.Random(seed))
+            batch = TapBatch(user_id, action, payload, username, first_name, now, random.Random(seed))
+            cursor.execute(tap_sql, batch.params)
+            result = batch.result(cursor.fetchone())
+            cursor.execute(fetch_sql, (user_id,))
+            stored = cursor.fetchone()
+
+            counts["cases"] += 1
+            statuses[event["status"]] = statuses.get(event["status"], 0) + 1
+            problems = []
+            if result["event"] != event:
+                counts["event_mismatches"] += 1
+                problems.append("event")
+            if not (result["data"] == data if exact else same_values(result["data"], data)):
+                counts["data_mismatches"] += 1
+                problems.append("data")
+            if not same_values(row_to_data(stored), data):
+                counts["stored_mismatches"] += 1
+                problems.append("stored")
+            if problems and len(mismatches) < 10:
+                mismatches.append(
+                    {"case": case, "problems": problems, "before": row and list(row), "expected": [event, data],
+                     "got": [result["event"], result["data"]]}
+                )
+
+        started = time.perf_counter()
+        for index in range(args.timed):
+            batch = TapBatch(players[index % len(players)], "tap_batch", {"count": 5}, None, None, now + index * 1000)
+            cursor.execute(tap_sql, batch.params)
+            cursor.fetchone()
+        timed_s = time.perf_counter() - started
+    finally:
+        game.COMBO_SAMPLING = sampling
+    return {**counts, "statuses": statuses, "mismatches": mismatches, "statement_ms": timed_s * 1000 / max(1, args.timed)}
+
+
+def run(args) -> dict:
+    conn, placeholder, tap_query = connect(args)
+    try:
+        results = run_cases(args, conn, placeholder, tap_query)
+    finally:
+        conn.close()
+    results.update(
+        {
+            "timestamp": int(time.time()),
+            "git_revision": git_revision(),
+            "config": {
+                "database": "postgresql" if args.database_url else "sqlite",
+                "cases": args.cases,
+                "players": args.players,
+                "seed": args.seed,
+            },
+        }
+    )
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default="", help="PostgreSQL DSN; a temporary SQLite file by default")
+    parser.add_argument("--cases", type=int, default=10000)
+    parser.add_argument("--players", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timed", type=int, default=2000, help="statements to time after the checks")
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    print(f"cases: {results['cases']} ({results['new_players']} new players), statuses: {results['statuses']}")
+    for name in ("event_mismatches", "data_mismatches", "stored_mismatches"):
+        print(f"{name:<18} {results[name]}")
+    for mismatch in results["mismatches"][:3]:
+        print(mismatch)
+    print(f"one tap batch statement: {results['statement_ms']:.3f} ms")
+    write_results(args.output or os.path.join(RESULTS_DIR, f"check-tap-sql-{results['timestamp']}.json"), results)
+    if any(results[name] for name in ("event_mismatches", "data_mismatches", "stored_mismatches")):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
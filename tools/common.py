@@ -0,0 +1,68 @@
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+TEST_BOT_TOKEN = "123456:TEST-LOADTEST-TOKEN"
+# Default place for result files, ignored by git wherever the tool runs from.
+RESULTS_DIR = os.path.join(ROOT, "bench_results")
+
+
+def sign_init_data(user_id: int, bot_token: str = TEST_BOT_TOKEN, auth_date: int | None = None) -> str:
+    # Builds a WebApp initData string the way Telegram signs it.
+    user = json.dumps(
+        {"id": int(user_id), "first_name": f"Bot{user_id}", "username": f"load_{user_id}"},
+        separators=(",", ":"),
+    )
+    pairs = {
+        "auth_date": str(auth_date or int(time.time())),
+        "query_id": f"AAH{user_id}",
+        "user": user,
+    }
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(pairs.items()))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
+    pairs["hash"] = hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
+    return urlencode(pairs)
+
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def latency_summary(latencies_s, elapsed_s: float) -> dict:
+    return {
+        "count": len(latencies_s),
+        "rps": len(latencies_s) / elapsed_s if elapsed_s > 0 else 0.0,
+        "p50_ms": percentile(latencies_s, 50) * 1000,
+        "p90_ms": percentile(latencies_s, 90) * 1000,
+        "p99_ms": percentile(latencies_s, 99) * 1000,
+        "max_ms": max(latencies_s) * 1000 if latencies_s else 0.0,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def write_results(path: str, results: dict):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"results written to {path}")
@@ -0,0 +1,223 @@
+"""Fake Telegram for testing webhook mode locally.
+
+Starts a fake Bot API server (answers sendMessage, setWebhook, getMe, ... with
+minimal valid results after --api-delay-ms) and POSTs --updates /start
+messages to the bot's webhook, --concurrency at a time, with the secret
+token header. Reports webhook response latency, how long it took until every
+update had been answered through the fake API, and the highest number of Bot
+API calls in flight at once (bounded by WEBHOOK_MAX_IN_FLIGHT).
+
+By default the bot runs in-process on a temporary SQLite file. To drive a
+running server, start it with TELEGRAM_API_URL=http://127.0.0.1:<api-port>
+and WEBHOOK_BASE_URL set, then pass --url, --api-port and --secret.
+
+    python tools/fake_telegram.py --updates 2000 --concurrency 40 --api-delay-ms 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from common import RESULTS_DIR, TEST_BOT_TOKEN, git_revision, latency_summary, write_results
+
+
+class FakeBotAPI:
+    def __init__(self, delay_ms: int):
+        self.delay = delay_ms / 1000
+        self.calls: dict[str, int] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.replies = 0
+        self.replied = asyncio.Event()
+        self.expected_replies = 0
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif method.startswith("send") or method.startswith("edit"):
+            result = {
+                "message_id": self.calls[method],
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+            self.replies += 1
+            if self.replies >= self.expected_replies > 0:
+                self.replied.set()
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port: int):
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", port)
+        await site.start()
+        return runner, site._server.sockets[0].getsockname()[1]
+
+
+def start_update(update_id: int, user_id: int) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"Bot{user_id}", "username": f"load_{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+async def start_in_process_bot(args, api_port: int):
+    os.environ["BOT_TOKEN"] = args.bot_token
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{api_port}"
+    os.environ["WEBHOOK_BASE_URL"] = "http://127.0.0.1"
+    os.environ["DATABASE_URL"] = ""
+    os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="fake-telegram-"), "users.db")
+
+    from aiohttp import web
+
+    import bot
+
+    await bot.ensure_db_ready()
+    bot.bot = bot.create_bot()
+    await bot._start_webhook()
+
+    runner = web.AppRunner(bot.create_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    async def stop():
+        await runner.cleanup()
+        await bot.shutdown()
+
+    return f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}", bot.WEBHOOK_SECRET, stop
+
+
+async def run(args) -> dict:
+    import aiohttp
+
+    api = FakeBotAPI(args.api_delay_ms)
+    api.expected_replies = args.updates
+    api_runner, api_port = await api.start(args.api_port)
+
+    stop = None
+    if args.url:
+        webhook_url, secret = args.url, args.secret
+    else:
+        webhook_url, secret, stop = await start_in_process_bot(args, api_port)
+
+    latencies = []
+    statuses: dict[str, int] = {}
+    queue = asyncio.Queue()
+    for index in range(args.updates):
+        queue.put_nowait(start_update(index + 1, args.first_user_id + index % args.users))
+
+    async def sender(session):
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.perf_counter()
+            async with session.post(
+                webhook_url,
+                data=json.dumps(update),
+                headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+            ) as response:
+                await response.read()
+                statuses[str(response.status)] = statuses.get(str(response.status), 0) + 1
+            latencies.append(time.perf_counter() - started)
+
+    try:
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+            async with session.post(webhook_url, json=start_update(0, 1), headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as response:
+                wrong_secret_status = response.status
+
+            started = time.perf_counter()
+            await asyncio.gather(*(sender(session) for _ in range(args.concurrency)))
+            sent_s = time.perf_counter() - started
+            try:
+                await asyncio.wait_for(api.replied.wait(), timeout=args.timeout)
+            except asyncio.TimeoutError:
+                pass
+            answered_s = time.perf_counter() - started
+    finally:
+        if stop is not None:
+            await stop()
+        await api_runner.cleanup()
+
+    return {
+        "timestamp": int(time.time()),
+        "git_revision": git_revision(),
+        "config": {
+            "updates": args.updates,
+            "concurrency": args.concurrency,
+            "api_delay_ms": args.api_delay_ms,
+            "max_in_flight": os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"),
+        },
+        "wrong_secret_status": wrong_secret_status,
+        "statuses": statuses,
+        "webhook": latency_summary(latencies, sent_s),
+        "replies": api.replies,
+        "answered_s": answered_s,
+        "api_calls": api.calls,
+        "api_max_in_flight": api.max_in_flight,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="webhook URL of a running server instead of starting one in-process")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET of the server given with --url")
+    parser.add_argument("--api-port", type=int, default=0)
+    parser.add_argument("--api-delay-ms", type=int, default=20, help="simulated Bot API latency")
+    parser.add_argument("--bot-token", default=TEST_BOT_TOKEN)
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--first-user-id", type=int, default=30_000_000)
+    parser.add_argument("--concurrency", type=int, default=40, help="Telegram's max_connections")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    webhook = results["webhook"]
+    print(f"wrong secret: HTTP {results['wrong_secret_status']}, statuses: {results['statuses']}")
+    print(
+        f"webhook: {webhook['count']} updates, {webhook['rps']:.1f}/s, "
+        f"p50 {webhook['p50_ms']:.2f} ms, p99 {webhook['p99_ms']:.2f} ms"
+    )
+    print(
+        f"answered {results['replies']}/{args.updates} in {results['answered_s']:.2f} s, "
+        f"Bot API calls in flight at most {results['api_max_in_flight']}"
+    )
+    write_results(args.output or os.path.join(RESULTS_DIR, f"fake-telegram-{results['timestamp']}.json"), results)
+
+
+if __name__ == "__main__":
+    main()
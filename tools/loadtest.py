@@ -0,0 +1,355 @@
+"""Load generator for the mini app API.
+
+Synthetic players behave like script.js: they tap at a steady rate, flush
+the pending taps as one tap_batch every --flush-ms (never two in flight),
+poll /api/user, open the leaderboard and buy upgrades now and then. Every
+request carries initData signed with a test BOT_TOKEN.
+
+By default the server runs in-process on a temporary SQLite file, which also
+lets the harness count database round-trips per request. Use --backend
+postgres with --database-url (or DATABASE_URL) for PostgreSQL, or --url to
+drive an already running server started with the same --bot-token.
+--driver memory keeps all players in process memory (storage.MemoryStorage),
+a baseline without any database I/O.
+
+    python tools/loadtest.py --users 200 --duration 30
+    python tools/loadtest.py --driver memory --users 200 --duration 30
+    python tools/loadtest.py --backend postgres --driver async --output bench_results/pg.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from contextlib import asynccontextmanager
+
+from common import RESULTS_DIR, TEST_BOT_TOKEN, git_revision, latency_summary, sign_init_data, write_results
+
+
+class RoundTripCounter:
+    def __init__(self):
+        self.count = 0
+
+
+class _CountingCursor:
+    def __init__(self, cursor, counter: RoundTripCounter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        self._counter.count += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingConnection:
+    def __init__(self, conn, counter: RoundTripCounter):
+        self._conn = conn
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(self._conn.cursor(*args, **kwargs), self._counter)
+
+    def commit(self):
+        self._counter.count += 1
+        return self._conn.commit()
+
+    def rollback(self):
+        self._counter.count += 1
+        return self._conn.rollback()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+class _CountingAsyncConnection:
+    def __init__(self, conn, counter: RoundTripCounter):
+        self._conn = conn
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if name not in ("fetchrow", "fetch", "fetchval", "execute", "executemany"):
+            return attr
+
+        async def counted(*args, **kwargs):
+            self._counter.count += 1
+            return await attr(*args, **kwargs)
+
+        return counted
+
+
+def install_round_trip_counter(bot) -> RoundTripCounter:
+    counter = RoundTripCounter()
+    get_db_connection = bot.get_db_connection
+    close_db_connection = bot.close_db_connection
+
+    def counting_get_db_connection():
+        return _CountingConnection(get_db_connection(), counter)
+
+    def counting_close_db_connection(conn):
+        close_db_connection(getattr(conn, "_conn", conn))
+
+    bot.get_db_connection = counting_get_db_connection
+    bot.close_db_connection = counting_close_db_connection
+
+    db = bot.DB
+    if hasattr(db, "transaction") and hasattr(db, "connection"):
+        connection = db.connection
+        transaction = db.transaction
+
+        @asynccontextmanager
+        async def counting_connection():
+            async with connection() as conn:
+                yield _CountingAsyncConnection(conn, counter)
+
+        def counting_transaction(conn):
+            counter.count += 2  # BEGIN and COMMIT
+            return transaction(getattr(conn, "_conn", conn))
+
+        db.connection = counting_connection
+        db.transaction = counting_transaction
+
+    writer = bot.BACKEND.writer
+    if writer is not None:
+        submit = writer.submit
+        commit = writer._commit
+
+        def counting_submit(fn, *args):
+            def counted(cursor, *fn_args):
+                return fn(_CountingCursor(cursor, counter), *fn_args)
+
+            return submit(counted, *args)
+
+        def counting_commit(cursor, tasks):
+            counter.count += 2  # BEGIN and COMMIT, shared by the whole batch
+            return commit(cursor, tasks)
+
+        writer.submit = counting_submit
+        writer._commit = counting_commit
+    return counter
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.statuses: dict[str, int] = {}
+
+    def record(self, endpoint: str, latency: float, status: int):
+        self.latencies.setdefault(endpoint, []).append(latency)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        if status >= 400:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+
+async def timed_request(session, stats: Stats, endpoint: str, method: str, url: str, **kwargs):
+    started = time.perf_counter()
+    try:
+        async with session.request(method, url, **kwargs) as response:
+            body = await response.read()
+            status = response.status
+    except Exception:
+        body = None
+        status = 599
+    stats.record(endpoint, time.perf_counter() - started, status)
+    return status, body
+
+
+async def run_player(session, base_url: str, user_id: int, args, stats: Stats, deadline: float):
+    headers = {"X-Telegram-Init-Data": sign_init_data(user_id, args.bot_token), "Content-Type": "application/json"}
+    rng = random.Random(user_id)
+    action_url = f"{base_url}/api/action/{user_id}"
+    user_url = f"{base_url}/api/user/{user_id}"
+    leaderboard_url = f"{base_url}/api/leaderboard"
+
+    await asyncio.sleep(rng.random() * args.flush_ms / 1000)
+    await timed_request(session, stats, "GET /api/user", "GET", user_url, headers=headers)
+
+    flush_interval = args.flush_ms / 1000
+    last_flush = time.monotonic()
+    next_poll = last_flush + args.poll_s
+    next_leaderboard = last_flush + rng.uniform(0, args.leaderboard_s * 2)
+    next_buy = last_flush + rng.uniform(0, args.buy_s * 2)
+    pending = 0.0
+
+    while time.monotonic() < deadline:
+        await asyncio.sleep(flush_interval)
+        now = time.monotonic()
+        pending += (now - last_flush) * args.tap_rate
+        last_flush = now
+
+        taps = int(pending)
+        if taps > 0:
+            pending -= taps
+            await timed_request(
+                session,
+                stats,
+                "POST /api/action tap_batch",
+                "POST",
+                action_url,
+                headers=headers,
+                data=json.dumps({"action": "tap_batch", "count": min(taps, 100)}),
+            )
+
+        if now >= next_poll:
+            next_poll = now + args.poll_s
+            await timed_request(session, stats, "GET /api/user", "GET", user_url, headers=headers)
+        if now >= next_leaderboard:
+            next_leaderboard = now + rng.uniform(0, args.leaderboard_s * 2)
+            await timed_request(session, stats, "GET /api/leaderboard", "GET", leaderboard_url, headers=headers)
+        if now >= next_buy:
+            next_buy = now + rng.uniform(0, args.buy_s * 2)
+            action = rng.choice(["buy_multitap", "buy_energy", "buy_skin"])
+            await timed_request(
+                session,
+                stats,
+                "POST /api/action buy",
+                "POST",
+                action_url,
+                headers=headers,
+                data=json.dumps({"action": action}),
+            )
+
+
+async def start_in_process_server(args):
+    os.environ["BOT_TOKEN"] = args.bot_token
+    os.environ["DB_DRIVER"] = args.driver
+    if args.backend == "postgres":
+        database_url = args.database_url or os.getenv("DATABASE_URL", "")
+        if not database_url:
+            raise SystemExit("--backend postgres needs --database-url or DATABASE_URL")
+        os.environ["DATABASE_URL"] = database_url
+    else:
+        os.environ["DATABASE_URL"] = ""
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="loadtest-"), "users.db")
+
+    from aiohttp import web
+
+    import bot
+
+    await bot.ensure_db_ready()
+    bot._start_state_store()
+    counter = install_round_trip_counter(bot)
+
+    runner = web.AppRunner(bot.create_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    async def stop():
+        await runner.cleanup()
+        await bot.shutdown()
+
+    return f"http://127.0.0.1:{port}", counter, stop
+
+
+async def run(args) -> dict:
+    import aiohttp
+
+    counter = None
+    stop = None
+    if args.url:
+        base_url = args.url.rstrip("/")
+    else:
+        base_url, counter, stop = await start_in_process_server(args)
+
+    stats = Stats()
+    connector = aiohttp.TCPConnector(limit=args.connections)
+    try:
+        async with aiohttp.ClientSession(connector=connector) as session:
+            started = time.perf_counter()
+            deadline = time.monotonic() + args.duration
+            round_trips_before = counter.count if counter else 0
+            await asyncio.gather(
+                *(
+                    run_player(session, base_url, args.first_user_id + index, args, stats, deadline)
+                    for index in range(args.users)
+                )
+            )
+            elapsed = time.perf_counter() - started
+    finally:
+        if stop is not None:
+            await stop()
+
+    all_latencies = [latency for values in stats.latencies.values() for latency in values]
+    total = latency_summary(all_latencies, elapsed)
+    total["errors"] = sum(stats.errors.values())
+    results = {
+        "timestamp": int(time.time()),
+        "git_revision": git_revision(),
+        "config": {
+            "backend": "external" if args.url else args.backend,
+            "driver": args.driver,
+            "state_store": os.getenv("STATE_STORE", "0"),
+            "users": args.users,
+            "duration_s": args.duration,
+            "tap_rate": args.tap_rate,
+            "flush_ms": args.flush_ms,
+        },
+        "total": total,
+        "statuses": stats.statuses,
+        "endpoints": {
+            endpoint: {**latency_summary(values, elapsed), "errors": stats.errors.get(endpoint, 0)}
+            for endpoint, values in sorted(stats.latencies.items())
+        },
+    }
+    if counter is not None and total["count"]:
+        results["db_round_trips_per_request"] = (counter.count - round_trips_before) / total["count"]
+    return results
+
+
+def print_results(results: dict):
+    print(f"{'endpoint':<30} {'count':>7} {'rps':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    rows = list(results["endpoints"].items()) + [("TOTAL", results["total"])]
+    for endpoint, summary in rows:
+        print(
+            f"{endpoint:<30} {summary['count']:>7} {summary['rps']:>8.1f} "
+            f"{summary['p50_ms']:>8.2f} {summary['p99_ms']:>8.2f} {summary.get('errors', 0):>7}"
+        )
+    if "db_round_trips_per_request" in results:
+        print(f"DB round-trips per request: {results['db_round_trips_per_request']:.2f}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="drive a running server instead of starting one in-process")
+    parser.add_argument("--backend", choices=["sqlite", "postgres"], default="sqlite")
+    parser.add_argument("--driver", choices=["sync", "async", "memory"], default=os.getenv("DB_DRIVER", "sync"))
+    parser.add_argument("--database-url", default="")
+    parser.add_argument("--bot-token", default=TEST_BOT_TOKEN)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--first-user-id", type=int, default=10_000_000)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--tap-rate", type=float, default=8.0, help="taps per second per player")
+    parser.add_argument("--flush-ms", type=int, default=120, help="TAP_BATCH_INTERVAL_MS in script.js")
+    parser.add_argument("--poll-s", type=float, default=15.0)
+    parser.add_argument("--leaderboard-s", type=float, default=20.0)
+    parser.add_argument("--buy-s", type=float, default=30.0)
+    parser.add_argument("--connections", type=int, default=0, help="client connection limit, 0 = unlimited")
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = asyncio.run(run(args))
+    print_results(results)
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"loadtest-{results['config']['backend']}-{args.driver}-{results['timestamp']}.json"
+    )
+    write_results(output, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Replays an action journal into a users table and checks the result.
+
+Reads the entries of a JOURNAL_DIR after its checkpoint (or generates
+--synthetic entries for --users players), folds them to the final columns of
+every player and applies those with one executemany per column set, the way
+the server does at start. With --compare the same entries are also applied
+one UPDATE per entry in a single transaction on a second copy, and the script
+verifies both tables end up identical and reports both timings.
+
+Runs on a temporary SQLite file by default, or on PostgreSQL with
+--database-url (the users table must exist; rows for the journal's players
+are created when missing).
+
+    python tools/replay_journal.py --synthetic 200000 --users 5000 --compare
+    python tools/replay_journal.py --journal /var/lib/clicker/journal --database-url postgresql://...
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from common import RESULTS_DIR, git_revision, write_results
+
+from journal import fold, read_checkpoint, read_entries
+from user_record import FIELDS, group_updates, update_params, update_query
+
+USERS_TABLE = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    coins REAL DEFAULT 0,
+    energy REAL DEFAULT 1000,
+    max_energy INTEGER DEFAULT 1000,
+    multi_tap_level INTEGER DEFAULT 1,
+    energy_level INTEGER DEFAULT 1,
+    auto_tap_level INTEGER DEFAULT 0,
+    skin_bought BOOLEAN DEFAULT FALSE,
+    last_update BIGINT DEFAULT 0,
+    username TEXT DEFAULT 'Аноним',
+    first_name TEXT DEFAULT 'Игрок',
+    ban_end_time BIGINT DEFAULT 0,
+    tap_window_start BIGINT DEFAULT 0,
+    tap_count INTEGER DEFAULT 0,
+    version BIGINT NOT NULL DEFAULT 0
+)
+"""
+
+
+def synthetic_entries(count: int, users: int, seed: int = 1):
+    # Taps with the occasional upgrade, as resolve_actions records them.
+    rng = random.Random(seed)
+    coins = [0.0] * users
+    energy = [1000.0] * users
+    level = [1] * users
+    now = int(time.time() * 1000)
+    entries = []
+    for seq in range(1, count + 1):
+        index = rng.randrange(users)
+        now += rng.randint(1, 20)
+        if rng.random() < 0.02 and coins[index] >= 100:
+            coins[index] -= 100
+            level[index] += 1
+            delta = {"coins": coins[index], "multi_tap_level": level[index], "last_update": now}
+            action = "upgrade_multitap"
+        else:
+            taps = rng.randint(1, 10)
+            coins[index] += taps * level[index]
+            energy[index] = max(0.0, energy[index] - taps)
+            delta = {"coins": coins[index], "energy": energy[index], "last_update": now, "tap_count": taps}
+            action = "tap"
+        entries.append({"seq": seq, "ts": now, "user_id": str(1_000_000 + index), "action": action, "delta": delta})
+    return entries
+
+
+class Target:
+    def __init__(self, database_url: str, path: str):
+        if database_url:
+            import psycopg2
+            import psycopg2.extras
+
+            self.conn = psycopg2.connect(database_url)
+            self.paramstyle = "format"
+            self.executemany = lambda cursor, query, params: psycopg2.extras.execute_batch(
+                cursor, query, params, page_size=500
+            )
+        else:
+            self.conn = sqlite3.connect(path)
+            self.paramstyle = "qmark"
+            self.executemany = lambda cursor, query, params: cursor.executemany(query, params)
+            self.conn.execute(USERS_TABLE)
+            self.conn.commit()
+        self.placeholder = "%s" if database_url else "?"
+
+    def ensure_users(self, user_ids):
+        cursor = self.conn.cursor()
+        self.executemany(
+            cursor,
+            f"INSERT INTO users (user_id) VALUES ({self.placeholder}) ON CONFLICT (user_id) DO NOTHING",
+            [(user_id,) for user_id in user_ids],
+        )
+        self.conn.commit()
+
+    def apply_folded(self, rows):
+        cursor = self.conn.cursor()
+        for columns, params in group_updates(rows).items():
+            self.executemany(cursor, update_query(columns, self.paramstyle), params)
+        self.conn.commit()
+
+    def apply_each(self, entries):
+        cursor = self.conn.cursor()
+        for entry in entries:
+            delta = entry["delta"]
+            cursor.execute(update_query(tuple(delta), self.paramstyle), update_params(entry["user_id"], delta))
+        self.conn.commit()
+
+    def snapshot(self, user_ids) -> dict:
+        cursor = self.conn.cursor()
+        columns = ", ".join(("user_id",) + FIELDS)
+        cursor.execute(f"SELECT {columns} FROM users ORDER BY user_id")
+        wanted = set(user_ids)
+        return {row[0]: tuple(row[1:]) for row in cursor.fetchall() if row[0] in wanted}
+
+    def close(self):
+        self.conn.close()
+
+
+def run(args) -> dict:
+    if args.journal:
+        after_seq = read_checkpoint(args.journal) if args.after_checkpoint else 0
+        entries = list(read_entries(args.journal, after_seq))
+    else:
+        entries = synthetic_entries(args.synthetic, args.users)
+    user_ids = sorted({entry["user_id"] for entry in entries})
+    workdir = tempfile.mkdtemp(prefix="replay-journal-")
+
+    started = time.perf_counter()
+    rows = fold(entries)
+    fold_s = time.perf_counter() - started
+
+    folded = Target(args.database_url, os.path.join(workdir, "folded.db"))
+    folded.ensure_users(user_ids)
+    started = time.perf_counter()
+    folded.apply_folded(rows)
+    apply_s = time.perf_counter() - started
+
+    results = {
+        "timestamp": int(time.time()),
+        "git_revision": git_revision(),
+        "entries": len(entries),
+        "users": len(user_ids),
+        "fold_s": fold_s,
+        "apply_folded_s": apply_s,
+        "update_statements": len(rows),
+    }
+
+    if args.compare:
+        if args.database_url:
+            # One database: snapshot the folded result, then replay over it.
+            expected = folded.snapshot(user_ids)
+            each = folded
+        else:
+            expected = folded.snapshot(user_ids)
+            each = Target("", os.path.join(workdir, "each.db"))
+            each.ensure_users(user_ids)
+        started = time.perf_counter()
+        each.apply_each(entries)
+        results["apply_each_s"] = time.perf_counter() - started
+        results["identical"] = each.snapshot(user_ids) == expected
+        if each is not folded:
+            each.close()
+    folded.close()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--journal", help="JOURNAL_DIR (or a worker-N subdirectory) to replay")
+    source.add_argument("--synthetic", type=int, default=100_000, help="number of generated entries")
+    parser.add_argument("--users", type=int, default=2000, help="players in the generated entries")
+    parser.add_argument(
+        "--after-checkpoint", action="store_true", help="replay only entries after the journal's checkpoint"
+    )
+    parser.add_argument("--database-url", default="", help="PostgreSQL DSN; a temporary SQLite file by default")
+    parser.add_argument("--compare", action="store_true", help="also apply entry by entry and compare")
+    parser.add_argument("--output", default="")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    results = run(args)
+    print(
+        f"{results['entries']} entries for {results['users']} players: fold {results['fold_s'] * 1000:.1f} ms, "
+        f"{results['update_statements']} updates in {results['apply_folded_s'] * 1000:.1f} ms"
+    )
+    if "apply_each_s" in results:
+        print(
+            f"entry by entry: {results['apply_each_s'] * 1000:.1f} ms, "
+            f"tables {'identical' if results['identical'] else 'DIFFER'}"
+        )
+    write_results(args.output or os.path.join(RESULTS_DIR, f"replay-journal-{results['timestamp']}.json"), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import functools
+
+# Column order of the users table (after user_id).
+FIELDS = (
+    "coins",
+    "energy",
+    "max_energy",
+    "multi_tap_level",
+    "energy_level",
+    "auto_tap_level",
+    "skin_bought",
+    "last_update",
+    "username",
+    "first_name",
+    "ban_end_time",
+    "tap_window_start",
+    "tap_count",
+)
+IDENTITY_FIELDS = ("username", "first_name")
+_BITS = {name: 1 << index for index, name in enumerate(FIELDS)}
+
+
+# A player row as slots plus a bitmask of changed columns. It supports the
+# mapping operations game.py uses (data["coins"], data.get(), dict(data)), and
+# an assignment that does not change the value is not recorded, so the
+# identity fields Telegram sends with every request are written only when the
+# user actually renamed themselves.
+class UserRecord:
+    __slots__ = FIELDS + ("_dirty",)
+
+    def __init__(self, values: dict):
+        for name in FIELDS:
+            setattr(self, name, values[name])
+        self._dirty = 0
+
+    def __getitem__(self, key: str):
+        if key not in _BITS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value):
+        bit = _BITS[key]
+        if getattr(self, key) != value:
+            setattr(self, key, value)
+            self._dirty |= bit
+
+    def __contains__(self, key) -> bool:
+        return key in _BITS
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+    def keys(self):
+        return FIELDS
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in _BITS else default
+
+    @property
+    def dirty_fields(self) -> tuple:
+        return tuple(name for name in FIELDS if self._dirty & _BITS[name])
+
+    def take_changes(self) -> dict:
+        # Changed columns in table order; the record is clean afterwards.
+        changes = {name: getattr(self, name) for name in FIELDS if self._dirty & _BITS[name]}
+        self._dirty = 0
+        return changes
+
+    def mark_dirty(self, fields):
+        for name in fields:
+            self._dirty |= _BITS[name]
+
+
+@functools.lru_cache(maxsize=256)
+def update_query(columns: tuple, paramstyle: str = "numeric", versioned: bool = False) -> str:
+    # UPDATE of just the given columns; paramstyle is "numeric" ($n, asyncpg
+    # and the aiosqlite adapter), "format" (psycopg2) or "qmark" (sqlite3).
+    # Every update bumps the row version; a versioned one applies only if the
+    # version is still the one read (the last parameter, after user_id).
+    count = len(columns) + (2 if versioned else 1)
+    if paramstyle == "format":
+        placeholders = ["%s"] * count
+    elif paramstyle == "qmark":
+        placeholders = ["?"] * count
+    else:
+        placeholders = [f"${index}" for index in range(1, count + 1)]
+    assignments = ", ".join(f"{column} = {placeholder}" for column, placeholder in zip(columns, placeholders))
+    where = f"user_id = {placeholders[len(columns)]}"
+    if versioned:
+        where += f" AND version = {placeholders[-1]}"
+    return f"UPDATE users SET {assignments}, version = version + 1 WHERE {where}"
+
+
+def update_params(user_id: str, changes: dict) -> tuple:
+    params = [bool(value) if column == "skin_bought" else value for column, value in changes.items()]
+    params.append(user_id)
+    return tuple(params)
+
+
+def group_updates(rows) -> dict:
+    # (user_id, changes) pairs grouped by column set, one executemany each.
+    groups = {}
+    for user_id, changes in rows:
+        if changes:
+            groups.setdefault(tuple(changes), []).append(update_params(user_id, changes))
+    return groups
@@ -0,0 +1,90 @@
+import asyncio
+import hashlib
+import hmac
+
+from aiohttp import web
+
+from metrics import WEBHOOK_IN_FLIGHT, WEBHOOK_UPDATES
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def derive_secret(bot_token: str) -> str:
+    # Stable across restarts and workers; Telegram allows [A-Za-z0-9_-].
+    return hashlib.sha256(b"webhook:" + bot_token.encode("utf-8")).hexdigest()
+
+
+# Receives Telegram updates on the mini app's aiohttp server instead of a
+# long-poll loop. Every update is acknowledged as soon as it is parsed and
+# handled in the background; at most max_in_flight are processed at once, and
+# when all slots are busy the response is held back, which makes Telegram
+# slow down instead of queueing unbounded work in memory. Until the bot is
+# attached, updates go to forward (the worker that runs the bot) or get 503
+# so Telegram redelivers them later.
+class TelegramWebhook:
+    def __init__(self, secret: str, max_in_flight: int = 100, forward=None):
+        self.secret = secret
+        self.forward = forward
+        self.bot = None
+        self.dispatcher = None
+        self._slots = asyncio.Semaphore(max(1, max_in_flight))
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def attach(self, bot, dispatcher):
+        self.bot = bot
+        self.dispatcher = dispatcher
+
+    async def handle(self, request: web.Request) -> web.Response:
+        supplied = request.headers.get(SECRET_HEADER, "")
+        if not self.secret or not hmac.compare_digest(supplied, self.secret):
+            WEBHOOK_UPDATES.inc("rejected")
+            return web.json_response({"error": "forbidden"}, status=403)
+        try:
+            payload = await request.json()
+        except ValueError:
+            WEBHOOK_UPDATES.inc("rejected")
+            return web.json_response({"error": "invalid_json"}, status=400)
+
+        if self.bot is None:
+            if self.forward is None:
+                return web.json_response({"error": "bot_not_ready"}, status=503)
+            await self.forward(payload)
+            WEBHOOK_UPDATES.inc("forwarded")
+            return web.Response()
+
+        try:
+            await self.feed(payload)
+        except ValueError:
+            WEBHOOK_UPDATES.inc("rejected")
+            return web.json_response({"error": "invalid_update"}, status=400)
+        return web.Response()
+
+    async def feed(self, payload: dict):
+        # Loaded with the bot (create_bot); pydantic's ValidationError is a ValueError.
+        from aiogram.types import Update
+
+        update = Update.model_validate(payload, context={"bot": self.bot})
+        await self._slots.acquire()
+        WEBHOOK_IN_FLIGHT.inc()
+        WEBHOOK_UPDATES.inc("accepted")
+        task = asyncio.create_task(self._process(update))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, update):
+        try:
+            await self.dispatcher.feed_update(self.bot, update)
+        except Exception as e:
+            WEBHOOK_UPDATES.inc("failed")
+            print(f"Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            WEBHOOK_IN_FLIGHT.dec()
+            self._slots.release()
+
+    async def stop(self, timeout_s: float = 10):
+        # Updates already acknowledged are not redelivered by Telegram.
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout_s)
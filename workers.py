@@ -0,0 +1,121 @@
+import hmac
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+import zlib
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+
+SECRET_HEADER = "X-Worker-Secret"
+
+
+def owner_index(user_id: str, workers: int) -> int:
+    # Stable across processes and restarts, unlike hash().
+    return zlib.crc32(str(user_id).encode("utf-8")) % workers
+
+
+# Routing between web workers that share one public port through
+# SO_REUSEPORT. Every user has exactly one owner worker; requests that land on
+# another worker are forwarded to the owner's internal port, so per-user state
+# kept in memory (PlayerStateStore, cached rows) lives in one process only.
+class WorkerRouter:
+    def __init__(self, index: int, count: int, base_port: int, secret: str, timeout_s: float = 10):
+        self.index = index
+        self.count = count
+        self.base_port = base_port
+        self.secret = secret
+        self.timeout = ClientTimeout(total=timeout_s)
+        self._session = None
+        self._runner = None
+
+    def owner(self, user_id: str) -> int:
+        return owner_index(user_id, self.count)
+
+    def owns(self, user_id: str) -> bool:
+        return self.owner(user_id) == self.index
+
+    def group(self, user_ids) -> dict[int, list[str]]:
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(self.owner(user_id), []).append(user_id)
+        return groups
+
+    async def call(self, worker: int, method: str, payload: dict):
+        if self._session is None:
+            self._session = ClientSession(connector=TCPConnector(limit=0), timeout=self.timeout)
+        url = f"http://127.0.0.1:{self.base_port + worker}/internal/{method}"
+        async with self._session.post(url, json=payload, headers={SECRET_HEADER: self.secret}) as response:
+            if response.status != 200:
+                raise RuntimeError(f"worker {worker} {method}: HTTP {response.status}")
+            return await response.json()
+
+    async def start(self, handlers: dict, extra_routes=()):
+        # handlers: {method: async fn(payload) -> JSON-serializable result}.
+        async def dispatch(request: web.Request):
+            supplied = request.headers.get(SECRET_HEADER, "")
+            if not hmac.compare_digest(supplied.encode(), self.secret.encode()):
+                return web.json_response({"error": "forbidden"}, status=403)
+            handler = handlers.get(request.match_info["method"])
+            if handler is None:
+                return web.json_response({"error": "unknown_method"}, status=404)
+            return web.json_response(await handler(await request.json()))
+
+        app = web.Application()
+        app.router.add_post("/internal/{method}", dispatch)
+        for method, path, handler in extra_routes:
+            app.router.add_route(method, path, handler)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.base_port + self.index).start()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+def run_master(count: int, argv: list[str]) -> int:
+    # Pre-fork supervisor: starts count copies of this script with
+    # WEB_WORKER_INDEX set, restarts the ones that die and forwards
+    # SIGTERM/SIGINT on shutdown.
+    secret = secrets.token_hex(16)
+    stopping = False
+
+    def spawn(index: int):
+        env = dict(os.environ, WEB_WORKER_INDEX=str(index), WORKER_SECRET=secret)
+        return subprocess.Popen([sys.executable] + argv, env=env)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    processes = {index: spawn(index) for index in range(count)}
+    print(f"Запущено веб-воркеров: {count}")
+    while not stopping:
+        time.sleep(0.5)
+        for index, process in processes.items():
+            if process.poll() is not None and not stopping:
+                print(f"Воркер {index} завершился с кодом {process.returncode}, перезапуск")
+                time.sleep(1)
+                processes[index] = spawn(index)
+
+    for process in processes.values():
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+    deadline = time.monotonic() + 30
+    for process in processes.values():
+        try:
+            process.wait(timeout=max(0.1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            process.kill()
+    return 0
+
@@ -0,0 +1,218 @@
+import asyncio
+import functools
+import json
+import time
+
+from aiohttp import WSCloseCode, WSMsgType, web
+
+from action_queue import ActionQueueFull
+from metrics import WS_ACTION_SECONDS, WS_CONNECTIONS, WS_DROPPED
+
+_dumps = functools.partial(json.dumps, separators=(",", ":"), ensure_ascii=False)
+
+CLOSE_UNAUTHORIZED = 4401
+_MISSING = object()
+
+
+class _Connection:
+    __slots__ = ("ws", "user_id", "username", "first_name", "state", "rank", "outbox", "writer")
+
+    def __init__(self, ws: web.WebSocketResponse, user: dict, max_queue: int):
+        self.ws = ws
+        self.user_id = str(user["id"])
+        self.username = user.get("username") or "Аноним"
+        self.first_name = user.get("first_name") or "Игрок"
+        self.state = {}
+        self.rank = None
+        self.outbox = asyncio.Queue(maxsize=max_queue)
+        self.writer = None
+
+
+# WebSocket transport for the mini app. The client authenticates once with
+# {"type": "auth", "init_data": ...}, then sends {"type": "action", "id": n,
+# "action": ..., ...} frames and gets back {"type": "result", "id": n,
+# "event": ..., "delta": {only changed fields}}. Rank changes caused by other
+# players are pushed as {"type": "rank"}. Outgoing frames go through a bounded
+# queue per connection; a client that stops reading is disconnected instead
+# of being buffered without limit.
+class WebSocketHub:
+    def __init__(
+        self,
+        authenticate,
+        load_state,
+        perform_action,
+        rank_of,
+        max_connections: int = 10000,
+        idle_timeout_s: float = 60,
+        max_queue: int = 64,
+        rank_push_interval_ms: int = 2000,
+    ):
+        self._authenticate = authenticate
+        self._load_state = load_state
+        self._perform_action = perform_action
+        self._rank_of = rank_of
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout_s
+        self.max_queue = max(1, max_queue)
+        self.rank_push_interval = rank_push_interval_ms / 1000
+        self._connections: set[_Connection] = set()
+        self._open = 0
+        self._rank_task = None
+
+    def __len__(self):
+        return len(self._connections)
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        # Sockets still authenticating count against the limit too.
+        if self._open >= self.max_connections:
+            return web.json_response({"error": "too_many_connections"}, status=503)
+        self._ensure_rank_pushes()
+
+        ws = web.WebSocketResponse(heartbeat=max(1.0, self.idle_timeout / 2), max_msg_size=4096)
+        await ws.prepare(request)
+        self._open += 1
+        conn = None
+        try:
+            conn = await self._handshake(ws)
+            if conn is None:
+                return ws
+            self._connections.add(conn)
+            WS_CONNECTIONS.inc()
+            conn.writer = asyncio.create_task(self._write(conn))
+
+            data = await self._load_state(conn.user_id, conn.username, conn.first_name)
+            conn.state = dict(data)
+            conn.rank = self._rank_of(conn.user_id)
+            self._send(conn, {"type": "state", "data": conn.state, "rank": conn.rank})
+            await self._serve(conn)
+        finally:
+            if conn is not None and conn in self._connections:
+                self._connections.discard(conn)
+                WS_CONNECTIONS.dec()
+                conn.writer.cancel()
+            self._open -= 1
+            await ws.close()
+        return ws
+
+    async def _handshake(self, ws: web.WebSocketResponse):
+        msg = await self._receive(ws, WSCloseCode.POLICY_VIOLATION, b"auth timeout")
+        if msg.type != WSMsgType.TEXT:
+            return None
+
+        try:
+            frame = json.loads(msg.data)
+        except ValueError:
+            frame = None
+        user = None
+        if isinstance(frame, dict) and frame.get("type") == "auth":
+            user = self._authenticate(str(frame.get("init_data", "")))
+        if not user:
+            await ws.send_str(_dumps({"type": "error", "error": "unauthorized"}))
+            await ws.close(code=CLOSE_UNAUTHORIZED, message=b"unauthorized")
+            return None
+        return _Connection(ws, user, self.max_queue)
+
+    async def _receive(self, ws: web.WebSocketResponse, code: int, reason: bytes):
+        # receive(timeout=...) drops the TCP connection on timeout; closing from
+        # a timer sends a proper close frame and ends the pending receive.
+        timer = asyncio.get_running_loop().call_later(
+            self.idle_timeout, lambda: asyncio.ensure_future(ws.close(code=code, message=reason))
+        )
+        try:
+            return await ws.receive()
+        finally:
+            timer.cancel()
+
+    async def _serve(self, conn: _Connection):
+        ws = conn.ws
+        while not ws.closed:
+            msg = await self._receive(ws, WSCloseCode.GOING_AWAY, b"idle")
+            if msg.type != WSMsgType.TEXT:
+                return
+
+            try:
+                frame = json.loads(msg.data)
+            except ValueError:
+                frame = None
+            if not isinstance(frame, dict):
+                self._send(conn, {"type": "error", "error": "invalid_json"})
+                continue
+
+            kind = frame.get("type")
+            if kind == "action":
+                await self._action(conn, frame)
+            elif kind == "sync":
+                data = await self._load_state(conn.user_id, conn.username, conn.first_name)
+                self._send(conn, {"type": "delta", "delta": self._delta(conn, data)})
+            else:
+                self._send(conn, {"type": "error", "id": frame.get("id"), "error": "unknown_type"})
+
+    async def _action(self, conn: _Connection, frame: dict):
+        action = str(frame.get("action", "")).strip()
+        if not action:
+            self._send(conn, {"type": "error", "id": frame.get("id"), "error": "action_required"})
+            return
+
+        started = time.perf_counter()
+        try:
+            result = await self._perform_action(conn.user_id, action, conn.username, conn.first_name, frame)
+        except ActionQueueFull:
+            self._send(conn, {"type": "error", "id": frame.get("id"), "error": "too_many_requests"})
+            return
+        except Exception as e:
+            print(f"Ошибка действия по WebSocket: {e}")
+            self._send(conn, {"type": "error", "id": frame.get("id"), "error": "internal"})
+            return
+        WS_ACTION_SECONDS.observe(time.perf_counter() - started, "tap_batch" if action == "tap_batch" else "other")
+
+        reply = {"type": "result", "id": frame.get("id"), "event": result["event"], "delta": self._delta(conn, result["data"])}
+        rank = self._rank_of(conn.user_id)
+        if rank != conn.rank:
+            conn.rank = reply["rank"] = rank
+        self._send(conn, reply)
+
+    @staticmethod
+    def _delta(conn: _Connection, data: dict) -> dict:
+        state = conn.state
+        delta = {key: value for key, value in data.items() if state.get(key, _MISSING) != value}
+        state.update(delta)
+        return delta
+
+    def _send(self, conn: _Connection, message: dict, droppable: bool = False) -> bool:
+        try:
+            conn.outbox.put_nowait(_dumps(message))
+            return True
+        except asyncio.QueueFull:
+            WS_DROPPED.inc("push" if droppable else "slow_consumer")
+            if not droppable:
+                asyncio.create_task(conn.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"slow consumer"))
+            return False
+
+    async def _write(self, conn: _Connection):
+        try:
+            while True:
+                await conn.ws.send_str(await conn.outbox.get())
+        except (ConnectionResetError, RuntimeError):
+            pass
+
+    def _ensure_rank_pushes(self):
+        if self._rank_task is None and self.rank_push_interval > 0:
+            self._rank_task = asyncio.create_task(self._push_ranks())
+
+    async def _push_ranks(self):
+        while True:
+            await asyncio.sleep(self.rank_push_interval)
+            for conn in list(self._connections):
+                rank = self._rank_of(conn.user_id)
+                if rank is not None and rank != conn.rank:
+                    # A full queue just means this push waits for the next round.
+                    if self._send(conn, {"type": "rank", "rank": rank}, droppable=True):
+                        conn.rank = rank
+
+    async def stop(self):
+        if self._rank_task is not None:
+            self._rank_task.cancel()
+            self._rank_task = None
+        for conn in list(self._connections):
+            await conn.ws.close(code=WSCloseCode.GOING_AWAY, message=b"server shutdown")
+